@@ -1,7 +1,27 @@
 import pygame
 import sys
+import os
+import argparse
 import math
 import random
+import json
+import mmap
+import struct
+import hashlib
+import inspect
+import ast
+import threading
+import time
+import gc
+import tracemalloc
+import linecache
+import shutil
+import atexit
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 # -------------------------------------------------
 # INIT
@@ -101,6 +121,7 @@ STATE_CASTLE     = 2
 STATE_LEVEL_SEL  = 3
 STATE_PLAYING    = 4
 STATE_STAR_GET   = 5
+STATE_LOADING    = 6
 
 # -------------------------------------------------
 # 3D MATH
@@ -130,6 +151,15 @@ def lerp_color(c1, c2, t):
 # -------------------------------------------------
 # MARIO
 # -------------------------------------------------
+MARIO_FACES = (
+    ((0,1,2,3), MARIO_BLUE),
+    ((4,5,6,7), MARIO_RED),
+    ((0,4,5,1), MARIO_RED),
+    ((2,6,7,3), MARIO_RED),
+    ((1,5,6,2), MARIO_BLUE),
+    ((0,4,7,3), MARIO_BLUE),
+)
+
 class Mario:
     def __init__(self, x, z):
         self.x, self.y, self.z = x, 0.0, z
@@ -148,14 +178,17 @@ class Mario:
         self.coins           = 0
         self.lives           = 4
         self.floor_y         = 0.0
+        self.floor_item      = None   # collision index item Mario is standing on
 
     def respawn(self, x, z):
         self.x, self.y, self.z = x, 0.0, z
         self.vx = self.vy = self.vz = 0.0
         self.grounded = True
         self.floor_y = 0.0
+        self.floor_item = None
 
     def update(self, keys, cam_yaw, platforms=None):
+        """platforms is the course's CollisionBVH."""
         move_x = move_z = 0
         if keys[pygame.K_LEFT]  or keys[pygame.K_a]: move_x -= 1
         if keys[pygame.K_RIGHT] or keys[pygame.K_d]: move_x += 1
@@ -189,17 +222,29 @@ class Mario:
         self.y += self.vy
         self.z += self.vz
 
-        # Platform collision
+        # Platform collision against the boxes under Mario's column
         self.floor_y = 0.0
+        self.floor_item = None
         if platforms:
-            for px, py, pz, pw, ph, pd in platforms:
-                hx, hz = pw / 2, pd / 2
-                if (px - hx <= self.x <= px + hx and
-                    pz - hz <= self.z <= pz + hz):
-                    top = py + ph / 2
-                    if self.y <= top and self.y + self.vy <= top + 5:
-                        if self.floor_y < top:
-                            self.floor_y = top
+            first_mover = platforms.first_mover
+            for item, (px, py, pz, pw, ph, pd) in platforms.column(self.x, self.z):
+                top = py + ph / 2
+                # Static boxes keep the step-up onto any top above Mario's feet; movers
+                # need him above their top before this tick's move, or riding one under
+                # another would snap him onto the upper one
+                if item >= first_mover:
+                    lands = self.y <= top <= self.y - self.vy + 5
+                else:
+                    lands = self.y <= top and self.y + self.vy <= top + 5
+                if lands:
+                    if self.floor_y < top:
+                        self.floor_y = top
+                        self.floor_item = item
+            for terrain in platforms.terrains:
+                top = terrain.height_at(self.x, self.z)
+                if top is not None and self.floor_y < top:
+                    self.floor_y = top
+                    self.floor_item = None
 
         if self.y <= self.floor_y:
             self.y = self.floor_y
@@ -207,6 +252,7 @@ class Mario:
             self.grounded = True
         else:
             self.grounded = False
+            self.floor_item = None
 
         if keys[pygame.K_SPACE] and self.grounded:
             self.vy = self.jump_force
@@ -231,15 +277,7 @@ class Mario:
             (self.x + s, self.y + h, self.z + s),
             (self.x - s, self.y + h, self.z + s),
         ]
-        faces = [
-            ([0,1,2,3], MARIO_BLUE),
-            ([4,5,6,7], MARIO_RED),
-            ([0,4,5,1], MARIO_RED),
-            ([2,6,7,3], MARIO_RED),
-            ([1,5,6,2], MARIO_BLUE),
-            ([0,4,7,3], MARIO_BLUE),
-        ]
-        return verts, faces
+        return verts, MARIO_FACES
 
 # -------------------------------------------------
 # CAMERA
@@ -265,151 +303,1346 @@ class Camera:
 # -------------------------------------------------
 # COLLECTIBLES
 # -------------------------------------------------
-class Star:
-    def __init__(self, x, y, z):
-        self.x, self.y, self.z = x, y, z
-        self.collected = False
-        self.bob = 0.0
-
-    def update(self):
-        self.bob += 0.06
-
-    def check(self, mario):
-        if self.collected:
-            return False
-        dx = mario.x - self.x
-        dy = mario.y - (self.y + math.sin(self.bob) * 10)
-        dz = mario.z - self.z
-        if math.sqrt(dx*dx + dy*dy + dz*dz) < 60:
-            self.collected = True
-            mario.stars_collected += 1
-            return True
-        return False
+STAR_BOB_RATE   = 0.06
+STAR_BOB_HEIGHT = 10
+STAR_REACH      = 60
+COIN_SPIN_RATE  = 0.08
+COIN_REACH      = 45
+STAR_FACES = (
+    ((0,1,2), STAR_YELLOW), ((0,2,3), STAR_YELLOW),
+    ((0,3,4), STAR_YELLOW), ((0,4,1), STAR_YELLOW),
+    ((5,2,1), GOLD),        ((5,3,2), GOLD),
+    ((5,4,3), GOLD),        ((5,1,4), GOLD),
+)
+COIN_FACES = (((0,1,2,3), YELLOW),)
+
+class EntityStore:
+    """Parallel arrays for one kind of entity; indexing yields thin views.
+
+    Position, animation phase, collected flag and the activity tick an
+    entity last ran live in NumPy arrays so the systems below can update
+    every entity of a kind in one vectorised pass.
+    """
+    fields = ("pos", "phase", "collected", "last_tick")
+
+    def __init__(self, view, capacity=8):
+        self.view      = view
+        self.count     = 0
+        self.pos       = np.zeros((capacity, 3), dtype=np.float64)
+        self.phase     = np.zeros(capacity, dtype=np.float64)
+        self.collected = np.zeros(capacity, dtype=bool)
+        self.last_tick = np.zeros(capacity, dtype=np.int64)
+
+    def add(self, x, y, z):
+        if self.count == len(self.phase):
+            self._grow(2 * self.count)
+        i = self.count
+        self.pos[i] = (x, y, z)
+        self.count += 1
+        return self.view(self, i)
+
+    def _grow(self, capacity):
+        for name in self.fields:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def reset(self):
+        n = self.count
+        self.phase[:n] = 0.0
+        self.collected[:n] = False
+        self.last_tick[:n] = 0
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.fields)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.view(self, i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.view(self, i)
+
+class EntityView:
+    """One row of an EntityStore."""
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    x = property(lambda self: float(self.store.pos[self.index, 0]))
+    y = property(lambda self: float(self.store.pos[self.index, 1]))
+    z = property(lambda self: float(self.store.pos[self.index, 2]))
+
+    @property
+    def collected(self):
+        return bool(self.store.collected[self.index])
+
+    @collected.setter
+    def collected(self, value):
+        self.store.collected[self.index] = value
+
+class Star(EntityView):
+    __slots__ = ()
+
+    @property
+    def bob(self):
+        return float(self.store.phase[self.index])
 
     def get_mesh(self):
         if self.collected:
             return [], []
-        y_off = math.sin(self.bob) * 10
+        x, y, z = self.store.pos[self.index].tolist()
+        y_off = math.sin(self.bob) * STAR_BOB_HEIGHT
         s = 15
-        cy = self.y + y_off
+        cy = y + y_off
         verts = [
-            (self.x, cy + s*2, self.z),
-            (self.x - s, cy + s*0.5, self.z - s),
-            (self.x + s, cy + s*0.5, self.z - s),
-            (self.x + s, cy + s*0.5, self.z + s),
-            (self.x - s, cy + s*0.5, self.z + s),
-            (self.x, cy - s, self.z),
-        ]
-        faces = [
-            ([0,1,2], STAR_YELLOW), ([0,2,3], STAR_YELLOW),
-            ([0,3,4], STAR_YELLOW), ([0,4,1], STAR_YELLOW),
-            ([5,2,1], GOLD),        ([5,3,2], GOLD),
-            ([5,4,3], GOLD),        ([5,1,4], GOLD),
+            (x, cy + s*2, z),
+            (x - s, cy + s*0.5, z - s),
+            (x + s, cy + s*0.5, z - s),
+            (x + s, cy + s*0.5, z + s),
+            (x - s, cy + s*0.5, z + s),
+            (x, cy - s, z),
         ]
-        return verts, faces
+        return verts, STAR_FACES
 
-class Coin:
-    def __init__(self, x, y, z):
-        self.x, self.y, self.z = x, y, z
-        self.collected = False
-        self.spin = 0.0
+class Coin(EntityView):
+    __slots__ = ()
 
-    def update(self):
-        self.spin += 0.08
-
-    def check(self, mario):
-        if self.collected:
-            return False
-        dx = mario.x - self.x
-        dy = mario.y - self.y
-        dz = mario.z - self.z
-        if math.sqrt(dx*dx + dy*dy + dz*dz) < 45:
-            self.collected = True
-            mario.coins += 1
-            return True
-        return False
+    @property
+    def spin(self):
+        return float(self.store.phase[self.index])
 
     def get_mesh(self):
         if self.collected:
             return [], []
+        x, y, z = self.store.pos[self.index].tolist()
         s = 8
         w = abs(math.cos(self.spin)) * s + 2
         verts = [
-            (self.x - w, self.y,      self.z),
-            (self.x + w, self.y,      self.z),
-            (self.x + w, self.y + s*2, self.z),
-            (self.x - w, self.y + s*2, self.z),
+            (x - w, y,       z),
+            (x + w, y,       z),
+            (x + w, y + s*2, z),
+            (x - w, y + s*2, z),
         ]
-        faces = [([0,1,2,3], YELLOW)]
-        return verts, faces
+        return verts, COIN_FACES
+
+def bob_system(stars, ticks):
+    stars.phase[:stars.count] += STAR_BOB_RATE * ticks
+
+def spin_system(coins, ticks):
+    coins.phase[:coins.count] += COIN_SPIN_RATE * ticks
+
+def pickup_system(store, mario, reach, lift=None):
+    """Mark entities within reach of Mario as collected; returns how many were picked up."""
+    n = store.count
+    d = store.pos[:n] - (mario.x, mario.y, mario.z)
+    if lift is not None:
+        d[:, 1] += lift
+    hit = ~store.collected[:n] & ((d * d).sum(axis=1) < reach * reach)
+    store.collected[:n] |= hit
+    return int(hit.sum())
+
+# -------------------------------------------------
+# ENTITY ACTIVITY
+# -------------------------------------------------
+ACTIVITY_RADIUS = 2000.0   # entities further than this from Mario and the camera sleep
+
+class ActivityManager:
+    """Decides which entities tick: those near Mario or the camera; the rest sleep.
+
+    Each store remembers the tick an entity last ran, so when it wakes it is
+    advanced by every tick it missed and its animation phase matches an
+    entity that never slept.
+    """
+    def __init__(self, radius=ACTIVITY_RADIUS):
+        self.radius = radius
+        self.tick   = 0
+        self.awake  = 0
+        self.asleep = 0
+
+    def step(self, stores, points):
+        """Advance one tick; returns, per store, the number of ticks each entity should run."""
+        self.tick += 1
+        r2 = self.radius * self.radius
+        awake = asleep = 0
+        out = []
+        for store in stores:
+            n = store.count
+            pos = store.pos[:n]
+            near = np.zeros(n, dtype=bool)
+            for p in points:
+                d = pos - p
+                near |= (d * d).sum(axis=1) <= r2
+            live = ~store.collected[:n]
+            wake = near & live
+            ticks = np.where(wake, self.tick - store.last_tick[:n], 0)
+            store.last_tick[:n][wake] = self.tick
+            awake += int(wake.sum())
+            asleep += int((live & ~near).sum())
+            out.append(ticks)
+        self.awake, self.asleep = awake, asleep
+        return out
+
+def simulate_world(world, mario, cam, collect=True):
+    """Advance the course's entities by one tick; returns the number of stars picked up."""
+    world.stream(mario)
+    points = ((mario.x, mario.y, mario.z), (cam.x, cam.y, cam.z))
+    star_ticks, coin_ticks, enemy_ticks = world.activity.step(
+        (world.stars, world.coins, world.enemies), points)
+    mover_system(world, mario)
+    world.scene.animate(world.activity.tick)
+    for water in world.waters:
+        water.animate(world.activity.tick)
+    bob_system(world.stars, star_ticks)
+    spin_system(world.coins, coin_ticks)
+    enemy_ai_system(world.enemies, enemy_ticks, mario)
+    render_stats["entities_awake"] = world.activity.awake
+    render_stats["entities_asleep"] = world.activity.asleep
+    if not collect:
+        return 0
+    stars = world.stars
+    got = pickup_system(stars, mario, STAR_REACH,
+                        np.sin(stars.phase[:stars.count]) * STAR_BOB_HEIGHT)
+    mario.stars_collected += got
+    mario.coins += pickup_system(world.coins, mario, COIN_REACH)
+    enemy_contact_system(world.enemies, mario)
+    return got
+
+# -------------------------------------------------
+# ENEMIES
+# -------------------------------------------------
+ENEMY_KINDS = {
+    #  name      size  speed  sight  hover  color
+    "goomba":   (30,   2.0,   350,   0,     DARK_BROWN),
+    "chomp":    (70,   3.5,   450,   0,     CHAIN_GRAY),
+    "whomp":    (90,   1.2,   250,   0,     STONE_GRAY),
+    "boo":      (40,   1.6,   400,   25,    WHITE),
+}
+ENEMY_KIND_NAMES = list(ENEMY_KINDS)
+ENEMY_CHASE_BOOST = 1.6   # chase speed relative to patrol speed
+ENEMY_PATROL_FRAC = 0.6   # patrol circle radius as a fraction of the leash
+SQUASH_TICKS      = 30    # a stomped enemy stays flattened this long, then is gone
+ENEMY_LOD_PIXELS  = 14    # enemies smaller than this on screen are drawn as one quad
+STOMP_BOUNCE      = 0.75  # fraction of Mario's jump force given back on a stomp
+KNOCKBACK         = 12.0
+
+class Enemy(EntityView):
+    __slots__ = ()
+
+    @property
+    def kind(self):
+        return ENEMY_KIND_NAMES[self.store.kind[self.index]]
+
+class EnemyStore(EntityStore):
+    """Enemies: collectible fields plus home, leash and per-kind tuning.
+
+    phase is the patrol angle around home; collected means defeated.
+    """
+    fields = EntityStore.fields + ("home", "leash", "size", "speed", "sight", "hover", "kind", "squash")
+
+    def __init__(self, capacity=8):
+        super().__init__(Enemy, capacity)
+        self.home   = np.zeros((capacity, 3), dtype=np.float64)
+        self.leash  = np.zeros(capacity, dtype=np.float64)
+        self.size   = np.zeros(capacity, dtype=np.float64)
+        self.speed  = np.zeros(capacity, dtype=np.float64)
+        self.sight  = np.zeros(capacity, dtype=np.float64)
+        self.hover  = np.zeros(capacity, dtype=np.float64)
+        self.kind   = np.zeros(capacity, dtype=np.uint8)
+        self.squash = np.zeros(capacity, dtype=np.int32)
+        self._shades = None
+
+    def add(self, kind, x, y, z, leash=200):
+        enemy = super().add(x, y, z)
+        i = enemy.index
+        size, speed, sight, hover, _ = ENEMY_KINDS[kind]
+        self.home[i] = (x, y, z)
+        self.leash[i] = leash
+        self.size[i], self.speed[i], self.sight[i], self.hover[i] = size, speed, sight, hover
+        self.kind[i] = ENEMY_KIND_NAMES.index(kind)
+        self.phase[i] = (i * 2.39996) % (2 * math.pi)   # spread patrols out
+        return enemy
+
+    def reset(self):
+        super().reset()
+        n = self.count
+        self.pos[:n] = self.home[:n]
+        self.phase[:n] = (np.arange(n) * 2.39996) % (2 * math.pi)
+        self.squash[:n] = 0
+
+    def face_colors(self, lights, ambient):
+        """Per-kind colours of the six box faces, lit like the baked course."""
+        if self._shades is None:
+            self._shades = [box_shades(kind[4], lights, ambient) for kind in ENEMY_KINDS.values()]
+        return self._shades
+
+def enemy_ai_system(enemies, ticks, mario):
+    """Patrol around home, chase Mario while he is in sight and inside the leash."""
+    n = enemies.count
+    if n == 0:
+        return
+    active = (ticks > 0) & (enemies.squash[:n] == 0)
+    speed = enemies.speed[:n]
+    leash = enemies.leash[:n]
+    home = enemies.home[:n]
+    pos = enemies.pos[:n]
+
+    enemies.phase[:n] += np.where(active, speed / np.maximum(leash * ENEMY_PATROL_FRAC, 1.0) * ticks, 0.0)
+    phase = enemies.phase[:n]
+    target_x = home[:, 0] + np.cos(phase) * leash * ENEMY_PATROL_FRAC
+    target_z = home[:, 2] + np.sin(phase) * leash * ENEMY_PATROL_FRAC
+
+    to_mx, to_mz = mario.x - pos[:, 0], mario.z - pos[:, 2]
+    hx, hz = mario.x - home[:, 0], mario.z - home[:, 2]
+    chase = (to_mx * to_mx + to_mz * to_mz < enemies.sight[:n] ** 2) & (hx * hx + hz * hz < leash * leash)
+    target_x = np.where(chase, mario.x, target_x)
+    target_z = np.where(chase, mario.z, target_z)
+
+    dx, dz = target_x - pos[:, 0], target_z - pos[:, 2]
+    dist = np.sqrt(dx * dx + dz * dz)
+    step = np.minimum(dist, speed * np.where(chase, ENEMY_CHASE_BOOST, 1.0) * ticks)
+    k = np.where(active, step / np.maximum(dist, 1e-6), 0.0)
+    pos[:, 0] += dx * k
+    pos[:, 2] += dz * k
+    pos[:, 1] = home[:, 1] + enemies.hover[:n] * (1 + np.sin(phase * 3)) * 0.5
+
+    squashed = enemies.squash[:n] > 0
+    enemies.squash[:n] = np.where(squashed, np.maximum(enemies.squash[:n] - ticks, 0), 0)
+    enemies.collected[:n] |= squashed & (enemies.squash[:n] == 0)
+
+def enemy_contact_system(enemies, mario):
+    """Stomp enemies Mario lands on; anything else he touches knocks him back."""
+    n = enemies.count
+    if n == 0:
+        return
+    pos = enemies.pos[:n]
+    size = enemies.size[:n]
+    dx, dz = mario.x - pos[:, 0], mario.z - pos[:, 2]
+    reach = size * 0.5 + mario.size
+    touch = (~enemies.collected[:n] & (enemies.squash[:n] == 0)
+             & (np.abs(dx) < reach) & (np.abs(dz) < reach)
+             & (mario.y < pos[:, 1] + size) & (mario.y + mario.size * 2 > pos[:, 1]))
+    if not touch.any():
+        return
+    stomp = touch & (mario.vy < 0) & (mario.y > pos[:, 1] + size * 0.5)
+    if stomp.any():
+        enemies.squash[:n][stomp] = SQUASH_TICKS
+        mario.vy = mario.jump_force * STOMP_BOUNCE
+        mario.grounded = False
+        return
+    i = int(np.argmax(touch))
+    d = math.hypot(dx[i], dz[i]) or 1.0
+    mario.vx = dx[i] / d * KNOCKBACK
+    mario.vz = dz[i] / d * KNOCKBACK
+    mario.vy = KNOCKBACK * 0.8
+    mario.grounded = False
+
+# -------------------------------------------------
+# MOVING PLATFORMS
+# -------------------------------------------------
+class Mover(EntityView):
+    __slots__ = ()
+
+class MoverStore(EntityStore):
+    """Kinematic boxes whose centre is a function of the course clock:
+
+        centre(t) = base + a * sin(omega * t + phase) + b * cos(omega * t + phase)
+
+    a alone slides back and forth, a and b at right angles orbit. pos holds
+    the centre for the current tick.
+    """
+    fields = EntityStore.fields + ("base", "size", "a", "b", "omega", "color")
+
+    def __init__(self, capacity=4):
+        super().__init__(Mover, capacity)
+        self.base  = np.zeros((capacity, 3), dtype=np.float64)
+        self.size  = np.zeros((capacity, 3), dtype=np.float64)
+        self.a     = np.zeros((capacity, 3), dtype=np.float64)
+        self.b     = np.zeros((capacity, 3), dtype=np.float64)
+        self.omega = np.zeros(capacity, dtype=np.float64)
+        self.color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.first_item = 0   # collision index item of mover 0
+        self.nodes = []       # SceneNode drawing each mover
+
+    def add(self, x, y, z, w, h, d, color, a=(0, 0, 0), b=(0, 0, 0), period=240, phase=0.0):
+        mover = super().add(x, y, z)
+        i = mover.index
+        self.base[i] = (x, y, z)
+        self.size[i] = (w, h, d)
+        self.a[i] = a
+        self.b[i] = b
+        self.omega[i] = 2 * math.pi / period
+        self.phase[i] = phase
+        self.color[i] = color
+        self.pos[i] = self.centres(0)[i]
+        return mover
+
+    def centres(self, t):
+        n = self.count
+        angle = (self.omega[:n] * t + self.phase[:n])[:, None]
+        return self.base[:n] + self.a[:n] * np.sin(angle) + self.b[:n] * np.cos(angle)
+
+    def reset(self):
+        # phase is the path offset here, so it survives a reset
+        self.collected[:self.count] = False
+        self.last_tick[:self.count] = 0
+        self.pos[:self.count] = self.centres(0)
+
+    def boxes(self):
+        return [tuple(p) + tuple(s) for p, s in zip(self.pos[:self.count].tolist(),
+                                                   self.size[:self.count].tolist())]
+
+    def meta(self):
+        n = self.count
+        period = (2 * math.pi / self.omega[:n]).tolist()
+        return [self.base[i].tolist() + self.size[i].tolist()
+                + [self.color[i].tolist(), self.a[i].tolist(), self.b[i].tolist(), period[i],
+                   float(self.phase[i])] for i in range(n)]
+
+class CollisionBVH:
+    """Bounding-volume hierarchy over (x, y, z, w, h, d) platform boxes.
+
+    Built once per course. When boxes move, refit() rewrites their leaves and
+    recomputes only the ancestors of those leaves, so the tree is never rebuilt.
+    """
+    def __init__(self, boxes, terrains=(), first_mover=None):
+        self.boxes   = [tuple(b) for b in boxes]
+        self.terrains = list(terrains)   # heightfields, floors everywhere over their footprint
+        self.first_mover = len(self.boxes) if first_mover is None else first_mover   # items from here on move
+        self.lo      = []
+        self.hi      = []
+        self.left    = []
+        self.right   = []
+        self.parent  = []
+        self.item    = []        # box index for leaves, -1 for inner nodes
+        self.leaf_of = [0] * len(self.boxes)
+        if self.boxes:
+            self._build(list(range(len(self.boxes))), -1)
+
+    def __len__(self):
+        return len(self.boxes) + len(self.terrains)
+
+    @staticmethod
+    def _bounds(box):
+        x, y, z, w, h, d = box
+        return [x - w/2, y - h/2, z - d/2], [x + w/2, y + h/2, z + d/2]
+
+    def _build(self, items, parent):
+        node = len(self.lo)
+        self.lo.append(None)
+        self.hi.append(None)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.parent.append(parent)
+        self.item.append(-1)
+        if len(items) == 1:
+            self.item[node] = items[0]
+            self.leaf_of[items[0]] = node
+            self.lo[node], self.hi[node] = self._bounds(self.boxes[items[0]])
+            return node
+        centres = [self.boxes[i][:3] for i in items]
+        spans = [max(c[k] for c in centres) - min(c[k] for c in centres) for k in range(3)]
+        axis = spans.index(max(spans))
+        items = sorted(items, key=lambda i: self.boxes[i][axis])
+        mid = len(items) // 2
+        self.left[node] = self._build(items[:mid], node)
+        self.right[node] = self._build(items[mid:], node)
+        self._union(node)
+        return node
+
+    def _union(self, node):
+        a, b = self.left[node], self.right[node]
+        self.lo[node] = [min(p, q) for p, q in zip(self.lo[a], self.lo[b])]
+        self.hi[node] = [max(p, q) for p, q in zip(self.hi[a], self.hi[b])]
+
+    def refit(self, moved):
+        """Update the boxes at indices `moved` (already written to self.boxes)."""
+        dirty = set()
+        for i in moved:
+            leaf = self.leaf_of[i]
+            self.lo[leaf], self.hi[leaf] = self._bounds(self.boxes[i])
+            n = self.parent[leaf]
+            while n >= 0 and n not in dirty:
+                dirty.add(n)
+                n = self.parent[n]
+        # Children are always numbered after their parent, so this is bottom-up
+        for n in sorted(dirty, reverse=True):
+            self._union(n)
+        return len(dirty)
+
+    def column(self, x, z):
+        """(index, box) for every box whose footprint contains (x, z)."""
+        if not self.boxes:
+            return
+        stack = [0]
+        while stack:
+            n = stack.pop()
+            lo, hi = self.lo[n], self.hi[n]
+            if x < lo[0] or x > hi[0] or z < lo[2] or z > hi[2]:
+                continue
+            if self.item[n] >= 0:
+                yield self.item[n], self.boxes[self.item[n]]
+            else:
+                stack.append(self.left[n])
+                stack.append(self.right[n])
+
+def mover_system(world, mario):
+    """Move every platform to its position for this tick, refit the index and carry the rider."""
+    movers = world.movers
+    n = movers.count
+    if n == 0:
+        return
+    centre = movers.centres(world.activity.tick)
+    delta = centre - movers.pos[:n]
+    movers.pos[:n] = centre
+    moved = np.nonzero(np.abs(delta).max(axis=1) > 0)[0].tolist()
+    collision = world.collision
+    first = movers.first_item
+    for i, p, size in zip(moved, centre[moved].tolist(), movers.size[moved].tolist()):
+        collision.boxes[first + i] = tuple(p) + tuple(size)
+    render_stats["bvh_refit_nodes"] = collision.refit([first + i for i in moved])
+    for i, p in zip(moved, centre[moved].tolist()):
+        movers.nodes[i].set(pos=p)
+    rider = mario.floor_item
+    if mario.grounded and rider is not None and rider >= first:
+        dx, dy, dz = delta[rider - first].tolist()
+        mario.x += dx
+        mario.y += dy
+        mario.z += dz
+        mario.floor_y += dy
+
+# -------------------------------------------------
+# SCENE GRAPH
+# -------------------------------------------------
+def _rotation(yaw, pitch, roll):
+    """Ry(yaw) @ Rx(pitch) @ Rz(roll)."""
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cr, sr = math.cos(roll), math.sin(roll)
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rx = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    rz = np.array([[cr, -sr, 0], [sr, cr, 0], [0, 0, 1]])
+    return ry @ rx @ rz
+
+def box_mesh(boxes, lights, ambient):
+    """Local (verts, faces) for a list of (x, y, z, w, h, d, color) boxes, lit per face."""
+    verts = []
+    faces = []
+    for x, y, z, w, h, d, color in boxes:
+        base = len(verts)
+        verts.extend((x + (bx - 0.5) * w, y + (by - 0.5) * h, z + (bz - 0.5) * d)
+                     for bx, by, bz in _BOX_CORNER_BITS.tolist())
+        for quad, shade in zip(_BOX_QUADS, box_shades(color, lights, ambient)):
+            faces.append(([base + i for i in quad], shade))
+    return verts, faces
+
+class SceneNode:
+    """Local transform (position, yaw/pitch/roll, scale) with an optional small mesh.
+
+    The world transform and world-space vertices are cached; changing a
+    node's transform marks it and its whole subtree dirty, and only dirty
+    nodes are recomputed on the next SceneGraph.update().
+
+    anim = (axis, rate, amplitude, period) drives one angle from the course
+    clock: rate * t + amplitude * sin(2 pi t / period).
+    """
+    def __init__(self, name, pos=(0, 0, 0), yaw=0.0, pitch=0.0, roll=0.0, scale=1.0,
+                 verts=None, faces=None, anim=None):
+        self.name     = name
+        self.parent   = None
+        self.children = []
+        self.graph    = None
+        self.depth    = 0
+        self.pos      = tuple(pos)
+        self.yaw, self.pitch, self.roll = yaw, pitch, roll
+        self.scale    = scale
+        self.verts    = np.asarray(verts, dtype=np.float64).reshape(-1, 3) if verts else None
+        self.faces    = faces or []
+        self.anim     = anim
+        self.dirty    = True
+        self.world_rot    = np.eye(3)
+        self.world_origin = np.zeros(3)
+        self.world_verts  = None
+        self.world_normals = None
+        if self.verts is not None:
+            tri = np.array([ind[:3] for ind, _ in self.faces])
+            a, b, c = self.verts[tri[:, 0]], self.verts[tri[:, 1]], self.verts[tri[:, 2]]
+            self.normals = np.cross(b - a, c - a)
+            self.face_first = tri[:, 0]
+
+    def add(self, child):
+        child.parent = self
+        self.children.append(child)
+        if self.graph is not None:
+            self.graph._register(child, self.depth + 1)
+        return child
+
+    def set(self, pos=None, yaw=None, pitch=None, roll=None):
+        if pos is not None:
+            self.pos = tuple(pos)
+        if yaw is not None:
+            self.yaw = yaw
+        if pitch is not None:
+            self.pitch = pitch
+        if roll is not None:
+            self.roll = roll
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        if self.graph is not None:
+            self.graph._dirty.add(self)
+        self._mark_subtree()
+
+    def _mark_subtree(self):
+        self.dirty = True
+        for child in self.children:
+            if not child.dirty:
+                child._mark_subtree()
+
+    def _refresh(self):
+        """Recompute this node and its dirty descendants; returns how many were recomputed."""
+        if self.parent is None:
+            rot, origin = np.eye(3), np.zeros(3)
+        else:
+            rot, origin = self.parent.world_rot, self.parent.world_origin
+        self.world_origin = origin + rot @ np.asarray(self.pos, dtype=np.float64)
+        self.world_rot = rot @ _rotation(self.yaw, self.pitch, self.roll) * self.scale
+        if self.verts is not None:
+            self.world_verts = self.verts @ self.world_rot.T + self.world_origin
+            self.world_normals = self.normals @ self.world_rot.T
+        self.dirty = False
+        count = 1
+        for child in self.children:
+            if child.dirty:
+                count += child._refresh()
+        return count
+
+class SceneGraph:
+    """Root of a course's animated parts; static subtrees cost nothing once cached."""
+    def __init__(self):
+        self.root     = SceneNode("root")
+        self.nodes    = [self.root]
+        self.animated = []
+        self.drawable = []
+        self._dirty   = {self.root}
+        self.root.graph = self
+
+    def add(self, node, parent=None):
+        return (parent or self.root).add(node)
+
+    def _register(self, node, depth):
+        node.graph = self
+        node.depth = depth
+        self.nodes.append(node)
+        if node.anim is not None:
+            self.animated.append(node)
+        if node.verts is not None:
+            self.drawable.append(node)
+        node.mark_dirty()
+        for child in node.children:
+            self._register(child, depth + 1)
+
+    def find(self, name):
+        for node in self.nodes:
+            if node.name == name:
+                return node
+        return None
+
+    def animate(self, t):
+        for node in self.animated:
+            axis, rate, amplitude, period = node.anim
+            angle = rate * t + amplitude * math.sin(2 * math.pi * t / period)
+            node.set(**{axis: angle})
+
+    def update(self):
+        """Refresh dirty subtrees, parents first; returns the number of nodes recomputed."""
+        count = 0
+        for node in sorted(self._dirty, key=lambda n: n.depth):
+            if node.dirty:
+                count += node._refresh()
+        self._dirty.clear()
+        return count
+
+    def meta(self):
+        index = {node: i for i, node in enumerate(self.nodes)}
+        return [{
+            "name":   node.name,
+            "parent": index[node.parent] if node.parent is not None else -1,
+            "pos":    list(node.pos),
+            "angles": [node.yaw, node.pitch, node.roll],
+            "scale":  node.scale,
+            "verts":  node.verts.tolist() if node.verts is not None else None,
+            "faces":  [[list(ind), list(c)] for ind, c in node.faces],
+            "anim":   list(node.anim) if node.anim is not None else None,
+        } for node in self.nodes]
+
+    @classmethod
+    def from_meta(cls, entries):
+        graph = cls()
+        nodes = [graph.root]
+        for e in entries[1:]:
+            yaw, pitch, roll = e["angles"]
+            node = SceneNode(e["name"], e["pos"], yaw, pitch, roll, e["scale"], e["verts"],
+                             [(ind, tuple(c)) for ind, c in e["faces"]],
+                             tuple(e["anim"]) if e["anim"] is not None else None)
+            nodes[e["parent"]].add(node)
+            nodes.append(node)
+        return graph
+
+# -------------------------------------------------
+# HEIGHTMAP TERRAIN
+# -------------------------------------------------
+TERRAIN_CHUNK     = 4      # cells per chunk side; must be a power of two
+TERRAIN_MAX_ERROR = 12.0   # screen pixels of height error a coarser chunk level may show
+
+class Terrain:
+    """Square heightmap split into chunks with precomputed LOD levels.
+
+    heights is (cells + 1, cells + 1), indexed [x, z]. Level l of a chunk uses
+    every 2**l-th grid vertex; each frame a chunk takes the coarsest level whose
+    height error projects to at most TERRAIN_MAX_ERROR pixels, so flat chunks are
+    a single quad at any distance. Where a chunk borders a coarser one its edge
+    vertices are snapped onto the coarse edge for that frame, so neighbouring
+    levels meet without cracks. bands is [(max_height, color)].
+    """
+    def __init__(self, x, z, size, heights, bands, lights, ambient, chunk=TERRAIN_CHUNK):
+        self.heights = np.asarray(heights, dtype=np.float32)
+        n = self.heights.shape[0] - 1
+        self.x, self.z, self.size = x, z, size
+        self.x0, self.z0 = x - size / 2, z - size / 2
+        self.cells   = n
+        self.spacing = size / n
+        self.chunk   = chunk
+        self.bands   = [(float(h), tuple(c)) for h, c in bands]
+        self.levels  = int(math.log2(chunk)) + 1
+        side = n // chunk
+        self.side = side
+
+        gx = self.x0 + np.arange(n + 1) * self.spacing
+        gz = self.z0 + np.arange(n + 1) * self.spacing
+        self.positions = np.stack([np.repeat(gx, n + 1), self.heights.ravel().astype(np.float64),
+                                   np.tile(gz, n + 1)], axis=1)
+        self.base_y = self.positions[:, 1].copy()
+        vid = np.arange((n + 1) ** 2).reshape(n + 1, n + 1)
+        norm = _unit_lights(lights)
+
+        self.chunk_faces   = []   # [chunk][level] -> (F, 4) vertex ids
+        self.chunk_normals = []
+        self.chunk_colors  = []
+        self.chunk_edges   = []   # [chunk] -> 4 edge vertex id arrays: -x, +x, -z, +z
+        self.neighbours    = []   # [chunk] -> 4 chunk ids (-1 outside)
+        self.errors        = np.zeros((side * side, self.levels))   # max height error per chunk level
+        centres = []
+        for ci in range(side):
+            for cj in range(side):
+                i0, j0 = ci * chunk, cj * chunk
+                block = vid[i0:i0 + chunk + 1, j0:j0 + chunk + 1]
+                faces_l, normals_l, colors_l = [], [], []
+                for level in range(self.levels):
+                    s = 1 << level
+                    self.errors[len(centres), level] = self._level_error(self.heights[i0:i0 + chunk + 1,
+                                                                                      j0:j0 + chunk + 1], s)
+                    sub = block[::s, ::s]
+                    quads = np.stack([sub[:-1, :-1], sub[:-1, 1:], sub[1:, 1:], sub[1:, :-1]], axis=-1).reshape(-1, 4)
+                    p = self.positions[quads]
+                    normal = np.cross(p[:, 2] - p[:, 0], p[:, 3] - p[:, 1])
+                    unit = normal / np.linalg.norm(normal, axis=1, keepdims=True)
+                    colors = [self._shade(h, u, norm, ambient)
+                              for h, u in zip(p[:, :, 1].mean(axis=1).tolist(), unit.tolist())]
+                    faces_l.append(quads)
+                    normals_l.append(normal)
+                    colors_l.append(colors)
+                self.chunk_faces.append(faces_l)
+                self.chunk_normals.append(normals_l)
+                self.chunk_colors.append(colors_l)
+                self.chunk_edges.append((block[0, :], block[-1, :], block[:, 0], block[:, -1]))
+                self.neighbours.append(tuple(
+                    (ci + di) * side + (cj + dj) if 0 <= ci + di < side and 0 <= cj + dj < side else -1
+                    for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1))))
+                centres.append(self.positions[block.ravel()].mean(axis=0))
+        self.centres = np.array(centres)
+        self.radius = chunk * self.spacing * 0.75
+        np.maximum.accumulate(self.errors, axis=1, out=self.errors)
+
+    @staticmethod
+    def _level_error(block, s):
+        """Largest gap between a chunk's heights and the bilinear surface through every s-th vertex."""
+        k = np.arange(block.shape[0])
+        lo = (k // s) * s
+        hi = np.minimum(lo + s, k[-1])
+        t = (k - lo) / s
+        rows = block[lo] * (1 - t)[:, None] + block[hi] * t[:, None]
+        coarse = rows[:, lo] * (1 - t) + rows[:, hi] * t
+        return float(np.abs(block - coarse).max())
+
+    def _shade(self, height, normal, lights, ambient):
+        color = self.bands[-1][1]
+        for top, band_color in self.bands:
+            if height <= top:
+                color = band_color
+                break
+        level = _light_level(normal, lights, ambient)
+        return tuple(min(255, int(c * level)) for c in color)
+
+    def height_at(self, x, z):
+        """Bilinear height of the full-resolution grid, or None outside the terrain."""
+        u = (x - self.x0) / self.spacing
+        v = (z - self.z0) / self.spacing
+        n = self.cells
+        if not (0 <= u <= n and 0 <= v <= n):
+            return None
+        i, j = min(int(u), n - 1), min(int(v), n - 1)
+        fu, fv = u - i, v - j
+        h = self.heights
+        return float((h[i, j] * (1 - fu) + h[i + 1, j] * fu) * (1 - fv)
+                     + (h[i, j + 1] * (1 - fu) + h[i + 1, j + 1] * fu) * fv)
+
+    def select_levels(self, cam):
+        d = np.linalg.norm(self.centres - (cam.x, cam.y, cam.z), axis=1)
+        pixels = self.errors * (700 / np.maximum(d - self.radius, 1.0))[:, None]
+        return (pixels <= TERRAIN_MAX_ERROR).sum(axis=1) - 1, d
+
+    def stitched_heights(self, levels):
+        """Vertex heights for this frame with fine edges snapped onto coarser neighbours."""
+        y = self.base_y.copy()
+        base = self.base_y
+        k = np.arange(self.chunk + 1)
+        for c, level in enumerate(levels.tolist()):
+            for edge, nb in zip(self.chunk_edges[c], self.neighbours[c]):
+                if nb < 0 or levels[nb] <= level:
+                    continue
+                s = 1 << int(levels[nb])
+                lo = (k // s) * s
+                hi = np.minimum(lo + s, self.chunk)
+                t = (k - lo) / s
+                y[edge] = base[edge[lo]] * (1 - t) + base[edge[hi]] * t
+        return y
+
+    def project(self, cam, fog=None):
+        """Visible front faces, one painter_order entry per chunk -> [(anchor, items)]."""
+        levels, dist = self.select_levels(cam)
+        pos = self.positions.copy()
+        pos[:, 1] = self.stitched_heights(levels)
+        sx, sy, rz, in_front = project_vertices(pos, cam)
+        xs, ys = sx.tolist(), sy.tolist()
+        cam_pos = np.array((cam.x, cam.y, cam.z))
+        out = []
+        drawn = 0
+        for c, level in enumerate(levels.tolist()):
+            if fog is not None and dist[c] - self.radius > fog.far:
+                continue
+            faces = self.chunk_faces[c][level]
+            ok = in_front[faces].all(axis=1)
+            ok &= np.einsum("ij,ij->i", self.chunk_normals[c][level], cam_pos - pos[faces[:, 0]]) > 0
+            if fog is not None:
+                ok &= rz[faces].min(axis=1) <= fog.far
+            keep = np.nonzero(ok)[0]
+            if len(keep) == 0:
+                continue
+            depth = rz[faces[keep]].mean(axis=1).tolist()
+            colors = self.chunk_colors[c][level]
+            items = []
+            for f, d in zip(keep.tolist(), depth):
+                color = colors[f] if fog is None else fog.blend(colors[f], d)
+                items.append((d, [(xs[i], ys[i]) for i in faces[f].tolist()], color, None))
+            drawn += len(items)
+            out.append((tuple(self.centres[c].tolist()), items))
+        render_stats["terrain_faces"] = render_stats.get("terrain_faces", 0) + drawn
+        return out
+
+    def meta(self):
+        return {"x": self.x, "z": self.z, "size": self.size, "bands": [[h, list(c)] for h, c in self.bands],
+                "chunk": self.chunk}
+
+# -------------------------------------------------
+# WATER
+# -------------------------------------------------
+WATER_CHUNK    = 4       # cells per chunk side; must be a power of two
+WATER_SPACING  = 75.0    # target grid spacing
+WATER_LOD_NEAR = 1300.0   # chunks nearer than this are drawn at full resolution
+
+class WaterSurface:
+    """Animated water: a chunked, LOD'd flat grid whose heights come from one NumPy wave
+    expression a frame, evaluated only for the chunks that survive culling."""
+    def __init__(self, x, y, z, w, d, color, lights, ambient, amplitude=6.0, wavelength=300.0, period=180,
+                 spacing=WATER_SPACING, chunk=WATER_CHUNK):
+        self.x, self.y, self.z, self.w, self.d = x, y, z, w, d
+        self.color      = tuple(color)
+        self.amplitude  = amplitude
+        self.wavelength = wavelength
+        self.period     = period
+        self.spacing    = spacing
+        self.chunk      = chunk
+        self.levels     = int(math.log2(chunk)) + 1
+        side_x = max(1, math.ceil(w / (spacing * chunk)))
+        side_z = max(1, math.ceil(d / (spacing * chunk)))
+        nx, nz = side_x * chunk, side_z * chunk
+        self.x0, self.z0 = x - w / 2, z - d / 2
+        self.cell_x, self.cell_z = w / nx, d / nz
+        self.row = nz + 1   # vertex id = i * row + j
+        vid = np.arange((nx + 1) * (nz + 1)).reshape(nx + 1, nz + 1)
+
+        self.chunk_quads = []   # [chunk][level] -> (F, 4) vertex ids
+        self.chunk_verts = []   # [chunk][level] -> vertex ids the quads use
+        centres = []
+        for ci in range(side_x):
+            for cj in range(side_z):
+                i0, j0 = ci * chunk, cj * chunk
+                block = vid[i0:i0 + chunk + 1, j0:j0 + chunk + 1]
+                quads_l, verts_l = [], []
+                for level in range(self.levels):
+                    sub = block[::1 << level, ::1 << level]
+                    quads_l.append(np.stack([sub[:-1, :-1], sub[:-1, 1:], sub[1:, 1:], sub[1:, :-1]],
+                                            axis=-1).reshape(-1, 4))
+                    verts_l.append(sub.ravel())
+                self.chunk_quads.append(quads_l)
+                self.chunk_verts.append(verts_l)
+                centres.append((self.x0 + (i0 + chunk / 2) * self.cell_x, y,
+                                self.z0 + (j0 + chunk / 2) * self.cell_z))
+        self.centres = np.array(centres)
+        self.radius  = math.hypot(self.cell_x, self.cell_z) * chunk / 2
+        self.fade    = max(WATER_LOD_NEAR - self.radius, 1.0)   # waves are flat from here out
+
+        norm = _unit_lights(lights)
+        self.light_dirs  = np.array([l for l, _ in norm])
+        self.light_power = np.array([i for _, i in norm])
+        self.ambient     = ambient
+        self.shades = [tuple(min(255, int(c * k / LIGHT_LEVELS)) for c in self.color)
+                       for k in range(int(1.25 * LIGHT_LEVELS) + 1)]
+        self.t = 0
+
+    def animate(self, t):
+        self.t = t
+
+    def visible_chunks(self, cam, fog=None):
+        """Chunks inside the view cone (and far plane) -> (chunk ids, distances)."""
+        rel = self.centres - (cam.x, cam.y, cam.z)
+        dist = np.linalg.norm(rel, axis=1)
+        cos_a, sin_a = math.cos(-cam.yaw), math.sin(-cam.yaw)
+        rx = rel[:, 0] * cos_a - rel[:, 2] * sin_a
+        rz = rel[:, 0] * sin_a + rel[:, 2] * cos_a
+        half = WIDTH / 2 / 700   # project_point's fov
+        live = (rz > -self.radius) & (np.abs(rx) < rz * half + self.radius * (1 + half))
+        if fog is not None:
+            live &= dist - self.radius <= fog.far
+        chunks = np.nonzero(live)[0]
+        return chunks, dist[chunks]
+
+    def project(self, cam, fog=None):
+        """Visible front faces, one painter_order entry per quad -> [(anchor, items)]."""
+        chunks, dist = self.visible_chunks(cam, fog)
+        if len(chunks) == 0:
+            return []
+        levels = np.floor(np.log2(np.maximum(dist, 1.0) / WATER_LOD_NEAR)) + 1
+        levels = np.clip(levels, 0, self.levels - 1).astype(np.int64).tolist()
+        chunks = chunks.tolist()
+        verts = np.unique(np.concatenate([self.chunk_verts[c][l] for c, l in zip(chunks, levels)]))
+        quads = np.searchsorted(verts, np.concatenate([self.chunk_quads[c][l] for c, l in zip(chunks, levels)]))
+
+        i, j = np.divmod(verts, self.row)
+        px = self.x0 + i * self.cell_x
+        pz = self.z0 + j * self.cell_z
+        k, phase = 2 * math.pi / self.wavelength, 2 * math.pi * self.t / self.period
+        py = self.y + self.amplitude * 0.5 * np.clip(
+            (self.fade - np.sqrt((px - cam.x) ** 2 + (self.y - cam.y) ** 2 + (pz - cam.z) ** 2)) / self.radius,
+            0, 1) * (
+            np.sin(px * k + phase) + np.sin((px * 0.6 + pz * 0.8) * k * 1.7 - phase * 1.3))
+
+        pos = np.stack([px, py, pz], axis=1)
+        sx, sy, rz, in_front = project_vertices(pos, cam)
+        p = pos[quads]
+        normal = np.cross(p[:, 2] - p[:, 0], p[:, 3] - p[:, 1])
+        qx, qy = sx[quads], sy[quads]
+        ok = in_front[quads].all(axis=1)
+        ok &= (qx.max(axis=1) >= 0) & (qx.min(axis=1) < WIDTH) & (qy.max(axis=1) >= 0) & (qy.min(axis=1) < HEIGHT)
+        ok &= np.einsum("ij,ij->i", normal, (cam.x, cam.y, cam.z) - p[:, 0]) > 0
+        if fog is not None:
+            ok &= rz[quads].min(axis=1) <= fog.far
+        keep = np.nonzero(ok)[0]
+        unit = normal[keep] / np.linalg.norm(normal[keep], axis=1, keepdims=True)
+        light = self.ambient + (np.maximum(unit @ self.light_dirs.T, 0.0) * self.light_power).sum(axis=1)
+        shade = np.rint(np.minimum(light, 1.25) * LIGHT_LEVELS).astype(np.int64).tolist()
+        depth = rz[quads[keep]].mean(axis=1).tolist()
+        mid_x = p[keep, :, 0].mean(axis=1).tolist()
+        mid_z = p[keep, :, 2].mean(axis=1).tolist()
+
+        xs, ys = sx.tolist(), sy.tolist()
+        out = []
+        for f, s, d, ax, az in zip(quads[keep].tolist(), shade, depth, mid_x, mid_z):
+            color = self.shades[s] if fog is None else fog.blend(self.shades[s], d)
+            out.append(((ax, self.y, az), [(d, [(xs[v], ys[v]) for v in f], color, None)]))
+        render_stats["water_faces"] = render_stats.get("water_faces", 0) + len(keep)
+        return out
+
+    def meta(self):
+        return {"x": self.x, "y": self.y, "z": self.z, "w": self.w, "d": self.d, "color": list(self.color),
+                "amplitude": self.amplitude, "wavelength": self.wavelength, "period": self.period,
+                "spacing": self.spacing, "chunk": self.chunk}
+
+# -------------------------------------------------
+# WORLD STREAMING
+# -------------------------------------------------
+STREAM_LOAD_RADIUS  = 2400.0             # chunks with any point this close to Mario are paged in
+STREAM_EVICT_RADIUS = 3600.0             # resident chunks further than this are dropped
+STREAM_BUDGET_BYTES = 256 * 1024         # cap on resident chunk data (about 50 chunks)
+STREAM_DISK_CHUNKS  = 512                # compiled chunk files kept on disk, least recently used go first
+
+class ChunkStreamer:
+    """Keeps the chunks of a StreamedCourse around Mario resident, loading them on a worker thread.
+
+    The gap between the load and evict radii stops edge chunks paging in and out every frame."""
+    def __init__(self, course, load_radius=STREAM_LOAD_RADIUS, evict_radius=STREAM_EVICT_RADIUS,
+                 budget=STREAM_BUDGET_BYTES):
+        self.course       = course
+        self.load_radius  = load_radius
+        self.evict_radius = evict_radius
+        self.budget       = budget
+        self.resident     = OrderedDict()   # (ci, cj) -> (chunk, nbytes), main thread only
+        self.bytes        = 0
+        self.loads        = 0
+        self.evictions    = 0
+        self.lock    = threading.Lock()
+        self.wake    = threading.Condition(self.lock)
+        self.queue   = []     # chunks for the worker, nearest first (replaced every update)
+        self.current = None   # chunk the worker is loading right now
+        self.done    = []     # [((ci, cj), chunk)] waiting for update()
+        self.error   = None
+        self.closed  = False
+        self.thread  = threading.Thread(target=self._run, name="chunk-streamer", daemon=True)
+        self.thread.start()
+
+    def distance(self, key, x, z):
+        """Distance from (x, z) to the nearest point of chunk key's square."""
+        size = self.course.chunk_size
+        dx = max(abs((key[0] + 0.5) * size - x) - size / 2, 0.0)
+        dz = max(abs((key[1] + 0.5) * size - z) - size / 2, 0.0)
+        return math.hypot(dx, dz)
+
+    def wanted(self, x, z):
+        """Chunks within the load radius of (x, z), nearest first."""
+        size, half = self.course.chunk_size, self.course.grid // 2
+        reach = int(self.load_radius // size) + 1
+        ci, cj = math.floor(x / size), math.floor(z / size)
+        near = {}
+        for i in range(max(ci - reach, -half), min(ci + reach, half - 1) + 1):
+            for j in range(max(cj - reach, -half), min(cj + reach, half - 1) + 1):
+                d = self.distance((i, j), x, z)
+                if d <= self.load_radius:
+                    near[(i, j)] = d
+        return sorted(near, key=near.get)
+
+    def _adopt(self, key, chunk):
+        size = chunk.nbytes()
+        self.resident[key] = (chunk, size)
+        self.bytes += size
+        self.loads += 1
+
+    def _evict(self, key):
+        self.bytes -= self.resident.pop(key)[1]
+        self.evictions += 1
+
+    def prime(self, x, z):
+        """Load the chunks around (x, z) on the calling thread, e.g. at spawn."""
+        for key in self.wanted(x, z):
+            if self.resident and self.bytes >= self.budget:
+                break
+            self._adopt(key, self.course.load_chunk(*key))
+
+    def update(self, x, z):
+        """Page chunks in and out around (x, z); returns True when the resident set changed."""
+        with self.lock:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            done, self.done = self.done, []
+        changed = False
+        for key, chunk in done:
+            if key not in self.resident and self.distance(key, x, z) <= self.evict_radius:
+                self._adopt(key, chunk)
+                changed = True
+        # Farthest first, always keeping at least one chunk
+        for key in sorted(self.resident, key=lambda k: -self.distance(k, x, z)):
+            if len(self.resident) == 1:
+                break
+            if self.bytes > self.budget or self.distance(key, x, z) > self.evict_radius:
+                self._evict(key)
+                changed = True
+        # Ask only for what fits the budget, sized by the average resident chunk
+        per_chunk = self.bytes / len(self.resident) if self.resident else 0
+        room = self.budget - self.bytes
+        queue = []
+        for key in self.wanted(x, z):
+            if key in self.resident:
+                continue
+            if per_chunk * (len(queue) + 1) > room:
+                break
+            queue.append(key)
+        with self.lock:
+            loaded = {k for k, _ in self.done}
+            self.queue = [k for k in queue if k != self.current and k not in loaded]
+            if self.queue:
+                self.wake.notify()
+        return changed
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.queue) + (self.current is not None)
+        return len(self.resident), self.bytes, self.budget, pending, self.loads, self.evictions
+
+    def close(self):
+        """Stop the worker and drop the resident chunks."""
+        with self.lock:
+            self.closed = True
+            self.queue = []
+            self.done = []
+            self.wake.notify()
+        self.thread.join()
+        self.resident.clear()
+        self.bytes = 0
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.wake.wait()
+                if self.closed:
+                    return
+                key = self.current = self.queue.pop(0)
+            try:
+                chunk = self.course.load_chunk(*key)
+            except Exception as e:
+                with self.lock:
+                    self.error = e
+                    self.current = None
+                continue
+            with self.lock:
+                self.done.append((key, chunk))
+                self.current = None
+
+# -------------------------------------------------
+# MESH STORAGE
+# -------------------------------------------------
+class MeshBuilder:
+    """Growable mesh in flat typed arrays.
+
+    Positions are a float32 xyz buffer, faces an offset/length table into a
+    shared index buffer, and colours a per-face index into a small palette.
+    """
+    def __init__(self):
+        self.positions  = array("f")   # x, y, z, x, y, z, ...
+        self.face_start = array("I")   # first slot of each face in face_index
+        self.face_len   = array("B")
+        self.face_index = array("I")
+        self.face_color = array("H")   # index into palette
+        self.face_object = array("I")  # primitive (add_box, add_roof, ...) a face came from
+        self.object_count = 0
+        self.palette    = []
+        self._palette_ids = {}
+
+    def vertex_count(self):
+        return len(self.positions) // 3
+
+    def face_count(self):
+        return len(self.face_len)
+
+    def begin_object(self):
+        """Start a new primitive; following faces are tagged with its id."""
+        self.object_count += 1
+        return self.object_count - 1
+
+    def add_vertex(self, x, y, z):
+        self.positions.extend((x, y, z))
+
+    def add_vertices(self, verts):
+        for v in verts:
+            self.positions.extend(v)
+
+    def add_face(self, indices, color, obj=None):
+        color = tuple(color)
+        cid = self._palette_ids.get(color)
+        if cid is None:
+            cid = self._palette_ids[color] = len(self.palette)
+            self.palette.append(color)
+        self.face_start.append(len(self.face_index))
+        self.face_len.append(len(indices))
+        self.face_index.extend(indices)
+        self.face_color.append(cid)
+        if obj is None:
+            obj = max(self.object_count - 1, 0)
+        self.face_object.append(obj)
+        self.object_count = max(self.object_count, obj + 1)
+
+    def vertex(self, i):
+        p = self.positions
+        return (p[3*i], p[3*i + 1], p[3*i + 2])
+
+    def face(self, f):
+        start = self.face_start[f]
+        return self.face_index[start:start + self.face_len[f]].tolist(), self.palette[self.face_color[f]]
+
+    def nbytes(self):
+        arrays = (self.positions, self.face_start, self.face_len, self.face_index,
+                  self.face_color, self.face_object)
+        return sum(a.itemsize * len(a) for a in arrays) + len(self.palette) * 3
+
+    def to_course_mesh(self):
+        """Pack into the padded CourseMesh layout used by the renderer and course files."""
+        positions = np.frombuffer(self.positions, dtype=np.float32).reshape(-1, 3).copy()
+        start = np.frombuffer(self.face_start, dtype=np.uint32).astype(np.int64)
+        size  = np.frombuffer(self.face_len, dtype=np.uint8).copy()
+        index = np.frombuffer(self.face_index, dtype=np.uint32).astype(np.int32)
+        k = int(size.max()) if len(size) else 3
+        slot = start[:, None] + np.arange(k)[None, :]
+        pad = np.arange(k)[None, :] >= size[:, None]
+        face_verts = np.where(pad, -1, index[np.where(pad, 0, slot)] if len(index) else -1).astype(np.int32)
+        face_color = np.frombuffer(self.face_color, dtype=np.uint16).copy()
+        palette = np.array(self.palette, dtype=np.uint8).reshape(-1, 3)
+        face_object = np.frombuffer(self.face_object, dtype=np.uint32).astype(np.int32)
+        return CourseMesh(positions, face_verts, size, face_color, palette, face_object)
+
+class VertexView:
+    """Read-only list-of-tuples view over a MeshBuilder or CourseMesh."""
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def __len__(self):
+        return self.mesh.vertex_count()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.mesh.vertex(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.mesh.vertex(i)
+
+class FaceView:
+    """Read-only list of (indices, color) pairs over a MeshBuilder or CourseMesh."""
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def __len__(self):
+        return self.mesh.face_count()
+
+    def __getitem__(self, f):
+        if f < 0:
+            f += len(self)
+        return self.mesh.face(f)
+
+    def __iter__(self):
+        for f in range(len(self)):
+            yield self.mesh.face(f)
 
 # -------------------------------------------------
 # WORLD BUILDER (base class)
 # -------------------------------------------------
 class WorldBase:
     def __init__(self):
-        self.verts     = []
-        self.faces     = []
+        self.builder    = MeshBuilder()
         self.platforms  = []   # (x, y, z, w, h, d) for collision
-        self.stars      = []
-        self.coins      = []
+        self.solids     = []   # (minx, miny, minz, maxx, maxy, maxz) of every box
+        self.stars      = EntityStore(Star)
+        self.coins      = EntityStore(Coin)
+        self.enemies    = EnemyStore()
+        self.movers     = MoverStore()
+        self.collision  = None   # CollisionBVH over platforms and movers
+        self.scene      = SceneGraph()
+        self.terrains   = []
+        self.waters     = []
+        self.streamer   = None   # ChunkStreamer, for courses paged in around Mario
         self.spawn      = (0, -400)
         self.sky_color  = SKY_BLUE
         self.name       = "Unknown"
         self.star_count = 0
+        self.mesh       = None   # CourseMesh, filled in by compile/load
+        self.pvs_cell_size = None   # set by enclosed courses to bake a PVS
+        self.pvs        = None
+        self.rooms      = []     # (name, minx, miny, minz, maxx, maxy, maxz)
+        self.portals    = []     # (room_a, room_b, 4 corner points)
+        self.room_graph = None
+        self.bsp        = None   # BSPTree over the static mesh
+        self.far_plane  = FAR_PLANE
+        self.fog_start  = FOG_START
+        self.fog        = None
+        self.activity   = ActivityManager()
+        # Directional lights baked into face colours at compile time:
+        # (direction towards the light, intensity), plus a flat ambient term.
+        self.lights     = [((0.4, 0.8, -0.45), 0.45), ((-0.6, 0.3, 0.5), 0.15)]
+        self.ambient    = 0.55
+
+    @property
+    def verts(self):
+        return VertexView(self.mesh if self.mesh is not None else self.builder)
+
+    @property
+    def faces(self):
+        return FaceView(self.mesh if self.mesh is not None else self.builder)
 
     def add_box(self, x, y, z, w, h, d, color, collide=False):
-        idx = len(self.verts)
+        self.builder.begin_object()
+        idx = self.builder.vertex_count()
         hw, hh, hd = w/2, h/2, d/2
-        self.verts += [
+        self.builder.add_vertices([
             (x-hw, y-hh, z-hd), (x+hw, y-hh, z-hd),
             (x+hw, y+hh, z-hd), (x-hw, y+hh, z-hd),
             (x-hw, y-hh, z+hd), (x+hw, y-hh, z+hd),
             (x+hw, y+hh, z+hd), (x-hw, y+hh, z+hd),
-        ]
-        for f in [[0,1,2,3],[4,5,6,7],[0,4,7,3],[1,5,6,2],[3,2,6,7],[0,1,5,4]]:
-            self.faces.append(([i + idx for i in f], color))
+        ])
+        # Wound counter-clockwise seen from outside, so face_normal() points out
+        for f in [[0,3,2,1],[4,5,6,7],[0,4,7,3],[1,2,6,5],[3,7,6,2],[0,1,5,4]]:
+            self.builder.add_face([i + idx for i in f], color)
+        self.solids.append((x-hw, y-hh, z-hd, x+hw, y+hh, z+hd))
         if collide:
             self.platforms.append((x, y, z, w, h, d))
 
     def add_roof(self, x, y, z, w, h, d, color):
-        idx = len(self.verts)
+        self.builder.begin_object()
+        idx = self.builder.vertex_count()
         hw, hd = w/2, d/2
-        self.verts.extend([
+        self.builder.add_vertices([
             (x-hw, y, z-hd), (x+hw, y, z-hd),
             (x+hw, y, z+hd), (x-hw, y, z+hd),
             (x, y + h, z),
         ])
-        for f in [[0,1,4],[1,2,4],[2,3,4],[3,0,4]]:
-            self.faces.append(([i + idx for i in f], color))
-        self.faces.append(([idx, idx+1, idx+2, idx+3], color))
+        for f in [[0,4,1],[1,4,2],[2,4,3],[3,4,0]]:
+            self.builder.add_face([i + idx for i in f], color)
+        self.builder.add_face([idx, idx+1, idx+2, idx+3], color)
 
     def add_slope(self, x, y, z, w, h, d, color):
         """Wedge/ramp shape"""
-        idx = len(self.verts)
+        self.builder.begin_object()
+        idx = self.builder.vertex_count()
         hw, hd = w/2, d/2
-        self.verts.extend([
+        self.builder.add_vertices([
             (x-hw, y,   z-hd), (x+hw, y,   z-hd),
             (x+hw, y,   z+hd), (x-hw, y,   z+hd),
             (x-hw, y+h, z+hd), (x+hw, y+h, z+hd),
         ])
-        for f in [[0,1,2,3],[2,5,4,3],[0,1,5,4],[0,3,4],[1,2,5]]:
-            self.faces.append(([i + idx for i in f], color))
+        for f in [[0,1,2,3],[2,5,4,3],[0,4,5,1],[0,3,4],[1,5,2]]:
+            self.builder.add_face([i + idx for i in f], color)
 
     def add_cylinder_approx(self, x, y, z, r, h, segments, color):
         """Approximate cylinder with polygon faces"""
-        idx = len(self.verts)
-        bottom_ring = []
-        top_ring = []
+        self.builder.begin_object()
+        idx = self.builder.vertex_count()
+        # Vertices alternate bottom, top around the ring
         for i in range(segments):
             a = (2 * math.pi * i) / segments
             px = x + r * math.cos(a)
             pz = z + r * math.sin(a)
-            self.verts.append((px, y, pz))
-            bottom_ring.append(idx + i)
-            self.verts.append((px, y + h, pz))
-            top_ring.append(idx + i * 2 + 1)
-            idx_base = len(self.verts) - 2
+            self.builder.add_vertex(px, y, pz)
+            self.builder.add_vertex(px, y + h, pz)
         # side faces
         for i in range(segments):
             j = (i + 1) % segments
@@ -417,24 +1650,76 @@ class WorldBase:
             b1 = idx + j * 2
             t0 = b0 + 1
             t1 = b1 + 1
-            self.faces.append(([b0, b1, t1, t0], color))
+            self.builder.add_face([b0, t0, t1, b1], color)
+
+    def add_room(self, name, x, y, z, w, h, d):
+        """Declare a room volume for portal visibility (centre + size, like add_box)."""
+        self.rooms.append((name, x - w/2, y - h/2, z - d/2, x + w/2, y + h/2, z + d/2))
+
+    def add_portal(self, room_a, room_b, x, y, z, w, h, d):
+        """Declare an opening between two rooms; one of w/h/d must be 0."""
+        hw, hh, hd = w/2, h/2, d/2
+        if w == 0:
+            corners = [(x, y-hh, z-hd), (x, y-hh, z+hd), (x, y+hh, z+hd), (x, y+hh, z-hd)]
+        elif d == 0:
+            corners = [(x-hw, y-hh, z), (x+hw, y-hh, z), (x+hw, y+hh, z), (x-hw, y+hh, z)]
+        else:
+            corners = [(x-hw, y, z-hd), (x+hw, y, z-hd), (x+hw, y, z+hd), (x-hw, y, z+hd)]
+        self.portals.append((room_a, room_b, corners))
 
     def add_star(self, x, y, z):
-        self.stars.append(Star(x, y, z))
+        self.stars.add(x, y, z)
         self.star_count += 1
 
+    def add_mover(self, x, y, z, w, h, d, color, a=(0, 0, 0), b=(0, 0, 0), period=240, phase=0.0):
+        """A moving platform; see MoverStore for how a, b, period and phase shape its path."""
+        mover = self.movers.add(x, y, z, w, h, d, color, a, b, period, phase)
+        verts, faces = box_mesh([(0, 0, 0, w, h, d, color)], self.lights, self.ambient)
+        self.movers.nodes.append(self.scene.add(
+            SceneNode(f"mover:{mover.index}", mover.store.pos[mover.index].tolist(), verts=verts, faces=faces)))
+
+    def add_part(self, name, x, y, z, boxes, parent=None, anim=None, yaw=0.0, pitch=0.0, roll=0.0):
+        """An animated scene-graph part made of (x, y, z, w, h, d, color) boxes in local space."""
+        verts, faces = box_mesh(boxes, self.lights, self.ambient) if boxes else (None, None)
+        return self.scene.add(SceneNode(name, (x, y, z), yaw, pitch, roll, verts=verts, faces=faces, anim=anim),
+                              parent)
+
+    def add_terrain(self, x, z, size, cells, height_fn, bands):
+        """Heightmap ground over a size x size square; height_fn maps (X, Z) grids to heights."""
+        g = np.linspace(-size / 2, size / 2, cells + 1)
+        gx, gz = np.meshgrid(x + g, z + g, indexing="ij")
+        heights = np.maximum(height_fn(gx, gz), 0.0)
+        self.terrains.append(Terrain(x, z, size, heights, bands, self.lights, self.ambient))
+
+    def add_water(self, x, y, z, w, d, color, **waves):
+        """Animated water surface at height y over a w x d rectangle; waves go to WaterSurface."""
+        self.waters.append(WaterSurface(x, y, z, w, d, color, self.lights, self.ambient, **waves))
+
+    def terrain_height(self, x, z):
+        """Ground height at (x, z) from the course's terrains (0 off the terrain)."""
+        heights = [h for h in (t.height_at(x, z) for t in self.terrains) if h is not None]
+        return max(heights, default=0.0)
+
+    def build_collision(self):
+        self.movers.first_item = len(self.platforms)
+        self.collision = CollisionBVH(list(self.platforms) + self.movers.boxes(), self.terrains,
+                                      self.movers.first_item)
+
+    def add_enemy(self, kind, x, y, z, leash=200):
+        self.enemies.add(kind, x, y, z, leash)
+
     def add_coins_line(self, x1, y1, z1, x2, y2, z2, count=5):
         for i in range(count):
             t = i / max(count - 1, 1)
             cx = x1 + (x2 - x1) * t
             cy = y1 + (y2 - y1) * t
             cz = z1 + (z2 - z1) * t
-            self.coins.append(Coin(cx, cy + 30, cz))
+            self.coins.add(cx, cy + 30, cz)
 
     def add_coins_ring(self, cx, y, cz, r, count=8):
         for i in range(count):
             a = (2 * math.pi * i) / count
-            self.coins.append(Coin(cx + r * math.cos(a), y + 30, cz + r * math.sin(a)))
+            self.coins.add(cx + r * math.cos(a), y + 30, cz + r * math.sin(a))
 
     def add_tree(self, x, z, trunk_h=90, canopy_w=110, canopy_h=90):
         self.add_box(x, 30, z, 35, trunk_h, 35, TRUNK_BROWN)
@@ -444,6 +1729,116 @@ class WorldBase:
     def build(self):
         pass
 
+    def stream(self, mario):
+        """Page geometry in and out around Mario; a regular course is always fully resident."""
+        pass
+
+    def close(self):
+        """Release anything the course holds beyond its data, e.g. a streaming thread."""
+        pass
+
+    def reset(self):
+        """Put collectibles back so a cached course can be replayed."""
+        self.stars.reset()
+        self.coins.reset()
+        self.enemies.reset()
+        self.movers.reset()
+        for node, p in zip(self.movers.nodes, self.movers.pos[:self.movers.count].tolist()):
+            node.set(pos=p)
+        self.scene.animate(0)
+        self.build_collision()
+        self.activity = ActivityManager(self.activity.radius)
+
+    def nbytes(self):
+        """Approximate memory held by this course (mesh arrays + Python-side objects)."""
+        total = 0
+        if self.mesh is not None:
+            total += self.mesh.nbytes()
+        else:
+            total += self.builder.nbytes()
+        total += sum(sys.getsizeof(p) for p in self.platforms)
+        total += self.stars.nbytes() + self.coins.nbytes() + self.enemies.nbytes() + self.movers.nbytes()
+        return total
+
+
+class StreamedCourse(WorldBase):
+    """A course too big to hold at once; build_chunk() fills in one square of a chunk grid,
+    compiled to its own course file on first use and paged in around Mario by a ChunkStreamer."""
+    chunk_size = 1000.0
+    grid       = 64   # chunks per side, centred on the origin
+
+    def build_chunk(self, chunk, ci, cj):
+        """Add the geometry of chunk (ci, cj), which covers ci * chunk_size .. (ci + 1) * chunk_size in x."""
+        pass
+
+    def chunk_dir(self):
+        cls = type(self)
+        return os.path.join(COURSE_CACHE_DIR, f"{cls.__name__}-{course_key(cls)}")
+
+    def load_chunk(self, ci, cj):
+        """Memory-map one chunk, compiling it first on a miss; runs on the streamer thread."""
+        path = os.path.join(self.chunk_dir(), f"{ci}_{cj}.course")
+        if os.path.exists(path):
+            try:
+                chunk = read_compiled_course(path, WorldBase)
+                os.utime(path)   # recency for _prune_chunk_files
+                return chunk
+            except (OSError, ValueError, KeyError):
+                pass
+        chunk = WorldBase()
+        chunk.lights, chunk.ambient = self.lights, self.ambient
+        self.build_chunk(chunk, ci, cj)
+        optimize_world(chunk)
+        bake_lighting(chunk.builder, chunk.lights, chunk.ambient)
+        chunk.mesh = chunk.builder.to_course_mesh()
+        try:
+            write_compiled_course(path, chunk)
+            self._prune_chunk_files()
+            return read_compiled_course(path, WorldBase)
+        except OSError:
+            return chunk
+
+    def _prune_chunk_files(self):
+        """Delete the least recently used chunk files beyond STREAM_DISK_CHUNKS."""
+        directory = self.chunk_dir()
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".course")]
+        if len(paths) <= STREAM_DISK_CHUNKS:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - STREAM_DISK_CHUNKS]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass   # still mapped on platforms that forbid it
+
+    def open_stream(self):
+        """Start the streamer and page in the chunks around spawn before play begins."""
+        if os.path.isdir(COURSE_CACHE_DIR):
+            current = os.path.basename(self.chunk_dir())
+            for old in os.listdir(COURSE_CACHE_DIR):
+                if old.startswith(type(self).__name__ + "-") and old != current:
+                    shutil.rmtree(os.path.join(COURSE_CACHE_DIR, old), ignore_errors=True)
+        self.streamer = ChunkStreamer(self)
+        self.streamer.prime(*self.spawn)
+        self._merge_chunks()
+
+    def stream(self, mario):
+        if self.streamer.update(mario.x, mario.z):
+            self._merge_chunks()
+
+    def close(self):
+        if self.streamer is not None:
+            self.streamer.close()
+            self.streamer = None
+
+    def _merge_chunks(self):
+        chunks = [chunk for chunk, _ in self.streamer.resident.values()]
+        self.mesh = CourseMesh.concat([c.mesh for c in chunks])
+        self.solids = np.concatenate([np.asarray(c.solids, dtype=np.float32).reshape(-1, 6) for c in chunks])
+        self.platforms = [p for c in chunks for p in c.platforms]
+        self.fog = None   # the palette changed
+        self.build_collision()
+
 
 # =================================================
 # COURSE 0: CASTLE GROUNDS (Hub World)
@@ -516,8 +1911,13 @@ class BobOmbBattlefield(WorldBase):
         # Chain Chomp post area
         self.add_box(-500, 15, -300, 40, 80, 40, WOOD_BROWN)
         self.add_box(-500, 5, -300, 120, 12, 120, DARK_GREEN)
-        # Chain Chomp (sphere approximation)
-        self.add_box(-500, 80, -300, 80, 80, 80, CHAIN_GRAY)
+        # Chain Chomp, tethered to the post
+        self.add_enemy("chomp", -500, 0, -300, leash=180)
+        # Goombas
+        self.add_enemy("goomba", 300, 0, -400, leash=200)
+        self.add_enemy("goomba", -300, 0, 100, leash=150)
+        self.add_enemy("goomba", 500, 0, 200, leash=250)
+        self.add_enemy("goomba", -600, 0, 500, leash=200)
         # Cannon areas
         self.add_box(600, 0, -500, 60, 40, 60, CANNON_BLACK)
         self.add_box(-600, 0, 600, 60, 40, 60, CANNON_BLACK)
@@ -583,6 +1983,10 @@ class WhompsFortress(WorldBase):
         self.add_box(-200, 250, 200, 180, 8, 40, WOOD_BROWN, collide=True)
         # Bullet Bill launcher
         self.add_box(350, 140, 350, 40, 60, 40, CANNON_BLACK)
+        # Whomp guarding the approach, goombas on the base
+        self.add_enemy("whomp", 0, 0, -250, leash=150)
+        self.add_enemy("goomba", -300, 0, -150, leash=100)
+        self.add_enemy("goomba", 300, 0, -150, leash=100)
         # Stars
         self.add_star(0, 460, 300)         # Top of fortress
         self.add_star(0, 580, 350)         # Tower top
@@ -607,8 +2011,9 @@ class JollyRogerBay(WorldBase):
     def build(self):
         # Beach
         self.add_box(0, 0, -400, 1200, 10, 500, SAND_YELLOW)
-        # Water surface
+        # Water: an opaque body hiding the sea bed, with the animated surface on top
         self.add_box(0, -10, 300, 1800, 8, 1400, WATER_BLUE)
+        self.add_water(0, -5, 300, 1800, 1400, WATER_BLUE)
         # Deep water floor
         self.add_box(0, -200, 300, 1800, 10, 1400, DEEP_WATER)
         # Sunken ship
@@ -652,16 +2057,13 @@ class CoolCoolMountain(WorldBase):
         self.build()
 
     def build(self):
-        # Base snowy ground
-        self.add_box(0, 0, 0, 2000, 10, 2000, SNOW_WHITE)
-        # Mountain core - ascending tiers
-        self.add_box(0, 80, 300, 900, 160, 900, SNOW_WHITE, collide=True)
-        self.add_box(0, 220, 350, 600, 120, 600, ICE_BLUE, collide=True)
-        self.add_box(0, 360, 400, 350, 100, 350, SNOW_WHITE, collide=True)
-        self.add_box(0, 470, 400, 180, 80, 180, SNOW_WHITE, collide=True)
-        self.add_roof(0, 540, 400, 220, 140, 220, SNOW_WHITE)
+        # Snowy ground rising into the mountain
+        def mountain(x, z):
+            r = np.hypot(x, z - 400)
+            return 520 * np.clip(1 - r / 560, 0, 1) ** 1.3 + 12 * np.sin(x / 90) * np.cos(z / 110) * (r < 560)
+        self.add_terrain(0, 0, 2000, 8, mountain, [(200, SNOW_WHITE), (320, ICE_BLUE), (1e9, SNOW_WHITE)])
         # Slide entrance (chimney at top)
-        self.add_box(60, 540, 400, 50, 80, 50, BRICK_RED)
+        self.add_box(60, self.terrain_height(60, 400) + 30, 400, 50, 80, 50, BRICK_RED)
         # Cabin at bottom
         self.add_box(-500, 30, -500, 150, 100, 120, WOOD_BROWN)
         self.add_roof(-500, 100, -500, 180, 70, 150, SNOW_WHITE)
@@ -681,12 +2083,12 @@ class CoolCoolMountain(WorldBase):
             self.add_roof(pos[0], 80, pos[1], 80, 100, 80, DARK_GREEN)
             self.add_roof(pos[0], 140, pos[1], 60, 70, 60, DARK_GREEN)
         # Stars
-        self.add_star(0, 560, 400)         # Mountain peak
+        self.add_star(0, self.terrain_height(0, 400) + 30, 400)   # Mountain peak
         self.add_star(-500, 100, -500)     # Cabin
         self.add_star(400, 140, -300)      # Snowman
         # Coins
         self.add_coins_line(-400, 0, -200, 400, 0, -200, 8)
-        self.add_coins_ring(0, 350, 400, 100, 8)
+        self.add_coins_ring(0, self.terrain_height(100, 400), 400, 100, 8)
 
 
 # =================================================
@@ -698,6 +2100,9 @@ class BigBoosHaunt(WorldBase):
         self.name = "Big Boo's Haunt"
         self.sky_color = SKY_MANSION
         self.spawn = (0, -500)
+        self.far_plane = 1800
+        self.fog_start = 0.4
+        self.pvs_cell_size = 200
         self.build()
 
     def build(self):
@@ -737,6 +2142,11 @@ class BigBoosHaunt(WorldBase):
             self.add_box(i * 120, 15, -600, 8, 40, 8, FENCE_BROWN)
         # Balcony
         self.add_box(0, 280, 100, 200, 10, 60, STONE_GRAY, collide=True)
+        # Boos over the graveyards and around the mansion
+        self.add_enemy("boo", -600, 40, -250, leash=200)
+        self.add_enemy("boo", 600, 40, -250, leash=200)
+        self.add_enemy("boo", 0, 60, 300, leash=150)
+        self.add_enemy("boo", 0, 40, -400, leash=300)
         # Stars
         self.add_star(0, 400, 300)         # Mansion attic
         self.add_star(-350, 220, 300)      # Left wing
@@ -755,6 +2165,11 @@ class HazyMazeCave(WorldBase):
         self.name = "Hazy Maze Cave"
         self.sky_color = SKY_CAVE
         self.spawn = (0, -400)
+        self.far_plane = 1600
+        self.fog_start = 0.35
+        self.lights = [((0.0, 1.0, 0.2), 0.4)]
+        self.ambient = 0.5
+        self.pvs_cell_size = 200
         self.build()
 
     def build(self):
@@ -788,6 +2203,15 @@ class HazyMazeCave(WorldBase):
         # Rolling rocks area
         self.add_box(800, 20, -400, 60, 50, 60, DARK_GRAY)
         self.add_box(850, 20, -500, 50, 40, 50, DARK_GRAY)
+        # Rooms: three caverns split by the x = +-600 maze walls. Each wall
+        # leaves openings above it and past both of its ends.
+        self.add_room("west cavern", -900, 200, 0, 600, 400, 2400)
+        self.add_room("central cavern", 0, 200, 0, 1200, 400, 2400)
+        self.add_room("east cavern", 900, 200, 0, 600, 400, 2400)
+        for wx, room in [(-600, "west cavern"), (600, "east cavern")]:
+            self.add_portal(room, "central cavern", wx, 250, 0, 0, 300, 800)
+            self.add_portal(room, "central cavern", wx, 200, -800, 0, 400, 800)
+            self.add_portal(room, "central cavern", wx, 200, 800, 0, 400, 800)
         # Stars
         self.add_star(-700, 40, 600)       # Underground lake
         self.add_star(700, 50, 700)        # Metal cap
@@ -806,6 +2230,7 @@ class LethalLavaLand(WorldBase):
         self.name = "Lethal Lava Land"
         self.sky_color = SKY_LAVA
         self.spawn = (0, -600)
+        self.lights = [((0.3, 0.7, -0.4), 0.35), ((0.0, -1.0, 0.0), 0.3)]   # glow from the lava sea
         self.build()
 
     def build(self):
@@ -906,6 +2331,7 @@ class DireDireDocks(WorldBase):
         self.add_box(0, 0, -400, 600, 10, 300, STONE_GRAY)
         # Water
         self.add_box(0, -15, 300, 2000, 8, 1500, DOCK_BLUE)
+        self.add_water(0, -10, 300, 2000, 1500, DOCK_BLUE, amplitude=8.0, period=240)
         # Deep floor
         self.add_box(0, -300, 300, 2000, 10, 1500, DEEP_WATER)
         # Dock walkways
@@ -951,8 +2377,11 @@ class SnowmansLand(WorldBase):
         self.build()
 
     def build(self):
-        # Snow ground
-        self.add_box(0, 0, 0, 2400, 10, 2400, SNOW_WHITE)
+        # Snow field, flat in the middle and drifting up towards the edges
+        def drifts(x, z):
+            r = np.hypot(x, z)
+            return 260 * np.clip((r - 850) / 450, 0, 1) ** 2 * (1 + 0.25 * np.sin(x / 80) * np.sin(z / 95))
+        self.add_terrain(0, 0, 2400, 4, drifts, [(1e9, SNOW_WHITE)])
         # Giant Snowman (3 sphere tiers)
         self.add_box(0, 60, 500, 300, 120, 300, SNOW_WHITE, collide=True)
         self.add_box(0, 170, 500, 220, 100, 220, SNOW_WHITE, collide=True)
@@ -979,8 +2408,9 @@ class SnowmansLand(WorldBase):
         self.add_box(600, 30, 500, 200, 15, 200, ICE_BLUE, collide=True)
         # Snow trees
         for tx, tz in [(-800,-600),(-700,700),(800,-500),(700,600),(-400,-700),(400,-600)]:
-            self.add_box(tx, 25, tz, 22, 70, 22, TRUNK_BROWN)
-            self.add_roof(tx, 70, tz, 70, 90, 70, SNOW_WHITE)
+            gy = self.terrain_height(tx, tz)
+            self.add_box(tx, gy + 25, tz, 22, 70, 22, TRUNK_BROWN)
+            self.add_roof(tx, gy + 70, tz, 70, 90, 70, SNOW_WHITE)
         # Stars
         self.add_star(0, 380, 500)         # Snowman head
         self.add_star(500, 80, -400)       # Igloo
@@ -1006,6 +2436,7 @@ class WetDryWorld(WorldBase):
         self.add_box(0, 0, 0, 1800, 10, 1800, STONE_GRAY)
         # Water at low level
         self.add_box(0, 30, 0, 1800, 5, 1800, WATER_BLUE)
+        self.add_water(0, 33.5, 0, 1800, 1800, WATER_BLUE, amplitude=4.0, wavelength=220.0)
         # City buildings
         self.add_box(-400, 100, 300, 200, 200, 200, STONE_GRAY, collide=True)
         self.add_box(-400, 230, 300, 160, 60, 160, DARK_GRAY, collide=True)
@@ -1049,18 +2480,16 @@ class TallTallMountain(WorldBase):
         self.name = "Tall, Tall Mountain"
         self.sky_color = SKY_BLUE
         self.spawn = (0, -400)
+        self.far_plane = 4500
         self.build()
 
     def build(self):
-        # Valley floor with grass
-        self.add_box(0, 0, 0, 1600, 10, 1600, GRASS_GREEN)
-        # Mountain - 6 ascending tiers
-        self.add_box(0, 50, 300, 700, 100, 700, DARK_GREEN, collide=True)
-        self.add_box(50, 140, 350, 550, 80, 550, GRASS_GREEN, collide=True)
-        self.add_box(0, 220, 400, 400, 80, 400, DARK_GREEN, collide=True)
-        self.add_box(-30, 300, 400, 300, 60, 300, GRASS_GREEN, collide=True)
-        self.add_box(0, 370, 400, 200, 50, 200, DARK_GREEN, collide=True)
-        self.add_box(0, 430, 400, 120, 40, 120, GRASS_GREEN, collide=True)
+        # Grassy valley floor rising into the mountain
+        def mountain(x, z):
+            r = np.hypot(x - 20 * np.sin(z / 150), z - 400)
+            return 450 * np.clip(1 - r / 420, 0, 1) ** 1.1
+        self.add_terrain(0, 0, 1600, 16, mountain,
+                         [(40, GRASS_GREEN), (250, DARK_GREEN), (380, GRASS_GREEN), (1e9, STONE_GRAY)])
         # Cliff face
         self.add_box(0, 150, 700, 700, 300, 30, CAVE_BROWN)
         # Waterfall
@@ -1071,11 +2500,11 @@ class TallTallMountain(WorldBase):
         self.add_box(-100, 130, -100, 30, 120, 30, STONE_GRAY)
         self.add_box(-100, 170, -100, 80, 10, 80, MARIO_RED, collide=True)
         # Slide entrance at peak
-        self.add_box(40, 460, 400, 50, 60, 50, DARK_BROWN)
+        self.add_box(40, self.terrain_height(40, 400) + 20, 400, 50, 60, 50, DARK_BROWN)
         # Monkey bridge
         self.add_box(200, 180, 200, 250, 8, 40, WOOD_BROWN, collide=True)
         # Log bridge
-        self.add_box(-200, 100, 200, 180, 12, 30, WOOD_BROWN, collide=True)
+        self.add_box(-200, self.terrain_height(-200, 200) + 30, 200, 180, 12, 30, WOOD_BROWN, collide=True)
         # Cloud platforms (white boxes high up)
         self.add_box(-400, 350, 0, 100, 15, 100, WHITE, collide=True)
         self.add_box(-200, 400, 100, 100, 15, 100, WHITE, collide=True)
@@ -1085,12 +2514,12 @@ class TallTallMountain(WorldBase):
         self.add_tree(-500, -300)
         self.add_tree(500, -200)
         # Stars
-        self.add_star(0, 480, 400)         # Peak
+        self.add_star(0, self.terrain_height(0, 400) + 30, 400)   # Peak
         self.add_star(-200, 420, 100)      # Cloud
         self.add_star(-300, 130, -200)     # Mushroom
         # Coins
         self.add_coins_line(-400, 0, -400, 400, 0, -400, 8)
-        self.add_coins_ring(0, 300, 400, 100, 8)
+        self.add_coins_ring(0, self.terrain_height(100, 400), 400, 100, 8)
 
 
 # =================================================
@@ -1159,6 +2588,7 @@ class TickTockClock(WorldBase):
         self.name = "Tick Tock Clock"
         self.sky_color = SKY_CAVE
         self.spawn = (0, -200)
+        self.pvs_cell_size = 200
         self.build()
 
     def build(self):
@@ -1169,34 +2599,41 @@ class TickTockClock(WorldBase):
         self.add_box(300, 400, 0, 20, 800, 600, CLOCK_BEIGE)
         self.add_box(0, 400, -300, 600, 800, 20, CLOCK_BEIGE)
         self.add_box(0, 400, 300, 600, 800, 20, CLOCK_BEIGE)
-        # Ascending platforms (clock hands/gears)
+        # Ascending platforms
         platforms = [
             (0, 40, 0, 200, 12, 200, METAL_GRAY),
-            (-100, 100, 50, 150, 10, 60, METAL_GRAY),
-            (100, 170, -50, 150, 10, 60, METAL_GRAY),
-            (0, 240, 100, 120, 10, 120, METAL_GRAY),
             (-80, 310, -80, 100, 10, 100, METAL_GRAY),
             (80, 380, 80, 100, 10, 100, METAL_GRAY),
-            (0, 450, 0, 150, 10, 80, METAL_GRAY),
             (-100, 520, 100, 100, 10, 100, METAL_GRAY),
-            (100, 590, -100, 100, 10, 100, METAL_GRAY),
             (0, 660, 0, 180, 10, 180, METAL_GRAY),
             (0, 740, 0, 250, 10, 250, METAL_GRAY),
         ]
         for px, py, pz, pw, ph, pd, c in platforms:
             self.add_box(px, py, pz, pw, ph, pd, c, collide=True)
-        # Gear decorations
-        for gy in [150, 350, 550]:
-            self.add_box(-280, gy, 0, 15, 80, 80, GOLD)
-            self.add_box(280, gy, 0, 15, 80, 80, GOLD)
-        # Pendulum (static representation)
-        self.add_box(0, 300, -280, 10, 200, 10, METAL_GRAY)
-        self.add_box(0, 200, -280, 40, 40, 10, GOLD)
+        # Moving platforms: sliders, a lift and a turning hand
+        self.add_mover(-100, 100, 50, 150, 10, 60, METAL_GRAY, a=(60, 0, 0), period=300)
+        self.add_mover(100, 170, -50, 150, 10, 60, METAL_GRAY, a=(0, 0, 50), period=260)
+        self.add_mover(0, 240, 100, 120, 10, 120, METAL_GRAY, a=(0, 30, 0), period=200)
+        self.add_mover(0, 450, 0, 150, 10, 80, METAL_GRAY, a=(60, 0, 0), b=(0, 0, 60), period=480)
+        self.add_mover(100, 590, -100, 100, 10, 100, METAL_GRAY, a=(-50, 0, 0), period=320)
+        # Gears on the side walls, neighbours turning opposite ways
+        gear = [(0, 0, 0, 15, 80, 24, GOLD), (0, 0, 0, 15, 24, 80, GOLD)]
+        for k, gy in enumerate([150, 350, 550]):
+            spin = 0.02 if k % 2 else -0.02
+            self.add_part(f"gear west {k}", -280, gy, 0, gear, anim=("pitch", spin, 0, 1))
+            self.add_part(f"gear east {k}", 280, gy, 0, gear, anim=("pitch", -spin, 0, 1))
+        # Pendulum swinging from its pivot
+        self.add_part("pendulum", 0, 400, -280,
+                      [(0, -100, 0, 10, 200, 10, METAL_GRAY), (0, -200, 0, 40, 40, 10, GOLD)],
+                      anim=("roll", 0, 0.35, 150))
         # Clock face at top
         self.add_box(0, 780, 0, 280, 10, 280, WHITE)
-        # Clock hands
-        self.add_box(0, 790, 0, 120, 4, 12, BLACK)
-        self.add_box(0, 790, 0, 8, 4, 80, BLACK)
+        # Clock hands turning about the centre of the face
+        clock = self.add_part("clock", 0, 790, 0, [])
+        self.add_part("minute hand", 0, 0, 0, [(0, 0, 35, 8, 4, 70, BLACK)], parent=clock,
+                      anim=("yaw", 2 * math.pi / 1800, 0, 1))
+        self.add_part("hour hand", 0, 0, 0, [(0, 0, 22, 12, 4, 45, BLACK)], parent=clock,
+                      anim=("yaw", 2 * math.pi / 7200, 0, 1))
         # Numbers (small blocks around clock face)
         for i in range(12):
             a = (2 * math.pi * i) / 12
@@ -1222,6 +2659,7 @@ class RainbowRide(WorldBase):
         self.name = "Rainbow Ride"
         self.sky_color = SKY_RAINBOW
         self.spawn = (0, -300)
+        self.far_plane = 4500
         self.build()
 
     def build(self):
@@ -1270,10 +2708,66 @@ class RainbowRide(WorldBase):
             z_off = i * 100
             x_off = math.sin(i * 0.5) * 150
             y_off = i * 15 + 30
-            self.coins.append(Coin(x_off, y_off, z_off))
+            self.coins.add(x_off, y_off, z_off)
         self.add_coins_ring(-300, 250, 800, 80, 8)
 
 
+# =================================================
+# BONUS: ENDLESS ISLES (streamed)
+# =================================================
+class EndlessIsles(StreamedCourse):
+    """An archipelago 512 chunks on a side (about 512,000 units across).
+
+    Compiled whole it would run past a gigabyte, so it only ever exists as the
+    few dozen chunks around Mario, generated and compiled the first time
+    each one is visited.
+    """
+    grid = 512
+
+    def __init__(self):
+        super().__init__()
+        self.name = "Endless Isles"
+        self.sky_color = SKY_BLUE
+        self.spawn = (500, 150)
+        self.far_plane = STREAM_LOAD_RADIUS
+        self.fog_start = 0.5
+        self.add_star(500, 190, 550)   # over the home island
+
+    def build_chunk(self, chunk, ci, cj):
+        size = self.chunk_size
+        x0, z0 = ci * size, cj * size
+        rng = random.Random(ci * 100003 + cj)
+        # Shallow sea: one quad, wound to face up
+        chunk.builder.begin_object()
+        idx = chunk.builder.vertex_count()
+        chunk.builder.add_vertices([(x0, 0, z0), (x0 + size, 0, z0),
+                                    (x0 + size, 0, z0 + size), (x0, 0, z0 + size)])
+        chunk.builder.add_face([idx, idx + 3, idx + 2, idx + 1], WATER_BLUE)
+        home = (ci, cj) == (0, 0)
+        if not home and rng.random() > 0.6:
+            return
+        # Island: sand rim and a grass plateau, with trees on top
+        if home:
+            ix, iz, w, d, h = x0 + 500, z0 + 550, 500, 500, 100
+        else:
+            w, d = rng.uniform(250, 600), rng.uniform(250, 600)
+            ix = x0 + rng.uniform(w / 2 + 60, size - w / 2 - 60)
+            iz = z0 + rng.uniform(d / 2 + 60, size - d / 2 - 60)
+            h = rng.choice((40, 70, 100, 140))
+        chunk.add_box(ix, 10, iz, w + 80, 20, d + 80, SAND_YELLOW, collide=True)
+        chunk.add_box(ix, h / 2, iz, w, h, d, GRASS_GREEN, collide=True)
+        for _ in range(rng.randint(0, 3)):
+            tx = ix + rng.uniform(-w / 2 + 40, w / 2 - 40)
+            tz = iz + rng.uniform(-d / 2 + 40, d / 2 - 40)
+            chunk.add_box(tx, h + 45, tz, 30, 90, 30, TRUNK_BROWN)
+            chunk.add_roof(tx, h + 80, tz, 100, 90, 100, TREE_GREEN)
+        # Now and then a rock and a floating stepping stone
+        if rng.random() < 0.4:
+            chunk.add_box(ix + w / 2 + 90, 30, iz, 70, 60, 70, VOLCANO_GRAY, collide=True)
+        if rng.random() < 0.3:
+            chunk.add_box(ix, h + 120, iz - d / 2 - 60, 110, 16, 110, STONE_GRAY, collide=True)
+
+
 # =================================================
 # ALL COURSES REGISTRY
 # =================================================
@@ -1294,115 +2788,2146 @@ COURSE_LIST = [
     ("Tiny-Huge Island",     TinyHugeIsland,      "Course 13",      GRASS_GREEN),
     ("Tick Tock Clock",      TickTockClock,       "Course 14",      CLOCK_BEIGE),
     ("Rainbow Ride",         RainbowRide,         "Course 15",      RAINBOW_PINK),
+    ("Endless Isles",        EndlessIsles,        "Bonus",          SAND_YELLOW),
 ]
 
 # -------------------------------------------------
-# RENDER ENGINE
+# MESH OPTIMIZER (runs after build())
 # -------------------------------------------------
-def render_world(screen, world, mario, cam):
-    screen.fill(world.sky_color)
-    render_list = []
+GROUND_Y   = 0.0    # Mario and the camera never go below this plane
+WELD_EPS   = 1e-3
+COVER_EPS  = 0.5
+
+def face_normal(verts, indices):
+    """Newell normal of a polygon (unit length, outward for CCW winding)."""
+    nx = ny = nz = 0.0
+    n = len(indices)
+    for k in range(n):
+        x0, y0, z0 = verts[indices[k]]
+        x1, y1, z1 = verts[indices[(k + 1) % n]]
+        nx += (y0 - y1) * (z0 + z1)
+        ny += (z0 - z1) * (x0 + x1)
+        nz += (x0 - x1) * (y0 + y1)
+    length = math.sqrt(nx*nx + ny*ny + nz*nz)
+    if length == 0:
+        return (0.0, 0.0, 0.0)
+    return (nx / length, ny / length, nz / length)
+
+def _face_hidden(verts, indices, normal, solids):
+    pts = [verts[i] for i in indices]
+    # Bottom faces resting on or under the ground plane
+    if normal[1] < -0.99 and max(p[1] for p in pts) <= GROUND_Y:
+        return True
+    # Faces whose front side is buried inside another box
+    cx = sum(p[0] for p in pts) / len(pts) + normal[0] * COVER_EPS
+    cy = sum(p[1] for p in pts) / len(pts) + normal[1] * COVER_EPS
+    cz = sum(p[2] for p in pts) / len(pts) + normal[2] * COVER_EPS
+    for x0, y0, z0, x1, y1, z1 in solids:
+        if not (x0 < cx < x1 and y0 < cy < y1 and z0 < cz < z1):
+            continue
+        if all(x0 - WELD_EPS <= px <= x1 + WELD_EPS and
+               y0 - WELD_EPS <= py <= y1 + WELD_EPS and
+               z0 - WELD_EPS <= pz <= z1 + WELD_EPS for px, py, pz in pts):
+            return True
+    return False
 
-    # World geometry
-    for indices, color in world.faces:
-        pts = []
-        z_sum = 0
-        visible = True
-        for i in indices:
-            res = project_point(*world.verts[i], cam.x, cam.y, cam.z, cam.yaw)
-            if not res:
-                visible = False
-                break
-            pts.append((res[0], res[1]))
-            z_sum += res[2]
-        if visible and len(pts) >= 3:
-            render_list.append((z_sum / len(indices), pts, color))
+def _axis_rect(verts, indices, normal):
+    """(axis, sign, plane, u0, u1, v0, v1) for an axis-aligned rectangle, else None."""
+    if len(indices) != 4:
+        return None
+    axis = max(range(3), key=lambda a: abs(normal[a]))
+    if abs(normal[axis]) < 1 - 1e-6:
+        return None
+    u, v = (axis + 1) % 3, (axis + 2) % 3
+    pts = [verts[i] for i in indices]
+    us = sorted(set(round(p[u], 3) for p in pts))
+    vs = sorted(set(round(p[v], 3) for p in pts))
+    if len(us) != 2 or len(vs) != 2:
+        return None
+    return (axis, 1 if normal[axis] > 0 else -1, round(pts[0][axis], 3), us[0], us[1], vs[0], vs[1])
+
+def _merge_rects(rects):
+    """Greedily join rectangles (u0, u1, v0, v1, obj) that share a full edge."""
+    changed = True
+    while changed:
+        changed = False
+        for flip in (False, True):
+            # flip=False joins along u (same v-span), flip=True along v (same u-span)
+            key = (lambda r: (r[0], r[1], r[2])) if flip else (lambda r: (r[2], r[3], r[0]))
+            rects.sort(key=key)
+            out = []
+            for r in rects:
+                if out:
+                    p = out[-1]
+                    if not flip and p[2:4] == r[2:4] and p[1] == r[0]:
+                        out[-1] = (p[0], r[1], p[2], p[3], min(p[4], r[4]))
+                        changed = True
+                        continue
+                    if flip and p[:2] == r[:2] and p[3] == r[2]:
+                        out[-1] = (p[0], p[1], p[2], r[3], min(p[4], r[4]))
+                        changed = True
+                        continue
+                out.append(r)
+            rects = out
+    return rects
+
+def optimize_world(world):
+    """Weld vertices, drop hidden faces and merge coplanar quads in place.
+
+    Returns (faces_before, faces_after, verts_before, verts_after).
+    """
+    faces_before, verts_before = len(world.faces), len(world.verts)
+
+    # 1. Weld coincident vertices
+    lookup, verts, remap = {}, [], []
+    for x, y, z in list(world.verts):
+        key = (round(x / WELD_EPS), round(y / WELD_EPS), round(z / WELD_EPS))
+        if key not in lookup:
+            lookup[key] = len(verts)
+            verts.append((x, y, z))
+        remap.append(lookup[key])
+
+    # 2. Remove degenerate and hidden faces
+    faces = []
+    source = world.builder
+    for f in range(source.face_count()):
+        indices, color = source.face(f)
+        obj = source.face_object[f]
+        indices = [remap[i] for i in indices]
+        indices = [i for k, i in enumerate(indices) if i != indices[k - 1]]
+        if len(set(indices)) < 3:
+            continue
+        normal = face_normal(verts, indices)
+        if normal == (0.0, 0.0, 0.0) or _face_hidden(verts, indices, normal, world.solids):
+            continue
+        faces.append((indices, color, normal, obj))
+
+    # 3. Merge adjacent coplanar same-color rectangles
+    groups, kept = {}, []
+    for indices, color, normal, obj in faces:
+        rect = _axis_rect(verts, indices, normal)
+        if rect is None:
+            kept.append((indices, color, obj))
+        else:
+            groups.setdefault(rect[:3] + (color,), []).append(rect[3:] + (obj,))
+    for (axis, sign, plane, color), rects in groups.items():
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        for u0, u1, v0, v1, obj in _merge_rects(rects):
+            corners = [(u0, v0), (u1, v0), (u1, v1), (u0, v1)]
+            if sign < 0:
+                corners.reverse()
+            indices = []
+            for cu, cv in corners:
+                p = [0.0, 0.0, 0.0]
+                p[axis], p[u], p[v] = plane, cu, cv
+                key = (round(p[0] / WELD_EPS), round(p[1] / WELD_EPS), round(p[2] / WELD_EPS))
+                if key not in lookup:
+                    lookup[key] = len(verts)
+                    verts.append(tuple(p))
+                indices.append(lookup[key])
+            kept.append((indices, color, obj))
+
+    # Drop vertices no face references any more
+    used = sorted({i for indices, _, _ in kept for i in indices})
+    compact = {old: new for new, old in enumerate(used)}
+    builder = MeshBuilder()
+    builder.add_vertices(verts[i] for i in used)
+    for indices, color, obj in kept:
+        builder.add_face([compact[i] for i in indices], color, obj)
+    world.builder = builder
+    return faces_before, builder.face_count(), verts_before, builder.vertex_count()
+
+def mesh_report():
+    """Print per-course face/vertex counts as built, after optimize_world() and as compiled."""
+    print(f"{'Course':24s} {'faces':>22s} {'verts':>22s}  order")
+    totals = [0] * 6
+    for name, WorldClass, _, _ in COURSE_LIST:
+        if issubclass(WorldClass, StreamedCourse):
+            continue   # geometry lives in chunks, not in the course class
+        world = WorldClass()
+        fb, fa, vb, va = optimize_world(world)
+        split, _ = build_bsp(world.builder)
+        growth = split.face_count() / max(fa, 1)
+        kept = split if growth <= BSP_MAX_GROWTH else world.builder
+        stats = (fb, fa, kept.face_count(), vb, va, kept.vertex_count())
+        totals = [t + s for t, s in zip(totals, stats)]
+        order = "bsp" if kept is split else f"sort (bsp {growth * 100 - 100:+.0f}%)"
+        print(f"{name:24s} {fb:5d} -> {fa:5d} -> {stats[2]:5d} {vb:5d} -> {va:5d} -> {stats[5]:5d}  {order}")
+    fb, fa, fc, vb, va, vc = totals
+    print(f"{'TOTAL':24s} {fb:5d} -> {fa:5d} -> {fc:5d} {vb:5d} -> {va:5d} -> {vc:5d}  "
+          f"({100 - 100 * fc / max(fb, 1):.0f}% fewer faces compiled)")
+    print(f"as built -> optimised -> compiled; a course keeps its BSP only if the split adds at most "
+          f"{BSP_MAX_GROWTH * 100 - 100:.0f}% faces")
+
+def _deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    return size
+
+def memory_report():
+    """Print per-course mesh memory: legacy lists of tuples vs MeshBuilder vs the packed
+    CourseMesh a loaded world holds; the saving is the lists against the CourseMesh."""
+    print(f"{'Course':24s} {'lists':>9s} {'builder':>9s} {'packed':>9s} {'saving':>7s}")
+    totals = [0, 0, 0]
+    for name, WorldClass, _, _ in COURSE_LIST:
+        if issubclass(WorldClass, StreamedCourse):
+            continue
+        world = WorldClass()
+        optimize_world(world)
+        legacy = _deep_sizeof([tuple(v) for v in world.verts], set())
+        legacy += _deep_sizeof([(list(ind), tuple(c)) for ind, c in world.faces], set())
+        row = [legacy, world.builder.nbytes(), world.builder.to_course_mesh().nbytes()]
+        totals = [t + r for t, r in zip(totals, row)]
+        print(f"{name:24s} {row[0]:9d} {row[1]:9d} {row[2]:9d} {row[0] / max(row[2], 1):6.1f}x")
+    print(f"{'TOTAL':24s} {totals[0]:9d} {totals[1]:9d} {totals[2]:9d} {totals[0] / max(totals[2], 1):6.1f}x")
 
-    # Collectibles
-    for star in world.stars:
-        star.update()
-        sv, sf = star.get_mesh()
-        for indices, color in sf:
-            pts = []
-            z_sum = 0
-            visible = True
-            for i in indices:
-                res = project_point(*sv[i], cam.x, cam.y, cam.z, cam.yaw)
-                if not res:
-                    visible = False
-                    break
-                pts.append((res[0], res[1]))
-                z_sum += res[2]
-            if visible and len(pts) >= 3:
-                render_list.append((z_sum / len(indices), pts, color))
+# -------------------------------------------------
+# BAKED LIGHTING
+# -------------------------------------------------
+LIGHT_LEVELS = 24   # shade quantisation; bounds palette growth per base colour
+
+def _light_level(normal, lights, ambient):
+    level = ambient
+    for (lx, ly, lz), intensity in lights:
+        level += intensity * max(0.0, normal[0]*lx + normal[1]*ly + normal[2]*lz)
+    return round(min(level, 1.25) * LIGHT_LEVELS) / LIGHT_LEVELS
+
+def _unit_lights(lights):
+    out = []
+    for (lx, ly, lz), intensity in lights:
+        length = math.sqrt(lx*lx + ly*ly + lz*lz) or 1.0
+        out.append(((lx / length, ly / length, lz / length), intensity))
+    return out
+
+def box_shades(color, lights, ambient):
+    """The six face colours of an axis-aligned box (_BOX_QUADS order), lit like the baked course."""
+    norm = _unit_lights(lights)
+    return [tuple(min(255, int(c * _light_level(n, norm, ambient))) for c in color) for n in _BOX_NORMALS]
+
+def bake_lighting(builder, lights, ambient):
+    """Shade every face by its normal and rewrite the palette with the lit colours."""
+    norm = _unit_lights(lights)
+    verts = VertexView(builder)
+    base = builder.palette
+    builder.palette = []
+    builder._palette_ids = {}
+    for f in range(builder.face_count()):
+        start = builder.face_start[f]
+        indices = builder.face_index[start:start + builder.face_len[f]]
+        level = _light_level(face_normal(verts, indices), norm, ambient)
+        color = tuple(min(255, int(c * level)) for c in base[builder.face_color[f]])
+        cid = builder._palette_ids.get(color)
+        if cid is None:
+            cid = builder._palette_ids[color] = len(builder.palette)
+            builder.palette.append(color)
+        builder.face_color[f] = cid
+    return len(base), len(builder.palette)
 
-    for coin in world.coins:
-        coin.update()
-        cv, cf = coin.get_mesh()
-        for indices, color in cf:
-            pts = []
-            z_sum = 0
-            visible = True
-            for i in indices:
-                res = project_point(*cv[i], cam.x, cam.y, cam.z, cam.yaw)
-                if not res:
-                    visible = False
+# -------------------------------------------------
+# BSP TREE (static painter's order)
+# -------------------------------------------------
+BSP_EPS        = 0.01
+BSP_CANDIDATES = 8    # splitter candidates scored per node
+BSP_SPLIT_COST = 256  # splitter score per polygon cut, against 1 per polygon of imbalance
+BSP_MAX_GROWTH = 1.10 # courses whose split faces outgrow this factor keep the depth sort
+
+def _split_polygon(pts, dists):
+    front, back = [], []
+    n = len(pts)
+    for k in range(n):
+        a, da = pts[k], dists[k]
+        b, db = pts[(k + 1) % n], dists[(k + 1) % n]
+        if da >= -BSP_EPS:
+            front.append(a)
+        if da <= BSP_EPS:
+            back.append(a)
+        if (da > BSP_EPS and db < -BSP_EPS) or (da < -BSP_EPS and db > BSP_EPS):
+            t = da / (da - db)
+            p = (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t, a[2] + (b[2] - a[2]) * t)
+            front.append(p)
+            back.append(p)
+    return front, back
+
+def _classify(plane, pts):
+    nx, ny, nz, d = plane
+    dists = [nx * x + ny * y + nz * z + d for x, y, z in pts]
+    lo, hi = min(dists), max(dists)
+    if hi <= BSP_EPS and lo >= -BSP_EPS:
+        return 0, dists      # coplanar
+    if lo >= -BSP_EPS:
+        return 1, dists      # front
+    if hi <= BSP_EPS:
+        return -1, dists     # back
+    return 2, dists          # spanning
+
+def _polygon_area(pts):
+    nx = ny = nz = 0.0
+    for k in range(len(pts)):
+        x0, y0, z0 = pts[k - 1]
+        x1, y1, z1 = pts[k]
+        nx += y0 * z1 - z0 * y1
+        ny += z0 * x1 - x0 * z1
+        nz += x0 * y1 - y0 * x1
+    return 0.5 * math.sqrt(nx * nx + ny * ny + nz * nz)
+
+def _polygon_plane(pts):
+    n = face_normal(pts, range(len(pts)))
+    cx = sum(p[0] for p in pts) / len(pts)
+    cy = sum(p[1] for p in pts) / len(pts)
+    cz = sum(p[2] for p in pts) / len(pts)
+    return (n[0], n[1], n[2], -(n[0] * cx + n[1] * cy + n[2] * cz))
+
+class BSPTree:
+    """Node planes, children and face ranges; faces of node i are contiguous in the mesh."""
+    def __init__(self, planes, children, face_ranges):
+        self.planes      = planes        # float32 (N, 4) nx, ny, nz, d
+        self.children    = children      # int32 (N, 2) front, back (-1 = empty)
+        self.face_ranges = face_ranges   # int32 (N, 2) start, count
+        self._planes   = planes.tolist()
+        self._children = children.tolist()
+        self._ranges   = face_ranges.tolist()
+
+    def locate(self, x, y, z):
+        """Empty child slot (node * 2 + side) that contains a point."""
+        n = 0
+        while True:
+            nx, ny, nz, d = self._planes[n]
+            side = 0 if nx * x + ny * y + nz * z + d >= 0 else 1
+            child = self._children[n][side]
+            if child < 0:
+                return n * 2 + side
+            n = child
+
+    def locate_many(self, points):
+        """locate() for a (P, 3) array of points, one tree level per step."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        node = np.zeros(len(points), dtype=np.int64)
+        slot = np.full(len(points), -1, dtype=np.int64)
+        todo = np.arange(len(points))
+        while len(todo):
+            n = node[todo]
+            plane = self.planes[n]
+            side = (np.einsum("ij,ij->i", plane[:, :3], points[todo]) + plane[:, 3] < 0).astype(np.int64)
+            child = self.children[n, side]
+            leaf = child < 0
+            slot[todo[leaf]] = n[leaf] * 2 + side[leaf]
+            node[todo[~leaf]] = child[~leaf]
+            todo = todo[~leaf]
+        return slot
+
+    def painter_order(self, cam, static, dynamic):
+        """Back-to-front draw list.
+
+        static maps face index -> (depth, pts, color) for the faces that passed
+        culling; dynamic is [(anchor_pos, items)] for moving entities, which are
+        dropped into the empty slot that holds their anchor.
+        """
+        slots = {}
+        dynamic = [entry for entry in dynamic if entry[1]]
+        if dynamic:
+            located = self.locate_many([pos for pos, _ in dynamic]).tolist()
+            for slot, entry in zip(located, dynamic):
+                slots.setdefault(slot, []).append(entry)
+        cx, cy, cz = cam.x, cam.y, cam.z
+        for group in slots.values():
+            group.sort(key=lambda e: (e[0][0] - cx) ** 2 + (e[0][1] - cy) ** 2 + (e[0][2] - cz) ** 2,
+                       reverse=True)
+
+        planes, children, ranges = self._planes, self._children, self._ranges
+        out = []
+        stack = [0]
+        while stack:
+            n = stack.pop()
+            if n < 0:
+                # Events are pushed bit-inverted: (node << 1) for its faces,
+                # (slot << 1 | 1) for dynamic entities in an empty slot
+                event = ~n
+                if event & 1:
+                    for _, items in slots[event >> 1]:
+                        out.extend(sorted(items, key=lambda it: it[0], reverse=True))
+                else:
+                    start, count = ranges[event >> 1]
+                    for f in range(start, start + count):
+                        item = static.get(f)
+                        if item is not None:
+                            out.append(item)
+                continue
+            nx, ny, nz, d = planes[n]
+            if nx * cx + ny * cy + nz * cz + d >= 0:
+                near, far = 0, 1
+            else:
+                near, far = 1, 0
+            # LIFO: near side is pushed first so the far side is drawn first
+            for side in (near, None, far):
+                if side is None:
+                    stack.append(~(n << 1))
+                    continue
+                child = children[n][side]
+                if child >= 0:
+                    stack.append(child)
+                elif n * 2 + side in slots:
+                    stack.append(~((n * 2 + side) << 1 | 1))
+        return out
+
+    def arrays(self):
+        return {"bsp_planes": self.planes, "bsp_children": self.children,
+                "bsp_ranges": self.face_ranges}
+
+def build_bsp(builder):
+    """Build a BSP over a MeshBuilder; returns (reordered MeshBuilder, BSPTree)."""
+    polys = []
+    for f in range(builder.face_count()):
+        indices, color = builder.face(f)
+        polys.append(([builder.vertex(i) for i in indices], color, builder.face_object[f]))
+    if not polys:
+        return builder, None
+
+    planes, children, node_faces = [], [], []
+    stack = [(polys, -1, 0)]
+    while stack:
+        group, parent, side = stack.pop()
+        # Pick the candidate splitter that cuts fewest polygons and balances best.
+        # The biggest polygons are always tried: splitting a ground plane is costly.
+        step = max(1, len(group) // BSP_CANDIDATES)
+        biggest = sorted(group, key=lambda poly: -_polygon_area(poly[0]))[:BSP_CANDIDATES // 2]
+        best, best_score = None, None
+        for cand in biggest + group[::step][:BSP_CANDIDATES]:
+            plane = _polygon_plane(cand[0])
+            nf = nb = ns = 0
+            for poly in group:
+                c, _ = _classify(plane, poly[0])
+                nf += c == 1
+                nb += c == -1
+                ns += c == 2
+            score = ns * BSP_SPLIT_COST + abs(nf - nb)
+            if best_score is None or score < best_score:
+                best, best_score = plane, score
+        node = len(planes)
+        planes.append(best)
+        children.append([-1, -1])
+        if parent >= 0:
+            children[parent][side] = node
+        here, front, back = [], [], []
+        for poly in group:
+            c, dists = _classify(best, poly[0])
+            if c == 0:
+                here.append(poly)
+            elif c == 1:
+                front.append(poly)
+            elif c == -1:
+                back.append(poly)
+            else:
+                fp, bp = _split_polygon(poly[0], dists)
+                if len(fp) >= 3:
+                    front.append((fp, poly[1], poly[2]))
+                if len(bp) >= 3:
+                    back.append((bp, poly[1], poly[2]))
+        node_faces.append(here)
+        if back:
+            stack.append((back, node, 1))
+        if front:
+            stack.append((front, node, 0))
+
+    out = MeshBuilder()
+    lookup = {}
+    ranges = []
+    for here in node_faces:
+        ranges.append((out.face_count(), len(here)))
+        for pts, color, obj in here:
+            indices = []
+            for p in pts:
+                key = (round(p[0] / WELD_EPS), round(p[1] / WELD_EPS), round(p[2] / WELD_EPS))
+                if key not in lookup:
+                    lookup[key] = out.vertex_count()
+                    out.add_vertex(*p)
+                idx = lookup[key]
+                if not indices or indices[-1] != idx:
+                    indices.append(idx)
+            if len(indices) > 1 and indices[0] == indices[-1]:
+                indices.pop()
+            out.add_face(indices, color, obj)
+    tree = BSPTree(np.array(planes, dtype=np.float32).reshape(-1, 4),
+                   np.array(children, dtype=np.int32).reshape(-1, 2),
+                   np.array(ranges, dtype=np.int32).reshape(-1, 2))
+    return out, tree
+
+# -------------------------------------------------
+# POTENTIALLY VISIBLE SETS (baked per course)
+# -------------------------------------------------
+PVS_SAMPLE_SPACING = 150.0   # spacing of target points on large faces
+PVS_MAX_SUBDIV     = 6       # cap per fan triangle, keeps huge floors affordable
+PVS_SHRINK         = 1.0     # occluders are shrunk so touching faces don't self-occlude
+PVS_MAX_TARGETS    = 64      # sample points per object besides its face centroids
+
+class PVS:
+    """Grid of cells over a course; each cell stores a bitset of visible objects."""
+    def __init__(self, origin, cell_size, dims, bits, object_count):
+        self.origin       = tuple(origin)
+        self.cell_size    = cell_size
+        self.dims         = tuple(dims)      # (nx, ny, nz)
+        self.bits         = bits             # uint8 (cells, ceil(objects / 8))
+        self.object_count = object_count
+        self._last_cell   = None
+        self._last_set    = None
+
+    def cell_of(self, x, y, z):
+        """Cell index containing a point, or None outside the baked volume."""
+        ix = int((x - self.origin[0]) // self.cell_size)
+        iy = int((y - self.origin[1]) // self.cell_size)
+        iz = int((z - self.origin[2]) // self.cell_size)
+        nx, ny, nz = self.dims
+        if 0 <= ix < nx and 0 <= iy < ny and 0 <= iz < nz:
+            return (ix * ny + iy) * nz + iz
+        return None
+
+    def visible_objects(self, *cells):
+        """Boolean mask over objects seen from any of the cells (cached for the last lookup)."""
+        if cells != self._last_cell:
+            bits = self.bits[cells[0]]
+            for cell in cells[1:]:
+                bits = bits | self.bits[cell]
+            self._last_set = np.unpackbits(bits)[:self.object_count].astype(bool)
+            self._last_cell = cells
+        return self._last_set
+
+    def arrays(self):
+        return {"pvs_bits": self.bits}
+
+    def meta(self):
+        return {"origin": list(self.origin), "cell_size": self.cell_size,
+                "dims": list(self.dims), "object_count": self.object_count}
+
+def _face_samples(pts, spacing):
+    """Points spread over a convex polygon (fan triangles, barycentric grid)."""
+    out = []
+    p0 = np.array(pts[0])
+    for k in range(1, len(pts) - 1):
+        a, b = np.array(pts[k]), np.array(pts[k + 1])
+        span = max(np.linalg.norm(a - p0), np.linalg.norm(b - p0), np.linalg.norm(b - a))
+        n = max(1, min(PVS_MAX_SUBDIV, int(math.ceil(span / spacing))))
+        for i in range(n + 1):
+            for j in range(n + 1 - i):
+                out.append(p0 + (a - p0) * (i / n) + (b - p0) * (j / n))
+    centroid = np.mean(pts, axis=0)
+    # Pull samples slightly inside the face so shared edges don't count as blocked
+    return [p + (centroid - p) * 0.02 for p in out] + [centroid]
+
+def bake_pvs(world, mesh, cell_size):
+    """Ray-cast from sample points in each cell to sample points on every object."""
+    pos = mesh.positions.astype(np.float64)
+    lo = pos.min(axis=0)
+    hi = pos.max(axis=0)
+    lo[1] = max(lo[1], GROUND_Y)
+    dims = np.maximum(1, np.ceil((hi - lo) / cell_size).astype(int))
+
+    # Target points, tagged with the object they belong to: every face centroid,
+    # plus up to PVS_MAX_TARGETS of the other samples spread evenly over the object
+    targets, owners, extra = [], [], {}
+    for f in range(mesh.face_count()):
+        indices, _ = mesh.face(f)
+        normal = np.array(face_normal(pos, indices))
+        obj = int(mesh.face_object[f])
+        samples = [p + normal * 0.5 for p in _face_samples([pos[i] for i in indices], PVS_SAMPLE_SPACING)]
+        targets.append(samples[-1])
+        owners.append(obj)
+        extra.setdefault(obj, []).extend(samples[:-1])
+    for obj, samples in extra.items():
+        picked = samples[::max(1, len(samples) // PVS_MAX_TARGETS)][:PVS_MAX_TARGETS]
+        targets.extend(picked)
+        owners.extend([obj] * len(picked))
+    targets = np.array(targets)
+    owners = np.array(owners)
+
+    boxes = np.array(world.solids, dtype=np.float64).reshape(-1, 6)
+    bmin = boxes[:, :3] + PVS_SHRINK
+    bmax = boxes[:, 3:] - PVS_SHRINK
+    valid = np.all(bmax > bmin, axis=1)
+    bmin, bmax = bmin[valid], bmax[valid]
+
+    nx, ny, nz = dims
+    nobj = mesh.object_count
+    bits = np.zeros((nx * ny * nz, (nobj + 7) // 8), dtype=np.uint8)
+    offsets = [(0.5, 0.5, 0.5)] + [(a, b, c) for a in (0.15, 0.85) for b in (0.15, 0.85) for c in (0.15, 0.85)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for ix in range(nx):
+            for iy in range(ny):
+                for iz in range(nz):
+                    seen = np.zeros(nobj, dtype=bool)
+                    corner = lo + np.array((ix, iy, iz)) * cell_size
+                    for off in offsets:
+                        eye = corner + np.array(off) * cell_size
+                        pending = ~seen[owners]
+                        if not pending.any():
+                            break
+                        tgt = targets[pending]
+                        # A camera inside a box sees straight through it
+                        around = np.all((bmin < eye) & (eye < bmax), axis=1)
+                        inv = 1.0 / (tgt - eye)
+                        lo_b, hi_b = bmin[~around] - eye, bmax[~around] - eye
+                        # Slab test per axis; (T, B) arrays avoid slow size-3 reductions
+                        t_in, t_out = None, None
+                        for a in range(3):
+                            t1 = np.outer(inv[:, a], lo_b[:, a])
+                            t2 = np.outer(inv[:, a], hi_b[:, a])
+                            near, far = np.minimum(t1, t2), np.maximum(t1, t2)
+                            t_in = near if t_in is None else np.maximum(t_in, near)
+                            t_out = far if t_out is None else np.minimum(t_out, far)
+                        blocked = ((t_in <= t_out) & (t_out > 0) & (t_in < 1)).any(axis=1)
+                        seen[owners[pending][~blocked]] = True
+                    cell = (ix * ny + iy) * nz + iz
+                    bits[cell] = np.packbits(np.concatenate([seen, np.zeros(bits.shape[1] * 8 - nobj, bool)]))
+    return PVS(lo.tolist(), cell_size, dims.tolist(), bits, nobj)
+
+# -------------------------------------------------
+# ROOMS AND PORTALS
+# -------------------------------------------------
+PORTAL_NEAR = 10.0   # matches project_point's near plane
+
+def _to_camera(p, cam):
+    rx, rz = rotate_y(p[0] - cam.x, p[2] - cam.z, -cam.yaw)
+    return (rx, p[1] - cam.y, rz)
+
+def _portal_screen_rect(corners, cam, fov=700):
+    """Screen bbox of a portal clipped to the near plane, or None if fully behind."""
+    pts = [_to_camera(c, cam) for c in corners]
+    clipped = []
+    for k, a in enumerate(pts):
+        b = pts[(k + 1) % len(pts)]
+        if a[2] >= PORTAL_NEAR:
+            clipped.append(a)
+        if (a[2] >= PORTAL_NEAR) != (b[2] >= PORTAL_NEAR):
+            t = (PORTAL_NEAR - a[2]) / (b[2] - a[2])
+            clipped.append(tuple(a[i] + (b[i] - a[i]) * t for i in range(3)))
+    if not clipped:
+        return None
+    xs = [x * fov / z + SCREEN_CENTER[0] for x, _, z in clipped]
+    ys = [-y * fov / z + SCREEN_CENTER[1] for _, y, z in clipped]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+class RoomGraph:
+    """Rooms, the portals between them and the room each static face belongs to."""
+    def __init__(self, rooms, portals, face_room):
+        self.rooms     = [tuple(r) for r in rooms]   # (name, minx, miny, minz, maxx, maxy, maxz)
+        self.portals   = [(a, b, [tuple(c) for c in corners]) for a, b, corners in portals]
+        self.face_room = face_room                   # int16 (F,), -1 = outside every room
+        self.names     = [r[0] for r in self.rooms]
+        self.links     = {i: [] for i in range(len(self.rooms))}
+        for a, b, corners in self.portals:
+            ia, ib = self.names.index(a), self.names.index(b)
+            self.links[ia].append((ib, corners))
+            self.links[ib].append((ia, corners))
+        self.visible_rooms = set()
+
+    def room_at(self, x, y, z):
+        """Smallest room containing the point, so nested rooms win over their parent."""
+        best, best_vol = None, None
+        for i, (_, x0, y0, z0, x1, y1, z1) in enumerate(self.rooms):
+            if x0 <= x <= x1 and y0 <= y <= y1 and z0 <= z <= z1:
+                vol = (x1 - x0) * (y1 - y0) * (z1 - z0)
+                if best is None or vol < best_vol:
+                    best, best_vol = i, vol
+        return best
+
+    def face_mask(self, cam):
+        """Faces in rooms reachable through on-screen portals, or None outside every room."""
+        start = self.room_at(cam.x, cam.y, cam.z)
+        if start is None:
+            self.visible_rooms = set()
+            return None
+        visible = {start}
+        stack = [(start, (0, 0, WIDTH, HEIGHT), (start,))]
+        while stack:
+            room, (l, t, r, b), path = stack.pop()
+            for other, corners in self.links[room]:
+                if other in path:
+                    continue
+                rect = _portal_screen_rect(corners, cam)
+                if rect is None:
+                    continue
+                # Narrow the view to the part of this portal seen through the previous ones
+                clip = (max(l, rect[0]), max(t, rect[1]), min(r, rect[2]), min(b, rect[3]))
+                if clip[0] >= clip[2] or clip[1] >= clip[3]:
+                    continue
+                visible.add(other)
+                stack.append((other, clip, path + (other,)))
+        self.visible_rooms = visible
+        mask = np.zeros(len(self.rooms) + 1, dtype=bool)
+        mask[list(visible)] = True
+        mask[-1] = True   # faces outside every room are always drawn
+        return mask[self.face_room]
+
+    def arrays(self):
+        return {"room_face": self.face_room}
+
+    def meta(self):
+        return {"rooms": [list(r) for r in self.rooms],
+                "portals": [[a, b, [list(c) for c in corners]] for a, b, corners in self.portals]}
+
+def build_room_graph(world, mesh):
+    """Assign every face to the room on its front side."""
+    graph = RoomGraph(world.rooms, world.portals, np.zeros(0, dtype=np.int16))
+    pos = mesh.positions.astype(np.float64)
+    face_room = np.full(mesh.face_count(), -1, dtype=np.int16)
+    for f in range(mesh.face_count()):
+        indices, _ = mesh.face(f)
+        n = face_normal(pos, indices)
+        c = pos[indices].mean(axis=0) + np.array(n)
+        room = graph.room_at(*c)
+        if room is not None:
+            face_room[f] = room
+    graph.face_room = face_room
+    return graph
+
+# -------------------------------------------------
+# OCCLUSION CULLING (coarse software depth buffer)
+# -------------------------------------------------
+OCC_W, OCC_H       = 160, 120   # depth buffer resolution
+OCC_MAX_OCCLUDERS  = 8
+OCC_MIN_SIZE       = 0.25       # occluder extent / distance below which it isn't worth drawing
+OCC_NEAR           = 10.0       # near plane occluder quads are clipped to (project_point's cut-off)
+_BOX_QUADS = [[0,3,2,1],[4,5,6,7],[0,4,7,3],[1,2,6,5],[3,7,6,2],[0,1,5,4]]
+_BOX_NORMALS = [(0, 0, -1), (0, 0, 1), (-1, 0, 0), (1, 0, 0), (0, 1, 0), (0, -1, 0)]
+
+def _clip_near(pts, near):
+    """Clip a camera-space polygon [(x, y, z), ...] to z >= near (Sutherland-Hodgman, one plane)."""
+    out = []
+    for k in range(len(pts)):
+        a, b = pts[k - 1], pts[k]
+        if a[2] >= near:
+            if b[2] >= near:
+                out.append(b)
+                continue
+        elif b[2] < near:
+            continue
+        t = (near - a[2]) / (b[2] - a[2])
+        out.append((a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t, near))
+        if b[2] >= near:
+            out.append(b)
+    return out
+
+def raster_convex(poly, w, h, conservative=True):
+    """Rasterise a convex polygon onto a w x h grid.
+
+    Returns (y0, x0, mask) for the covered pixels, or None. With conservative
+    set only pixels whose four corners are inside count, otherwise pixel centres.
+    """
+    xs = [p[0] for p in poly]
+    ys = [p[1] for p in poly]
+    x0 = max(0, int(math.floor(min(xs))))
+    x1 = min(w, int(math.ceil(max(xs))))
+    y0 = max(0, int(math.floor(min(ys))))
+    y1 = min(h, int(math.ceil(max(ys))))
+    if x0 >= x1 or y0 >= y1:
+        return None
+    area = 0.0
+    for k in range(len(poly)):
+        ax, ay = poly[k - 1]
+        bx, by = poly[k]
+        area += ax * by - bx * ay
+    if area == 0:
+        return None
+    sign = 1.0 if area > 0 else -1.0
+    if conservative:
+        gx = np.arange(x0, x1 + 1, dtype=np.float32)[None, :]
+        gy = np.arange(y0, y1 + 1, dtype=np.float32)[:, None]
+    else:
+        gx = np.arange(x0, x1, dtype=np.float32)[None, :] + 0.5
+        gy = np.arange(y0, y1, dtype=np.float32)[:, None] + 0.5
+    inside = np.ones((gy.shape[0], gx.shape[1]), dtype=bool)
+    for k in range(len(poly)):
+        ax, ay = poly[k - 1]
+        bx, by = poly[k]
+        inside &= ((bx - ax) * (gy - ay) - (by - ay) * (gx - ax)) * sign >= 0
+    if conservative:
+        inside = inside[:-1, :-1] & inside[1:, :-1] & inside[:-1, 1:] & inside[1:, 1:]
+    return y0, x0, inside
+
+class OcclusionCuller:
+    """Rasterises the biggest nearby boxes into a max-depth pyramid and tests object bounds.
+
+    Off by default (F4): from the orbit camera the hand-built courses rarely hide
+    anything behind a box, and the pass rejected under 1% of faces for 1-2 ms a frame.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.depth   = np.full((OCC_H, OCC_W), np.inf, dtype=np.float32)
+        # (padding buffer or None, level) per halving, allocated once and refilled each frame
+        self.pyramid = []
+        level = self.depth
+        while max(level.shape) > 2:
+            h, w = level.shape
+            padded = np.full((h + h % 2, w + w % 2), np.inf, dtype=np.float32) if h % 2 or w % 2 else None
+            level = np.empty(((h + h % 2) // 2, (w + w % 2) // 2), dtype=np.float32)
+            self.pyramid.append((padded, level))
+        self.levels  = [self.depth] + [level for _, level in self.pyramid]
+        self.occluders = 0
+        self.culled_objects = 0
+
+    def _draw_occluders(self, solids, cam):
+        self.depth.fill(np.inf)
+        if len(solids) == 0:
+            self.occluders = 0
+            return
+        boxes = np.asarray(solids, dtype=np.float32).reshape(-1, 6)
+        center = (boxes[:, :3] + boxes[:, 3:]) * 0.5
+        extent = (boxes[:, 3:] - boxes[:, :3]).max(axis=1)
+        dx, dz = center[:, 0] - cam.x, center[:, 2] - cam.z
+        rz = dx * math.sin(-cam.yaw) + dz * math.cos(-cam.yaw)
+        # Rank by size over the distance to the nearest part; quads are clipped to the
+        # near plane below, so boxes the camera is close to or beside still count.
+        score = extent / np.maximum(rz - extent * 0.5, OCC_NEAR)
+        candidates = np.nonzero((rz + extent > OCC_NEAR) & (score > OCC_MIN_SIZE))[0]
+        candidates = candidates[np.argsort(-score[candidates])][:OCC_MAX_OCCLUDERS]
+        sin_y, cos_y = math.sin(-cam.yaw), math.cos(-cam.yaw)
+        sx_scale = OCC_W / WIDTH
+        sy_scale = OCC_H / HEIGHT
+        drawn = 0
+        for b in candidates.tolist():
+            x0, y0, z0, x1, y1, z1 = boxes[b].tolist()
+            # Camera space corners, as in project_point
+            view = []
+            for x, y, z in ((x0, y0, z0), (x1, y0, z0), (x1, y1, z0), (x0, y1, z0),
+                            (x0, y0, z1), (x1, y0, z1), (x1, y1, z1), (x0, y1, z1)):
+                dx, dz = x - cam.x, z - cam.z
+                view.append((dx * cos_y - dz * sin_y, y - cam.y, dx * sin_y + dz * cos_y))
+            # Only the faces turned towards the camera can be nearest
+            facing = (cam.z < z0, cam.z > z1, cam.x < x0, cam.x > x1, cam.y > y1, cam.y < y0)
+            hit_any = False
+            for quad, front in zip(_BOX_QUADS, facing):
+                if not front:
+                    continue
+                pts = _clip_near([view[i] for i in quad], OCC_NEAR)
+                if len(pts) < 3:
+                    continue
+                scale = [700 / p[2] for p in pts]
+                hit = raster_convex([((p[0] * k + SCREEN_CENTER[0]) * sx_scale,
+                                      (SCREEN_CENTER[1] - p[1] * k) * sy_scale) for p, k in zip(pts, scale)],
+                                    OCC_W, OCC_H)
+                if hit is None:
+                    continue
+                fy, fx, mask = hit
+                region = self.depth[fy:fy + mask.shape[0], fx:fx + mask.shape[1]]
+                # The farthest corner keeps the stored depth conservative
+                far = max(p[2] for p in pts)
+                region[mask] = np.minimum(region[mask], far)
+                hit_any = True
+            drawn += hit_any
+        self.occluders = drawn
+
+    def _build_pyramid(self):
+        level = self.depth
+        for padded, out in self.pyramid:
+            if padded is not None:
+                h, w = level.shape
+                padded[:h, :w] = level   # the extra row/column stays at infinity
+                level = padded
+            h, w = level.shape
+            np.max(level.reshape(h // 2, 2, w // 2, 2), axis=(1, 3), out=out)
+            level = out
+
+    def visible_objects(self, mesh, solids, cam, candidates=None):
+        """Boolean mask over mesh objects; False means hidden behind an occluder."""
+        visible = np.ones(mesh.object_count, dtype=bool)
+        self.culled_objects = 0
+        if not self.enabled or mesh.object_count == 0:
+            self.occluders = 0
+            return visible
+        self._draw_occluders(solids, cam)
+        if self.occluders == 0:
+            return visible
+        self._build_pyramid()
+
+        # Objects whose faces were all welded or merged away keep +-inf bounds: skip them
+        finite = np.isfinite(mesh.object_bounds).all(axis=1)
+        b = np.where(finite[:, None], mesh.object_bounds, 0.0)
+        corners = np.stack([b[:, [ix, iy, iz]] for ix in (0, 3) for iy in (1, 4) for iz in (2, 5)], axis=1)
+        sx, sy, rz, in_front = project_vertices(corners.reshape(-1, 3), cam)
+        n = mesh.object_count
+        sx = sx.reshape(n, 8) * (OCC_W / WIDTH)
+        sy = sy.reshape(n, 8) * (OCC_H / HEIGHT)
+        rz = rz.reshape(n, 8)
+        testable = in_front.reshape(n, 8).all(axis=1) & finite
+        if candidates is not None:
+            testable &= candidates
+        for o in np.nonzero(testable)[0].tolist():
+            x0 = max(0, int(math.floor(sx[o].min())))
+            x1 = min(OCC_W, int(math.ceil(sx[o].max())) + 1)
+            y0 = max(0, int(math.floor(sy[o].min())))
+            y1 = min(OCC_H, int(math.ceil(sy[o].max())) + 1)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            # Coarsest level where the rect spans at most a few texels
+            lvl = 0
+            while lvl + 1 < len(self.levels) and max(x1 - x0, y1 - y0) >> lvl > 4:
+                lvl += 1
+            tile = self.levels[lvl][y0 >> lvl:((y1 - 1) >> lvl) + 1, x0 >> lvl:((x1 - 1) >> lvl) + 1]
+            if tile.max() < rz[o].min():
+                visible[o] = False
+        self.culled_objects = int((~visible).sum())
+        return visible
+
+occlusion_culler = OcclusionCuller()
+
+# -------------------------------------------------
+# COMPILED COURSES (on-disk cache)
+# -------------------------------------------------
+COURSE_MAGIC          = b"UM3D"
+COURSE_FORMAT_VERSION = 2
+COURSE_CACHE_DIR      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "course_cache")
+_HEADER               = struct.Struct("<4sII")   # magic, version, meta length
+WORLD_CACHE_BYTES     = 32 * 1024 * 1024         # in-memory LRU cap for loaded courses
+
+def _align16(n):
+    return (n + 15) & ~15
+
+class CourseMesh:
+    """Static course geometry as flat arrays (vertex table, padded face table, palette)."""
+    def __init__(self, positions, face_verts, face_size, face_color, palette, face_object,
+                 object_bounds=None, face_planes=None, edges=None, face_edges=None, edge_faces=None):
+        self.positions   = positions    # float32 (V, 3)
+        self.face_verts  = face_verts   # int32 (F, K), padded with -1
+        self.face_size   = face_size    # uint8 (F,)
+        self.face_color  = face_color   # uint16 (F,) index into palette
+        self.palette     = palette      # uint8 (P, 3)
+        self.face_object = face_object  # int32 (F,) primitive id, used by visibility
+        self.object_count = int(face_object.max()) + 1 if len(face_object) else 0
+        if object_bounds is None:
+            object_bounds = self._object_bounds()
+        self.object_bounds = object_bounds   # float32 (O, 6) min xyz, max xyz
+        if face_planes is None:
+            face_planes = self._face_planes()
+        self.face_planes = face_planes       # float32 (F, 4) outward normal, d
+        if edges is None:
+            edges, face_edges, edge_faces = self._edge_list()
+        self.edges      = edges        # int32 (E, 2) unique vertex pairs
+        self.face_edges = face_edges   # int32 (F, K) edge k runs from vertex k to k+1, -1 pad
+        self.edge_faces = edge_faces   # int32 (E, 2) adjacent faces (same face twice on a boundary)
+        self.colors     = [tuple(int(c) for c in rgb) for rgb in palette]
+
+    def _face_planes(self):
+        fv = np.where(self.face_verts < 0, 0, self.face_verts)
+        p0, p1, p2 = (self.positions[fv[:, k]].astype(np.float64) for k in range(3))
+        n = np.cross(p1 - p0, p2 - p0)
+        n /= np.maximum(np.linalg.norm(n, axis=1, keepdims=True), 1e-12)
+        d = -(n * p0).sum(axis=1)
+        return np.hstack([n, d[:, None]]).astype(np.float32)
+
+    def _edge_list(self):
+        fv = self.face_verts
+        f_count, k = fv.shape
+        slot = np.arange(k)[None, :]
+        valid = slot < self.face_size[:, None]
+        nxt = np.where(slot + 1 < self.face_size[:, None], slot + 1, 0)
+        a = fv
+        b = np.take_along_axis(fv, np.broadcast_to(nxt, fv.shape), axis=1)
+        v_count = np.int64(max(len(self.positions), 1))
+        key = np.minimum(a, b).astype(np.int64) * v_count + np.maximum(a, b)
+        uniq, inverse = np.unique(key[valid], return_inverse=True)
+        edges = np.stack([uniq // v_count, uniq % v_count], axis=1).astype(np.int32)
+        face_edges = np.full(fv.shape, -1, dtype=np.int32)
+        face_edges[valid] = inverse
+        owner = np.broadcast_to(np.arange(f_count)[:, None], fv.shape)[valid]
+        edge_faces = np.empty((len(uniq), 2), dtype=np.int32)
+        edge_faces[:, 0] = f_count
+        edge_faces[:, 1] = -1
+        np.minimum.at(edge_faces[:, 0], inverse, owner)
+        np.maximum.at(edge_faces[:, 1], inverse, owner)
+        return edges, face_edges, edge_faces
+
+    def _object_bounds(self):
+        bounds = np.empty((self.object_count, 6), dtype=np.float32)
+        bounds[:, :3] = np.inf
+        bounds[:, 3:] = -np.inf
+        fv = self.face_verts
+        valid = fv >= 0
+        owner = np.broadcast_to(self.face_object[:, None], fv.shape)[valid]
+        pts = self.positions[fv[valid]]
+        np.minimum.at(bounds[:, :3], owner, pts)
+        np.maximum.at(bounds[:, 3:], owner, pts)
+        return bounds
+
+    def vertex_count(self):
+        return len(self.positions)
+
+    def face_count(self):
+        return len(self.face_size)
+
+    def vertex(self, i):
+        x, y, z = self.positions[i].tolist()
+        return (x, y, z)
+
+    def face(self, f):
+        return self.face_verts[f, :self.face_size[f]].tolist(), self.colors[self.face_color[f]]
+
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays().values())
+
+    @classmethod
+    def concat(cls, meshes):
+        """Join meshes into one, shifting vertex, edge, face and object ids; the palette is merged."""
+        def starts(count):
+            return np.cumsum([0] + [count(m) for m in meshes])[:-1].tolist()
+
+        k = max(m.face_verts.shape[1] for m in meshes)
+
+        def padded(table, offset):
+            out = np.full((len(table), k), -1, dtype=np.int32)
+            out[:, :table.shape[1]] = np.where(table < 0, -1, table + offset)
+            return out
+
+        v0 = starts(lambda m: len(m.positions))
+        e0 = starts(lambda m: len(m.edges))
+        f0 = starts(lambda m: len(m.face_size))
+        o0 = starts(lambda m: len(m.object_bounds))
+        p0 = starts(lambda m: len(m.palette))
+        palette, color_map = np.unique(np.concatenate([m.palette for m in meshes]), axis=0,
+                                       return_inverse=True)
+        face_color = np.concatenate([m.face_color.astype(np.int64) + p for m, p in zip(meshes, p0)])
+        return cls(np.concatenate([m.positions for m in meshes]),
+                   np.concatenate([padded(m.face_verts, v) for m, v in zip(meshes, v0)]),
+                   np.concatenate([m.face_size for m in meshes]),
+                   color_map.reshape(-1)[face_color].astype(np.uint16),
+                   palette.astype(np.uint8),
+                   np.concatenate([m.face_object + o for m, o in zip(meshes, o0)]).astype(np.int32),
+                   object_bounds=np.concatenate([m.object_bounds for m in meshes]),
+                   face_planes=np.concatenate([m.face_planes for m in meshes]),
+                   edges=np.concatenate([m.edges + v for m, v in zip(meshes, v0)]).astype(np.int32),
+                   face_edges=np.concatenate([padded(m.face_edges, e) for m, e in zip(meshes, e0)]),
+                   edge_faces=np.concatenate([m.edge_faces + f for m, f in zip(meshes, f0)]).astype(np.int32))
+
+    def arrays(self):
+        return {
+            "positions":  self.positions,
+            "face_verts": self.face_verts,
+            "face_size":  self.face_size,
+            "face_color": self.face_color,
+            "palette":    self.palette,
+            "face_object": self.face_object,
+            "object_bounds": self.object_bounds,
+            "face_planes": self.face_planes,
+            "edges":      self.edges,
+            "face_edges": self.face_edges,
+            "edge_faces": self.edge_faces,
+        }
+
+# Build-pipeline functions whose source also feeds the course key
+COURSE_PIPELINE = ("build_course", "MeshBuilder", "face_normal",
+                   "optimize_world", "_face_hidden", "_axis_rect", "_merge_rects",
+                   "bake_lighting", "_light_level", "_unit_lights",
+                   "build_bsp", "_split_polygon", "_classify", "_polygon_plane", "_polygon_area",
+                   "bake_pvs", "_face_samples", "build_room_graph",
+                   "box_shades", "box_mesh", "CourseMesh", "SceneGraph", "Terrain", "WaterSurface")
+# Module constants the compiled data depends on; every colour constant is hashed as well
+COURSE_CONSTANTS = ("GROUND_Y", "WELD_EPS", "COVER_EPS", "LIGHT_LEVELS",
+                    "BSP_EPS", "BSP_CANDIDATES", "BSP_SPLIT_COST", "BSP_MAX_GROWTH",
+                    "PVS_SAMPLE_SPACING", "PVS_MAX_SUBDIV", "PVS_SHRINK", "PVS_MAX_TARGETS",
+                    "TERRAIN_CHUNK", "TERRAIN_MAX_ERROR", "WATER_CHUNK", "WATER_SPACING")
+
+_top_level_sources = None
+
+def _source_of(name):
+    # One parse of this file serves every course; inspect.getsource re-parses per call.
+    global _top_level_sources
+    if _top_level_sources is None:
+        try:
+            with open(os.path.abspath(__file__), encoding="utf-8") as f:
+                src = f.read()
+            lines = src.splitlines(keepends=True)
+            _top_level_sources = {node.name: "".join(lines[node.lineno - 1:node.end_lineno])
+                                  for node in ast.parse(src).body
+                                  if isinstance(node, (ast.ClassDef, ast.FunctionDef))}
+        except (OSError, SyntaxError):
+            _top_level_sources = {}
+    text = _top_level_sources.get(name)
+    return text if text is not None else inspect.getsource(globals()[name])
+
+_course_keys = {}
+
+def _course_constants():
+    """(name, value) for COURSE_CONSTANTS and every colour constant (an upper-case RGB tuple)."""
+    names = set(COURSE_CONSTANTS)
+    names.update(name for name, value in globals().items()
+                 if name.isupper() and isinstance(value, tuple) and len(value) == 3
+                 and all(isinstance(c, int) for c in value))
+    return [(name, globals()[name]) for name in sorted(names)]
+
+def course_key(WorldClass):
+    """Hash of the course class source (its bases and the build pipeline), the constants it
+    bakes in and the format version."""
+    key = _course_keys.get(WorldClass)
+    if key is None:
+        h = hashlib.sha1(b"v%d" % COURSE_FORMAT_VERSION)
+        h.update(repr(_course_constants()).encode())
+        for cls in WorldClass.__mro__:
+            if cls is object:
+                continue
+            h.update(_source_of(cls.__name__).encode())
+        for name in COURSE_PIPELINE:
+            h.update(_source_of(name).encode())
+        key = _course_keys[WorldClass] = h.hexdigest()[:16]
+    return key
+
+def course_cache_path(WorldClass):
+    return os.path.join(COURSE_CACHE_DIR, f"{WorldClass.__name__}-{course_key(WorldClass)}.course")
+
+def build_course(WorldClass):
+    """Run a course's build(), optimise it and pack the result into a CourseMesh."""
+    world = WorldClass()
+    world.mesh_stats = optimize_world(world)
+    bake_lighting(world.builder, world.lights, world.ambient)
+    split, bsp = build_bsp(world.builder)
+    if split.face_count() <= world.builder.face_count() * BSP_MAX_GROWTH:
+        world.builder, world.bsp = split, bsp
+    world.mesh = world.builder.to_course_mesh()
+    if world.pvs_cell_size:
+        world.pvs = bake_pvs(world, world.mesh, world.pvs_cell_size)
+    if world.rooms:
+        world.room_graph = build_room_graph(world, world.mesh)
+    world.build_collision()
+    return world
+
+def write_compiled_course(path, world):
+    meta = {
+        "name":       world.name,
+        "sky_color":  list(world.sky_color),
+        "spawn":      list(world.spawn),
+        "star_count": world.star_count,
+        "far_plane":  world.far_plane,
+        "fog_start":  world.fog_start,
+        "lights":     [[list(d), i] for d, i in world.lights],
+        "ambient":    world.ambient,
+        "platforms":  [list(p) for p in world.platforms],
+        "stars":      [[s.x, s.y, s.z] for s in world.stars],
+        "coins":      [[c.x, c.y, c.z] for c in world.coins],
+        "enemies":    [[e.kind, e.x, e.y, e.z, float(world.enemies.leash[e.index])] for e in world.enemies],
+        "movers":     world.movers.meta(),
+        "scene":      world.scene.meta(),
+        "terrains":   [t.meta() for t in world.terrains],
+        "waters":     [w.meta() for w in world.waters],
+        "pvs":        world.pvs.meta() if world.pvs is not None else None,
+        "rooms":      world.room_graph.meta() if world.room_graph is not None else None,
+        "arrays":     {},
+    }
+    arrays = world.mesh.arrays()
+    arrays["solids"] = np.asarray(world.solids, dtype=np.float32).reshape(-1, 6)
+    for k, terrain in enumerate(world.terrains):
+        arrays[f"terrain{k}"] = terrain.heights
+    if world.pvs is not None:
+        arrays.update(world.pvs.arrays())
+    if world.room_graph is not None:
+        arrays.update(world.room_graph.arrays())
+    if world.bsp is not None:
+        arrays.update(world.bsp.arrays())
+    blobs = []
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        meta["arrays"][name] = [arr.dtype.str, list(arr.shape), offset]
+        blob = arr.tobytes()
+        blobs.append(blob + b"\0" * (_align16(len(blob)) - len(blob)))
+        offset += len(blobs[-1])
+    header = json.dumps(meta).encode()
+    head = _HEADER.pack(COURSE_MAGIC, COURSE_FORMAT_VERSION, len(header)) + header
+    head += b"\0" * (_align16(len(head)) - len(head))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(head)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, path)
+
+def read_compiled_course(path, WorldClass):
+    """Memory-map a compiled course; mesh arrays point straight into the mapping."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < _HEADER.size:
+        raise ValueError(f"{path}: truncated course file")
+    magic, version, meta_len = _HEADER.unpack_from(mm, 0)
+    if magic != COURSE_MAGIC or version != COURSE_FORMAT_VERSION:
+        raise ValueError(f"{path}: not a v{COURSE_FORMAT_VERSION} course file")
+    meta = json.loads(mm[_HEADER.size:_HEADER.size + meta_len])
+    base = _align16(_HEADER.size + meta_len)
+    arrays = {}
+    for name, (dtype, shape, offset) in meta["arrays"].items():
+        count = int(np.prod(shape))
+        if count:
+            arr = np.frombuffer(mm, dtype=dtype, count=count, offset=base + offset)
+        else:
+            arr = np.zeros(0, dtype=dtype)
+        arrays[name] = arr.reshape(shape)
+
+    world = WorldClass.__new__(WorldClass)
+    WorldBase.__init__(world)
+    world.name       = meta["name"]
+    world.sky_color  = tuple(meta["sky_color"])
+    world.spawn      = tuple(meta["spawn"])
+    world.star_count = meta["star_count"]
+    world.far_plane  = meta["far_plane"]
+    world.fog_start  = meta["fog_start"]
+    world.lights     = [(tuple(d), i) for d, i in meta["lights"]]
+    world.ambient    = meta["ambient"]
+    world.platforms  = [tuple(p) for p in meta["platforms"]]
+    for p in meta["stars"]:
+        world.stars.add(*p)
+    for p in meta["coins"]:
+        world.coins.add(*p)
+    for e in meta["enemies"]:
+        world.enemies.add(*e)
+    for m in meta["movers"]:
+        world.movers.add(*m)
+    world.scene = SceneGraph.from_meta(meta["scene"])
+    world.terrains = [Terrain(heights=arrays.pop(f"terrain{k}"), lights=world.lights, ambient=world.ambient, **t)
+                      for k, t in enumerate(meta["terrains"])]
+    world.waters = [WaterSurface(lights=world.lights, ambient=world.ambient, **w) for w in meta["waters"]]
+    world.movers.nodes = [world.scene.find(f"mover:{i}") for i in range(world.movers.count)]
+    pvs_bits = arrays.pop("pvs_bits", None)
+    room_face = arrays.pop("room_face", None)
+    world.solids     = arrays.pop("solids")
+    if "bsp_planes" in arrays:
+        world.bsp = BSPTree(arrays.pop("bsp_planes"), arrays.pop("bsp_children"), arrays.pop("bsp_ranges"))
+    world.mesh       = CourseMesh(**arrays)
+    if meta["pvs"] is not None:
+        world.pvs = PVS(bits=pvs_bits, **meta["pvs"])
+    if meta["rooms"] is not None:
+        world.room_graph = RoomGraph(face_room=room_face, **meta["rooms"])
+    world.build_collision()
+    return world
+
+def load_course(WorldClass, progress=None):
+    """Return a ready-to-play course, compiling it to COURSE_CACHE_DIR on a miss.
+
+    progress, if given, is called as progress(fraction, label) between stages.
+    """
+    report = progress or (lambda fraction, label: None)
+    if issubclass(WorldClass, StreamedCourse):
+        report(0.1, "Streaming")
+        world = WorldClass()
+        world.open_stream()
+        return world
+    path = course_cache_path(WorldClass)
+    if os.path.exists(path):
+        report(0.5, "Loading")
+        try:
+            return read_compiled_course(path, WorldClass)
+        except (OSError, ValueError, KeyError):
+            pass
+    report(0.1, "Building")
+    world = build_course(WorldClass)
+    report(0.7, "Compiling")
+    try:
+        write_compiled_course(path, world)
+        for old in os.listdir(COURSE_CACHE_DIR):
+            if old.startswith(WorldClass.__name__ + "-") and old != os.path.basename(path):
+                os.remove(os.path.join(COURSE_CACHE_DIR, old))
+        report(0.9, "Loading")
+        return read_compiled_course(path, WorldClass)
+    except OSError:
+        return world
+
+class WorldCache:
+    """Bounded LRU of loaded courses keyed by course class.
+
+    Geometry is immutable once loaded, so a hit only resets the collectibles.
+    """
+    def __init__(self, max_bytes=WORLD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries   = OrderedDict()   # WorldClass -> (world, nbytes)
+        self.bytes     = 0
+
+    def __contains__(self, WorldClass):
+        return WorldClass in self.entries
+
+    def get(self, WorldClass):
+        entry = self.entries.get(WorldClass)
+        if entry is not None:
+            self.entries.move_to_end(WorldClass)
+            world = entry[0]
+            world.reset()
+            return world
+        world = load_course(WorldClass)
+        self.put(WorldClass, world)
+        return world
+
+    def put(self, WorldClass, world):
+        if WorldClass in self.entries:
+            old, old_size = self.entries.pop(WorldClass)
+            self.bytes -= old_size
+            if old is not world:
+                old.close()
+        size = world.nbytes()
+        self.entries[WorldClass] = (world, size)
+        self.bytes += size
+        # Always keep the newest course, even if it alone exceeds the cap
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (old, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            old.close()
+
+class CoursePreloader:
+    """Loads courses on a daemon thread so the main loop never builds a world itself.
+
+    The main thread asks for a course with request(), polls status() for the
+    loading screen and collects finished worlds with drain().
+    """
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.wake     = threading.Condition(self.lock)
+        self.pending  = None   # next course to load (latest request wins)
+        self.current  = None   # course the worker is loading right now
+        self.progress = {}     # WorldClass -> (fraction, label)
+        self.done     = []     # [(WorldClass, world)] waiting for drain()
+        self.error    = None
+        self.thread   = threading.Thread(target=self._run, name="course-preloader", daemon=True)
+        self.thread.start()
+
+    def request(self, WorldClass):
+        with self.lock:
+            if WorldClass is self.current or WorldClass is self.pending:
+                return
+            if any(W is WorldClass for W, _ in self.done):
+                return
+            self.pending = WorldClass
+            self.progress[WorldClass] = (0.0, "Queued")
+            self.wake.notify()
+
+    def status(self, WorldClass):
+        with self.lock:
+            return self.progress.get(WorldClass, (0.0, "Queued"))
+
+    def drain(self):
+        with self.lock:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            done, self.done = self.done, []
+        return done
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while self.pending is None:
+                    self.wake.wait()
+                WorldClass = self.current = self.pending
+                self.pending = None
+
+            def report(fraction, label, WorldClass=WorldClass):
+                with self.lock:
+                    self.progress[WorldClass] = (fraction, label)
+
+            try:
+                world = load_course(WorldClass, report)
+            except Exception as e:
+                with self.lock:
+                    self.error = e
+                    self.current = None
+                continue
+            with self.lock:
+                self.done.append((WorldClass, world))
+                self.progress.pop(WorldClass, None)
+                self.current = None
+
+# -------------------------------------------------
+# RENDER ENGINE
+# -------------------------------------------------
+render_stats   = {}   # per-frame counters shown by the debug overlay
+render_options = {"silhouette_only": False}
+
+FAR_PLANE      = 3000.0   # default draw distance
+FOG_START      = 0.6      # fraction of the far plane where fog begins
+FOG_STEPS      = 16
+
+class Fog:
+    """Far-plane cull distance plus a precomputed base->sky colour ramp per palette entry."""
+    def __init__(self, far, start, sky_color, palette):
+        self.far   = far
+        self.start = start
+        self.sky   = sky_color
+        self.ramps = [self._ramp(c) for c in palette]
+        self._extra = {}   # ramps for dynamic-entity colours, built on first use
+
+    def _ramp(self, color):
+        return [lerp_color(color, self.sky, k / (FOG_STEPS - 1)) for k in range(FOG_STEPS)]
+
+    def step(self, depth):
+        if depth <= self.start:
+            return 0
+        t = (depth - self.start) / max(self.far - self.start, 1.0)
+        return min(FOG_STEPS - 1, int(t * (FOG_STEPS - 1)))
+
+    def blend(self, color, depth):
+        k = self.step(depth)
+        if k == 0:
+            return color
+        ramp = self._extra.get(color)
+        if ramp is None:
+            ramp = self._extra[color] = self._ramp(color)
+        return ramp[k]
+
+def world_fog(world):
+    if world.fog is None or world.fog.sky != world.sky_color:
+        world.fog = Fog(world.far_plane, world.far_plane * world.fog_start,
+                        world.sky_color, world.mesh.colors)
+    return world.fog
+
+OVERDRAW_SCALE = 4   # screen pixels per count-buffer cell along each axis
+OVERDRAW_COLORS = [(0, 0, 0), (40, 60, 200), (40, 170, 90), (220, 220, 40), (240, 140, 30), (220, 40, 40)]
+
+class OverdrawCounter:
+    """Counts how many filled polygons cover each pixel (F6), sampled at cell centres.
+
+    draw_outlines() feeds every polygon it fills through raster_convex into
+    the count buffer; finish() records the frame's average fills per screen
+    pixel, per drawn (non-sky) pixel and the maximum, and draw() tints the
+    screen with a heatmap.
+    """
+    def __init__(self, scale=OVERDRAW_SCALE):
+        self.enabled = False
+        self.scale   = scale
+        self.counts  = np.zeros((HEIGHT // scale, WIDTH // scale), dtype=np.int32)
+        self.average = 0.0
+        self.drawn_average = 0.0
+        self.maximum = 0
+        self.lut     = np.array(OVERDRAW_COLORS, dtype=np.uint8)
+
+    def begin(self):
+        self.counts.fill(0)
+
+    def add(self, pts):
+        inv = 1.0 / self.scale
+        hit = raster_convex([(x * inv, y * inv) for x, y in pts], self.counts.shape[1], self.counts.shape[0],
+                            conservative=False)
+        if hit is not None:
+            y0, x0, mask = hit
+            self.counts[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]] += mask
+
+    def finish(self):
+        total = int(self.counts.sum())
+        self.average = total / self.counts.size
+        self.drawn_average = total / max(int(np.count_nonzero(self.counts)), 1)
+        self.maximum = int(self.counts.max())
+        render_stats["overdraw_avg"] = self.average
+        render_stats["overdraw_drawn"] = self.drawn_average
+        render_stats["overdraw_max"] = self.maximum
+
+    def draw(self, screen):
+        rgb = self.lut[np.minimum(self.counts, len(self.lut) - 1)]
+        heat = pygame.transform.scale(pygame.surfarray.make_surface(rgb.transpose(1, 0, 2)), (WIDTH, HEIGHT))
+        heat.set_alpha(170)
+        screen.blit(heat, (0, 0))
+        x = 12
+        for k, color in enumerate(OVERDRAW_COLORS[1:], 1):
+            pygame.draw.rect(screen, color, (x, HEIGHT - 52, 22, 14))
+            label = small_font.render(f"{k}+" if k == len(OVERDRAW_COLORS) - 1 else str(k), True, WHITE)
+            screen.blit(label, (x + 26, HEIGHT - 53))
+            x += 56
+        txt = small_font.render(f"overdraw avg {self.average:.2f}  per drawn pixel {self.drawn_average:.2f}"
+                                f"  max {self.maximum}", True, WHITE)
+        screen.blit(txt, (x + 8, HEIGHT - 53))
+
+overdraw = OverdrawCounter()
+
+ALLOC_TOP_SITES = 8   # call sites listed by AllocationTracker.report()
+
+class AllocationTracker:
+    """Per-frame tracemalloc accounting (F7, --alloc-bench): peak bytes, plus bytes live at
+    each checkpoint() charged to the innermost line of this module that allocated them."""
+    def __init__(self, depth=8):
+        self.enabled = False
+        self.tracing = False
+        self.depth   = depth
+        self.own     = None   # (filename, line range) of this class, looked up on first begin()
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.sites  = {}            # (filename, lineno) -> [blocks, bytes] summed over frames
+        self.total  = [0, 0]        # blocks, bytes summed over frames
+        self.held   = 0             # bytes still live at end() summed over frames
+        self.peak   = 0             # traced peak summed over frames
+        self.last   = (0, 0, 0, 0)  # blocks, bytes, held, peak of the latest frame
+
+    def begin(self):
+        if not self.enabled or self.tracing:
+            return
+        if self.own is None:
+            try:
+                lines, first = inspect.getsourcelines(type(self))
+            except (OSError, TypeError):   # no source, e.g. a frozen or .pyc-only build
+                lines, first = [], 0
+            self.own = (type(self).__init__.__code__.co_filename, range(first, first + len(lines)))
+        self.frame = {}
+        self.frame_peak = 0
+        self.tracing = True
+        tracemalloc.start(self.depth)
+
+    def _note_peak(self):
+        # Read before each snapshot and reset after it, so snapshots never count toward the peak
+        self.frame_peak = max(self.frame_peak, tracemalloc.get_traced_memory()[1])
+
+    def _live(self):
+        filename, own = self.own
+        live = {}
+        for stat in tracemalloc.take_snapshot().statistics("traceback"):
+            frames = stat.traceback
+            site = frames[-1]
+            for frame in reversed(frames):
+                if frame.filename == filename:
+                    site = frame
                     break
-                pts.append((res[0], res[1]))
-                z_sum += res[2]
-            if visible and len(pts) >= 3:
-                render_list.append((z_sum / len(indices), pts, color))
-
-    # Mario
-    m_verts, m_faces = mario.get_mesh()
-    for indices, color in m_faces:
-        pts = []
-        z_sum = 0
-        visible = True
-        for i in indices:
-            res = project_point(*m_verts[i], cam.x, cam.y, cam.z, cam.yaw)
-            if not res:
-                visible = False
-                break
-            pts.append((res[0], res[1]))
-            z_sum += res[2]
-        if visible and len(pts) >= 3:
-            render_list.append((z_sum / len(indices), pts, color))
-
-    # Painter's algorithm
-    render_list.sort(key=lambda x: x[0], reverse=True)
-    for _, pts, color in render_list:
+            if site.filename == filename and site.lineno in own:
+                continue   # the tracker's own bookkeeping, snapshots included
+            entry = live.setdefault((site.filename, site.lineno), [0, 0])
+            entry[0] += stat.count
+            entry[1] += stat.size
+        for site, (count, size) in live.items():
+            yield site, count, size
+
+    def checkpoint(self):
+        if not self.tracing:
+            return
+        self._note_peak()
+        frame = self.frame
+        for site, count, size in self._live():
+            seen = frame.get(site)
+            if seen is None or size > seen[1]:
+                frame[site] = (count, size)
+        tracemalloc.reset_peak()
+
+    def end(self):
+        if not self.tracing:
+            return
+        self._note_peak()
+        peak = self.frame_peak
+        held = sum(size for _, _, size in self._live())
+        tracemalloc.stop()
+        self.tracing = False
+        blocks = size = 0
+        for site, (count, nbytes) in self.frame.items():
+            entry = self.sites.setdefault(site, [0, 0])
+            entry[0] += count
+            entry[1] += nbytes
+            blocks += count
+            size += nbytes
+        self.frames += 1
+        self.total[0] += blocks
+        self.total[1] += size
+        self.held += held
+        self.peak += peak
+        self.last = (blocks, size, held, peak)
+        render_stats["alloc"] = self.last
+
+    def report(self, top=ALLOC_TOP_SITES):
+        """Per-frame averages and the `top` call sites by bytes, as printable lines."""
+        n = max(self.frames, 1)
+        lines = [f"{self.frames} frames: {self.total[0] / n:.0f} blocks  {self.total[1] / n / 1024:.1f} KB"
+                 f" per frame  held {self.held / n / 1024:.1f} KB  peak {self.peak / n / 1024:.1f} KB"]
+        ranked = sorted(self.sites.items(), key=lambda item: item[1][1], reverse=True)
+        for (filename, lineno), (count, size) in ranked[:top]:
+            source = linecache.getline(filename, lineno).strip()
+            lines.append(f"{size / n / 1024:7.2f} KB {count / n:6.0f} blocks  "
+                         f"{os.path.basename(filename)}:{lineno}  {source[:60]}")
+        return lines
+
+alloc_tracker = AllocationTracker()
+
+def draw_outlines(screen, mesh, render_list, cam):
+    """Fill and outline faces in painter's order; with silhouette_only (F5) static
+    faces only stroke silhouette edges, each once, with the last face that uses it.
+
+    Stroking every edge is the default: skipping shared edges removed only about a
+    quarter of them, and the per-face bookkeeping cost more than the lines it saved.
+    """
+    counting = overdraw.enabled
+    if not render_options["silhouette_only"]:
+        edges_drawn = 0
+        for _, pts, color, _ in render_list:
+            pygame.draw.polygon(screen, color, pts)
+            pygame.draw.polygon(screen, BLACK, pts, 1)
+            if counting:
+                overdraw.add(pts)
+            edges_drawn += len(pts)
+        render_stats["edges_drawn"] = edges_drawn
+        alloc_tracker.checkpoint()
+        return
+
+    order = [p for p, item in enumerate(render_list) if item[3] is not None]
+    due = iter(())
+    edges_drawn = 0
+    if order:
+        pos = np.array(order, dtype=np.int64)
+        faces = np.array([render_list[p][3] for p in order], dtype=np.int64)
+        fe = mesh.face_edges[faces]
+        valid = fe >= 0
+        owner = np.full(len(mesh.edges), -1, dtype=np.int64)
+        np.maximum.at(owner, fe[valid], np.broadcast_to(pos[:, None], fe.shape)[valid])
+        stroke = valid & (owner[np.where(valid, fe, 0)] == pos[:, None])
+        planes = mesh.face_planes
+        front = planes[:, :3] @ np.array((cam.x, cam.y, cam.z), dtype=np.float32) + planes[:, 3] > 0
+        ef = mesh.edge_faces[np.where(valid, fe, 0)]
+        drawn = np.zeros(mesh.face_count(), dtype=bool)
+        drawn[faces] = True
+        # Silhouette: the other face is missing, undrawn or turned the other way
+        lone = (ef[..., 0] == ef[..., 1]) | ~drawn[ef[..., 0]] | ~drawn[ef[..., 1]]
+        stroke &= lone | (front[ef[..., 0]] != front[ef[..., 1]])
+        # One bitmask per static face in painter's order, bit k set when edge k is due
+        due = iter((stroke.astype(np.int64) << np.arange(stroke.shape[1])).sum(axis=1).tolist())
+
+    for _, pts, color, face in render_list:
         pygame.draw.polygon(screen, color, pts)
-        pygame.draw.polygon(screen, BLACK, pts, 1)
+        if counting:
+            overdraw.add(pts)
+        if face is None:
+            pygame.draw.polygon(screen, BLACK, pts, 1)
+            edges_drawn += len(pts)
+            continue
+        row = next(due)
+        n = len(pts)
+        full = (1 << n) - 1
+        if row & full == full:
+            pygame.draw.lines(screen, BLACK, True, pts)
+            edges_drawn += n
+            continue
+        # Rotate so a skipped edge comes last, then emit each run of due edges
+        start = (~row & (row + 1)).bit_length()
+        run = []
+        for k in range(start, start + n):
+            k %= n
+            if row >> k & 1:
+                if not run:
+                    run.append(pts[k])
+                run.append(pts[(k + 1) % n])
+                edges_drawn += 1
+            elif run:
+                pygame.draw.lines(screen, BLACK, False, run)
+                run = []
+        if run:
+            pygame.draw.lines(screen, BLACK, False, run)
+    render_stats["edges_drawn"] = edges_drawn
+    alloc_tracker.checkpoint()
+
+def project_vertices(positions, cam, fov=700):
+    """Vectorised project_point over a (V, 3) array -> (sx, sy, rz, in_front)."""
+    dx = positions[:, 0] - cam.x
+    dy = positions[:, 1] - cam.y
+    dz = positions[:, 2] - cam.z
+    cos_a = math.cos(-cam.yaw)
+    sin_a = math.sin(-cam.yaw)
+    rx = dx * cos_a - dz * sin_a
+    rz = dx * sin_a + dz * cos_a
+    in_front = rz > 10
+    scale = fov / np.where(in_front, rz, 1.0)
+    sx = (rx * scale + SCREEN_CENTER[0]).astype(np.int32)
+    sy = (-dy * scale + SCREEN_CENTER[1]).astype(np.int32)
+    return sx, sy, rz, in_front
+
+_BOX_CORNER_BITS = np.array([(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0),
+                             (0, 0, 1), (1, 0, 1), (1, 1, 1), (0, 1, 1)], dtype=np.float64)
+_BOX_QUAD_ARRAY = np.array(_BOX_QUADS)
+
+def project_boxes(lo, ext, shades, cam, fog=None, lod_pixels=None):
+    """Project axis-aligned boxes in one pass -> [(anchor, items)] for painter_order.
+
+    lo and ext are (B, 3) min corners and sizes, shades a per-box list of six
+    face colours. Off-screen boxes are dropped; with lod_pixels, boxes smaller
+    than that on screen collapse to their screen-space bounding quad.
+    """
+    corners = lo[:, None, :] + _BOX_CORNER_BITS[None, :, :] * ext[:, None, :]
+    sx, sy, rz, in_front = project_vertices(corners.reshape(-1, 3), cam)
+    sx, sy, rz = sx.reshape(-1, 8), sy.reshape(-1, 8), rz.reshape(-1, 8)
+    ok = in_front.reshape(-1, 8).all(axis=1)
+    if fog is not None:
+        ok &= rz.min(axis=1) <= fog.far
+    hi = lo + ext
+    facing = np.stack([cam.z < lo[:, 2], cam.z > hi[:, 2], cam.x < lo[:, 0], cam.x > hi[:, 0],
+                       cam.y > hi[:, 1], cam.y < lo[:, 1]], axis=1)
+    depth = rz[:, _BOX_QUAD_ARRAY].mean(axis=2)
+    x0, x1, y0, y1 = sx.min(axis=1), sx.max(axis=1), sy.min(axis=1), sy.max(axis=1)
+    ok &= (x1 >= 0) & (x0 < WIDTH) & (y1 >= 0) & (y0 < HEIGHT)
+    if lod_pixels is not None:
+        far = ext.max(axis=1) * 700 / np.maximum(rz.min(axis=1), 1.0) < lod_pixels
+    else:
+        far = np.zeros(len(lo), dtype=bool)
+    # Everything the loop reads is converted to lists once, for the kept boxes only
+    keep = np.nonzero(ok)[0]
+    x0, x1, y0, y1 = x0[keep].tolist(), x1[keep].tolist(), y0[keep].tolist(), y1[keep].tolist()
+    anchors = ((lo[keep] + hi[keep]) * 0.5).tolist()
+    depth = depth[keep]
+    means = depth.mean(axis=1).tolist()
+    fog_start = fog.start if fog is not None else math.inf
+
+    out = []
+    for j, (a, is_far, front, d_quad, xs, ys) in enumerate(zip(
+            keep.tolist(), far[keep].tolist(), facing[keep].tolist(), depth.tolist(),
+            sx[keep].tolist(), sy[keep].tolist())):
+        colors = shades[a]
+        if is_far:
+            d = means[j]
+            color = colors[0] if d <= fog_start else fog.blend(colors[0], d)
+            out.append((tuple(anchors[j]), [(d, [(x0[j], y0[j]), (x1[j], y0[j]), (x1[j], y1[j]), (x0[j], y1[j])],
+                                             color, None)]))
+            continue
+        items = []
+        for q in range(6):
+            if front[q]:
+                d = d_quad[q]
+                color = colors[q] if d <= fog_start else fog.blend(colors[q], d)
+                items.append((d, [(xs[i], ys[i]) for i in _BOX_QUADS[q]], color, None))
+        out.append((tuple(anchors[j]), items))
+    return out
+
+def project_scene(scene, cam, fog=None):
+    """Front faces of every scene-graph mesh from its cached world vertices -> [(anchor, items)]."""
+    out = []
+    cam_pos = np.array((cam.x, cam.y, cam.z))
+    for node in scene.drawable:
+        wv = node.world_verts
+        sx, sy, rz, in_front = project_vertices(wv, cam)
+        if not in_front.all():
+            continue
+        if fog is not None and rz.min() > fog.far:
+            continue
+        xs, ys, zs = sx.tolist(), sy.tolist(), rz.tolist()
+        facing = (np.einsum("ij,ij->i", node.world_normals, cam_pos - wv[node.face_first]) > 0).tolist()
+        items = []
+        for (indices, color), front in zip(node.faces, facing):
+            if not front:
+                continue
+            d = sum(zs[i] for i in indices) / len(indices)
+            if fog is not None:
+                color = fog.blend(color, d)
+            items.append((d, [(xs[i], ys[i]) for i in indices], color, None))
+        out.append((tuple(wv.mean(axis=0).tolist()), items))
+    return out
+
+def project_enemies(enemies, cam, fog, shades):
+    """Live enemies as boxes; shades are per kind (EnemyStore.face_colors)."""
+    n = enemies.count
+    live = np.nonzero(~enemies.collected[:n])[0]
+    if len(live) == 0:
+        return []
+    size = enemies.size[live]
+    height = np.where(enemies.squash[live] > 0, size * 0.3, size)
+    lo = enemies.pos[live] - np.stack([size * 0.5, np.zeros_like(size), size * 0.5], axis=1)
+    ext = np.stack([size, height, size], axis=1)
+    kinds = enemies.kind[live].tolist()
+    return project_boxes(lo, ext, [shades[k] for k in kinds], cam, fog, ENEMY_LOD_PIXELS)
+
+def project_static_faces(mesh, cam, face_mask=None, fog=None):
+    """Project the course mesh; returns {face: (depth, pts, color, face)} for visible faces.
+
+    face_mask, if given, is a boolean array over faces (PVS, portals, ...).
+    fog, if given, culls faces past its far plane and fades the rest into the sky.
+    """
+    sx, sy, rz, in_front = project_vertices(mesh.positions, cam)
+    fv = mesh.face_verts
+    pad = fv < 0
+    fv_safe = np.where(pad, 0, fv)
+    visible = np.all(in_front[fv_safe] | pad, axis=1) & (mesh.face_size >= 3)
+    if face_mask is not None:
+        visible &= face_mask
+    depth = np.where(pad, 0.0, rz[fv_safe]).sum(axis=1) / np.maximum(mesh.face_size, 1)
+    if fog is not None:
+        nearest = np.where(pad, np.inf, rz[fv_safe]).min(axis=1)
+        visible &= nearest <= fog.far
+        render_stats["faces_far"] = int((nearest > fog.far).sum())
+
+    faces = np.nonzero(visible)[0]
+    # One point tuple per vertex, shared by every face corner that uses it
+    pv = list(zip(sx.tolist(), sy.tolist()))
+    colors = mesh.colors
+    if fog is not None:
+        t = (depth[faces] - fog.start) / max(fog.far - fog.start, 1.0)
+        steps = np.clip(t * (FOG_STEPS - 1), 0, FOG_STEPS - 1).astype(np.int32).tolist()
+        ramps = fog.ramps
+    else:
+        steps = [0] * len(faces)
+        ramps = [[c] for c in colors]
+    out = {}
+    for f, d, row, n, c, k in zip(faces.tolist(), depth[faces].tolist(), fv[faces].tolist(),
+                                  mesh.face_size[faces].tolist(), mesh.face_color[faces].tolist(), steps):
+        out[f] = (d, [pv[i] for i in row[:n]], ramps[c][k], f)
+    return out
+
+def project_mesh(verts, faces, cam, fog=None):
+    """Project a small dynamic mesh (Mario, collectibles) -> [(depth, pts, color, None)].
+
+    Each vertex is projected once, as project_point() would, and its point tuple is
+    shared by the faces that use it.
+    """
+    cos_a = math.cos(-cam.yaw)
+    sin_a = math.sin(-cam.yaw)
+    cx, cy = SCREEN_CENTER
+    points, zs = [], []
+    for x, y, z in verts:
+        dx = x - cam.x
+        dz = z - cam.z
+        rz = dx * sin_a + dz * cos_a
+        zs.append(rz)
+        if rz <= 10:
+            points.append(None)
+            continue
+        scale = 700 / rz
+        points.append((int((dx * cos_a - dz * sin_a) * scale + cx), int(-(y - cam.y) * scale + cy)))
+    out = []
+    for indices, color in faces:
+        pts = [points[i] for i in indices]
+        if len(pts) < 3 or None in pts:
+            continue
+        depth = sum(zs[i] for i in indices) / len(indices)
+        if fog is not None:
+            if depth > fog.far:
+                continue
+            color = fog.blend(color, depth)
+        out.append((depth, pts, color, None))
+    return out
+
+def render_world(screen, world, mario, cam):
+    screen.fill(world.sky_color)
+    if overdraw.enabled:
+        overdraw.begin()
+    if world.mesh is None:
+        world.mesh = world.builder.to_course_mesh()
+
+    # World geometry, limited to what the PVS sees from the camera's and Mario's cells when
+    # the course has one. The camera orbits above and outside enclosed courses, where its own
+    # cell can sit inside a ceiling, so Mario's cell is always included.
+    face_mask = None
+    if world.pvs is not None:
+        cells = [cell for cell in (world.pvs.cell_of(cam.x, cam.y, cam.z),
+                                   world.pvs.cell_of(mario.x, mario.y + mario.size, mario.z))
+                 if cell is not None]
+        if cells:
+            face_mask = world.pvs.visible_objects(*cells)[world.mesh.face_object]
+    # Rooms reachable through on-screen portals
+    if world.room_graph is not None:
+        room_mask = world.room_graph.face_mask(cam)
+        if room_mask is not None:
+            face_mask = room_mask if face_mask is None else face_mask & room_mask
+    # Objects hidden behind the nearest big boxes (F4)
+    mesh = world.mesh
+    considered = mesh.face_count() if face_mask is None else int(face_mask.sum())
+    render_stats["faces_considered"] = considered
+    render_stats["faces_occluded"] = render_stats["occluders"] = 0
+    if occlusion_culler.enabled:
+        occ_mask = occlusion_culler.visible_objects(mesh, world.solids, cam)[mesh.face_object]
+        face_mask = occ_mask if face_mask is None else face_mask & occ_mask
+        render_stats["faces_occluded"] = considered - int(face_mask.sum())
+        render_stats["occluders"] = occlusion_culler.occluders
+    fog = world_fog(world)
+    static = project_static_faces(mesh, cam, face_mask, fog)
+    render_stats["faces_static"] = len(static)
+
+    # Dynamic entities, each anchored at a point for BSP insertion
+    dynamic = []
+    for star in world.stars:
+        dynamic.append(((star.x, star.y, star.z), project_mesh(*star.get_mesh(), cam, fog)))
+    for coin in world.coins:
+        dynamic.append(((coin.x, coin.y, coin.z), project_mesh(*coin.get_mesh(), cam, fog)))
+    dynamic.extend(project_enemies(world.enemies, cam, fog, world.enemies.face_colors(world.lights, world.ambient)))
+    render_stats["scene_updates"] = world.scene.update()
+    render_stats["terrain_faces"] = 0
+    for terrain in world.terrains:
+        dynamic.extend(terrain.project(cam, fog))
+    render_stats["water_faces"] = 0
+    for water in world.waters:
+        dynamic.extend(water.project(cam, fog))
+    dynamic.extend(project_scene(world.scene, cam, fog))
+    dynamic.append(((mario.x, mario.y + mario.size, mario.z), project_mesh(*mario.get_mesh(), cam)))
+
+    # Painter's algorithm: exact static order from the BSP, else sort by depth
+    if world.bsp is not None:
+        render_list = world.bsp.painter_order(cam, static, dynamic)
+    else:
+        render_list = list(static.values())
+        for _, items in dynamic:
+            render_list.extend(items)
+        render_list.sort(key=lambda x: x[0], reverse=True)
+    render_stats["faces_drawn"] = len(render_list)
+    render_stats["stream"] = world.streamer.stats() if world.streamer is not None else None
+    render_stats["edges_naive"] = sum(len(item[1]) for item in render_list)
+    draw_outlines(screen, mesh, render_list, cam)
+    if overdraw.enabled:
+        overdraw.finish()
+        overdraw.draw(screen)
 
 
 # -------------------------------------------------
 # HUD
 # -------------------------------------------------
+TEXT_CACHE_SIZE = 64   # rendered strings kept by TextCache
+
+class TextCache:
+    """Rendered text surfaces keyed by (font, text, color); the least recently used go first."""
+    def __init__(self, size=TEXT_CACHE_SIZE):
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.surfaces[key] = font.render(text, True, color)
+        if len(self.surfaces) > self.size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+text_cache = TextCache()
+
 def draw_hud(screen, mario, world_name):
     # Background bar
     pygame.draw.rect(screen, (0, 0, 0, 128), (0, 0, WIDTH, 45))
     pygame.draw.rect(screen, (0, 0, 0), (0, 44, WIDTH, 2))
 
     # Stars
-    star_txt = star_font.render(f"★{mario.stars_collected}", True, STAR_YELLOW)
+    star_txt = text_cache.render(star_font, f"★{mario.stars_collected}", STAR_YELLOW)
     screen.blit(star_txt, (15, 2))
 
     # Coins
-    coin_txt = hud_font.render(f"×{mario.coins:03d}", True, YELLOW)
+    coin_txt = text_cache.render(hud_font, f"×{mario.coins:03d}", YELLOW)
     screen.blit(coin_txt, (120, 14))
 
     # Lives
-    life_txt = hud_font.render(f"♥{mario.lives}", True, MARIO_RED)
+    life_txt = text_cache.render(hud_font, f"♥{mario.lives}", MARIO_RED)
     screen.blit(life_txt, (220, 14))
 
     # Level name
-    name_txt = hud_font.render(world_name, True, WHITE)
+    name_txt = text_cache.render(hud_font, world_name, WHITE)
     screen.blit(name_txt, (WIDTH - name_txt.get_width() - 15, 14))
 
     # Controls (bottom)
-    ctrl = small_font.render("WASD/ARROWS: Move | SPACE: Jump | Q/E: Camera | ESC: Level Select", True, WHITE)
+    ctrl = text_cache.render(small_font, "WASD/ARROWS: Move | SPACE: Jump | Q/E: Camera | ESC: Level Select", WHITE)
     screen.blit(ctrl, (WIDTH//2 - ctrl.get_width()//2, HEIGHT - 22))
+    alloc_tracker.checkpoint()
+
+
+# -------------------------------------------------
+# GC PAUSES
+# -------------------------------------------------
+GC_PLAY_THRESHOLDS = (10000, 50, 100)   # gc.set_threshold() while a course is being played
+
+class GCManager:
+    """Keeps cyclic collections out of gameplay frames (freeze + raised thresholds while
+    a course is played) and times every pause into render_stats["gc"]."""
+    def __init__(self, thresholds=GC_PLAY_THRESHOLDS):
+        self.thresholds = thresholds
+        self.defaults   = gc.get_threshold()
+        self.playing    = False
+        self.explicit   = False
+        self.started    = None
+        self.frame      = [0, 0.0]   # passes, ms in the current frame
+        self.collections = 0
+        self.total_ms   = 0.0
+        self.worst_ms   = 0.0
+        gc.callbacks.append(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self.started = time.perf_counter()
+            return
+        if self.started is None:
+            return
+        ms = (time.perf_counter() - self.started) * 1000
+        self.started = None
+        self.frame[0] += 1
+        self.frame[1] += ms
+        self.collections += 1
+        self.total_ms += ms
+        if self.playing and not self.explicit:
+            self.worst_ms = max(self.worst_ms, ms)
+
+    def start_play(self):
+        if self.playing:
+            return
+        self.collect()
+        gc.freeze()
+        gc.set_threshold(*self.thresholds)
+        self.playing = True
+
+    def collect(self):
+        self.explicit = True
+        try:
+            gc.collect()
+        finally:
+            self.explicit = False
+
+    def stop_play(self):
+        if not self.playing:
+            return
+        gc.unfreeze()
+        gc.set_threshold(*self.defaults)
+        self.playing = False
+        self.collect()
+
+    def end_frame(self):
+        render_stats["gc"] = (self.frame[0], self.frame[1])
+        self.frame[0] = 0
+        self.frame[1] = 0.0
+
+gc_manager = GCManager()
+
+
+# -------------------------------------------------
+# SPIKE PROFILER
+# -------------------------------------------------
+SPIKE_SAMPLE_INTERVAL = 0.001   # seconds between samples of the main thread's stack
+SPIKE_TOP_CALLS       = 8       # loop calls listed by SpikeProfiler.stop()
+
+class SpikeProfiler:
+    """Samples the main thread's stack, keeping only frames over budget, and writes them
+    as folded stacks (--profile-spikes)."""
+    def __init__(self, budget_ms=1000 / FPS, interval=SPIKE_SAMPLE_INTERVAL):
+        self.budget_ms = budget_ms
+        self.interval  = interval
+        self.running   = False
+        self.path      = None
+        self.thread    = None
+        self.loop      = None       # code object of the frame loop
+        self.current   = None       # samples of the frame in progress
+        self.started   = 0.0
+        self.stacks    = {}         # (codes root first, loop line) -> samples from frames over budget
+        self.frames    = 0
+        self.spikes    = []         # duration of each frame over budget, ms
+
+    def start(self, path):
+        self.path = path
+        self.switch = sys.getswitchinterval()
+        sys.setswitchinterval(self.interval)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="spike-profiler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        main_id = threading.main_thread().ident
+        while self.running:
+            time.sleep(self.interval)
+            samples, loop = self.current, self.loop
+            if samples is None:
+                continue
+            frame = sys._current_frames().get(main_id)
+            codes = []
+            line = 0
+            while frame is not None:
+                codes.append(frame.f_code)
+                if frame.f_code is loop:
+                    line = frame.f_lineno
+                frame = frame.f_back
+            codes.reverse()
+            samples.append((tuple(codes), line))
+
+    def begin_frame(self):
+        if not self.running:
+            return
+        if self.loop is None:
+            self.loop = sys._getframe(1).f_code
+        self.current = []
+        self.started = time.perf_counter()
+
+    def end_frame(self):
+        samples, self.current = self.current, None
+        if samples is None:
+            return
+        ms = (time.perf_counter() - self.started) * 1000
+        self.frames += 1
+        if ms <= self.budget_ms:
+            return
+        self.spikes.append(ms)
+        for sample in samples:
+            self.stacks[sample] = self.stacks.get(sample, 0) + 1
+
+    def _name(self, code):
+        name = getattr(code, "co_qualname", code.co_name)
+        if code.co_filename == self.loop.co_filename:
+            return name
+        return f"{os.path.basename(code.co_filename)}:{name}"
+
+    def stop(self):
+        """Stop sampling, write the folded stacks and print the per-call summary."""
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        sys.setswitchinterval(self.switch)
+        folded, calls = {}, {}
+        for (codes, line), count in self.stacks.items():
+            stack = ";".join(self._name(code) for code in codes)
+            folded[stack] = folded.get(stack, 0) + count
+            # Attribute the sample to the loop's callee, or to the loop line itself (C calls such as flip)
+            k = codes.index(self.loop) + 1 if self.loop in codes else len(codes)
+            if k < len(codes):
+                call = self._name(codes[k])
+            else:
+                call = f"{self.loop.co_name}:{line}  {linecache.getline(self.loop.co_filename, line).strip()}"
+            calls[call] = calls.get(call, 0) + count
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(folded.items()):
+                f.write(f"{stack} {count}\n")
+        total = sum(calls.values())
+        worst = max(self.spikes, default=0.0)
+        print(f"{len(self.spikes)} of {self.frames} frames over {self.budget_ms:.1f} ms (worst {worst:.1f} ms), "
+              f"{total} samples written to {self.path}")
+        for call, count in sorted(calls.items(), key=lambda item: item[1], reverse=True)[:SPIKE_TOP_CALLS]:
+            print(f"{100 * count / total:6.1f}%  {call}")
+
+spike_profiler = SpikeProfiler()
+
+
+# -------------------------------------------------
+# DEBUG OVERLAY (F3)
+# -------------------------------------------------
+class DebugOverlay:
+    def __init__(self):
+        self.enabled = False
+
+    def draw(self, screen, fps):
+        if not self.enabled:
+            return
+        considered = render_stats.get("faces_considered", 0)
+        occluded = render_stats.get("faces_occluded", 0)
+        lines = [
+            f"FPS {fps:5.1f}",
+            f"faces drawn {render_stats.get('faces_drawn', 0)}  past far plane {render_stats.get('faces_far', 0)}"
+            f"  terrain {render_stats.get('terrain_faces', 0)}  water {render_stats.get('water_faces', 0)}",
+            f"edges {render_stats.get('edges_drawn', 0)}/{render_stats.get('edges_naive', 0)}"
+            + ("  silhouette [F5]" if render_options["silhouette_only"] else ""),
+            f"occluded {occluded}/{considered} ({100 * occluded / max(considered, 1):.0f}%)"
+            f"  occluders {render_stats.get('occluders', 0)}"
+            + ("" if occlusion_culler.enabled else " [off, F4]"),
+            f"entities awake {render_stats.get('entities_awake', 0)}  asleep {render_stats.get('entities_asleep', 0)}",
+        ]
+        if overdraw.enabled:
+            lines.append(f"overdraw avg {render_stats.get('overdraw_avg', 0.0):.2f}"
+                         f"  per drawn pixel {render_stats.get('overdraw_drawn', 0.0):.2f}"
+                         f"  max {render_stats.get('overdraw_max', 0)} [F6]")
+        stream = render_stats.get("stream")
+        if stream is not None:
+            chunks, used, budget, pending, loads, evictions = stream
+            lines.append(f"chunks {chunks} ({used // 1024} / {budget // 1024} KB)  pending {pending}"
+                         f"  loaded {loads}  evicted {evictions}")
+        passes, pause = render_stats.get("gc", (0, 0.0))
+        lines.append(f"gc {passes} pauses {pause:.2f} ms  worst {gc_manager.worst_ms:.2f} ms"
+                     f"  total {gc_manager.collections}  frozen {gc.get_freeze_count()}")
+        if alloc_tracker.enabled:
+            blocks, size, held, peak = render_stats.get("alloc", (0, 0, 0, 0))
+            lines.append(f"alloc {blocks} blocks {size / 1024:.1f} KB  held {held / 1024:.1f} KB"
+                         f"  peak {peak / 1024:.1f} KB [F7]")
+        y = 52
+        for line in lines:
+            txt = small_font.render(line, True, WHITE)
+            bg = pygame.Rect(8, y - 1, txt.get_width() + 6, txt.get_height() + 2)
+            pygame.draw.rect(screen, BLACK, bg)
+            screen.blit(txt, (11, y))
+            y += txt.get_height() + 4
+        alloc_tracker.checkpoint()
+
+debug_overlay = DebugOverlay()
 
 
 # -------------------------------------------------
@@ -1559,10 +5084,48 @@ class LevelSelectScene:
         screen.blit(ctrl, ctrl.get_rect(center=(WIDTH // 2, HEIGHT - 20)))
 
 
+# -------------------------------------------------
+# LOADING SCENE
+# -------------------------------------------------
+class LoadingScene:
+    def __init__(self, course_name):
+        self.course_name = course_name
+        self.timer = 0
+
+    def update(self):
+        self.timer += 1
+
+    def draw(self, screen, fraction, label):
+        screen.fill((20, 15, 40))
+        title = select_font.render(self.course_name, True, WHITE)
+        screen.blit(title, title.get_rect(center=(WIDTH // 2, HEIGHT // 2 - 50)))
+
+        # Progress bar
+        bar = pygame.Rect(0, 0, 400, 22)
+        bar.center = (WIDTH // 2, HEIGHT // 2)
+        pygame.draw.rect(screen, (50, 45, 80), bar)
+        fill = bar.copy()
+        fill.width = int(bar.width * max(0.0, min(1.0, fraction)))
+        pygame.draw.rect(screen, STAR_YELLOW, fill)
+        pygame.draw.rect(screen, WHITE, bar, 2)
+
+        # Spinning star so a stalled stage is still visibly alive
+        for k in range(5):
+            a = math.radians(k * 72 + self.timer * 6)
+            pygame.draw.circle(screen, STAR_YELLOW,
+                               (int(WIDTH // 2 + math.cos(a) * 14), int(HEIGHT // 2 + 50 + math.sin(a) * 14)), 3)
+
+        dots = "." * (1 + (self.timer // 15) % 3)
+        txt = small_font.render(f"{label}{dots}", True, (180, 180, 180))
+        screen.blit(txt, txt.get_rect(center=(WIDTH // 2, HEIGHT // 2 + 85)))
+
+
 # -------------------------------------------------
 # STAR GET SCENE
 # -------------------------------------------------
 class StarGetScene:
+    overlay = None   # shared full-screen fade, created on first use
+
     def __init__(self):
         self.timer = 0
 
@@ -1570,8 +5133,10 @@ class StarGetScene:
         self.timer += 1
 
     def draw(self, screen, total_stars):
-        overlay = pygame.Surface((WIDTH, HEIGHT))
-        overlay.fill(BLACK)
+        overlay = StarGetScene.overlay
+        if overlay is None:
+            overlay = StarGetScene.overlay = pygame.Surface((WIDTH, HEIGHT))
+            overlay.fill(BLACK)
         overlay.set_alpha(min(self.timer * 4, 180))
         screen.blit(overlay, (0, 0))
 
@@ -1585,15 +5150,16 @@ class StarGetScene:
                 sy = HEIGHT // 2 - 30 + math.sin(a) * (star_size * 2 + 20) + bob
                 pygame.draw.circle(screen, STAR_YELLOW, (int(sx), int(sy)), max(3, star_size // 3))
 
-            txt = star_font.render("★ STAR GET! ★", True, STAR_YELLOW)
+            txt = text_cache.render(star_font, "★ STAR GET! ★", STAR_YELLOW)
             screen.blit(txt, txt.get_rect(center=(WIDTH // 2, HEIGHT // 2 - 30)))
 
-            count = menu_font.render(f"Total: {total_stars}", True, WHITE)
+            count = text_cache.render(menu_font, f"Total: {total_stars}", WHITE)
             screen.blit(count, count.get_rect(center=(WIDTH // 2, HEIGHT // 2 + 30)))
 
         if self.timer > 120:
-            prompt = small_font.render("Press SPACE to continue", True, WHITE)
+            prompt = text_cache.render(small_font, "Press SPACE to continue", WHITE)
             screen.blit(prompt, prompt.get_rect(center=(WIDTH // 2, HEIGHT // 2 + 80)))
+        alloc_tracker.checkpoint()
 
 
 # -------------------------------------------------
@@ -1609,11 +5175,16 @@ def main():
     mario       = None
     cam         = None
     world       = None
+    world_cache = WorldCache()
+    preloader   = CoursePreloader()
+    loading_scene  = None
+    pending_course = None
     total_stars = 0
 
     running = True
     while running:
         dt = clock.tick(FPS)
+        spike_profiler.begin_frame()
         keys = pygame.key.get_pressed()
         events = pygame.event.get()
 
@@ -1621,6 +5192,10 @@ def main():
             if event.type == pygame.QUIT:
                 running = False
 
+        # Hand background-loaded courses over to the cache
+        for WorldClass, loaded in preloader.drain():
+            world_cache.put(WorldClass, loaded)
+
         # ---- STATE MACHINE ----
         if state == STATE_MENU:
             menu_scene.update()
@@ -1642,38 +5217,62 @@ def main():
             level_sel.total_stars = total_stars
             choice = level_sel.update(events)
             level_sel.draw(screen)
+            # Build whatever is under the cursor while the player browses
+            _, hovered, _, _ = COURSE_LIST[level_sel.cursor]
+            if hovered not in world_cache:
+                preloader.request(hovered)
             if choice is not None:
-                _, WorldClass, _, _ = COURSE_LIST[choice]
-                world = WorldClass()
+                name, WorldClass, _, _ = COURSE_LIST[choice]
+                if WorldClass in world_cache:
+                    world = world_cache.get(WorldClass)
+                    mario = Mario(*world.spawn)
+                    cam = Camera(mario)
+                    gc_manager.start_play()
+                    state = STATE_PLAYING
+                else:
+                    pending_course = WorldClass
+                    loading_scene = LoadingScene(name)
+                    state = STATE_LOADING
+            for event in events:
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    state = STATE_MENU
+
+        elif state == STATE_LOADING:
+            if pending_course in world_cache:
+                world = world_cache.get(pending_course)
                 mario = Mario(*world.spawn)
                 cam = Camera(mario)
+                gc_manager.start_play()
                 state = STATE_PLAYING
+            else:
+                preloader.request(pending_course)
+                loading_scene.update()
+                loading_scene.draw(screen, *preloader.status(pending_course))
             for event in events:
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                    state = STATE_MENU
+                    state = STATE_LEVEL_SEL
 
         elif state == STATE_PLAYING:
-            result = mario.update(keys, cam.yaw, world.platforms)
+            alloc_tracker.begin()
+            result = mario.update(keys, cam.yaw, world.collision)
             cam.update(keys)
 
-            # Check star collection
-            got_star = False
-            for star in world.stars:
-                if star.check(mario):
-                    total_stars += 1
-                    got_star = True
-            for coin in world.coins:
-                coin.check(mario)
+            # Entities near Mario or the camera, then star/coin collection
+            got_star = simulate_world(world, mario, cam)
+            total_stars += got_star
 
             render_world(screen, world, mario, cam)
             draw_hud(screen, mario, world.name)
+            debug_overlay.draw(screen, clock.get_fps())
 
             if got_star:
                 star_scene = StarGetScene()
+                gc_manager.collect()   # hidden by the fade
                 state = STATE_STAR_GET
 
             if result == "death":
                 if mario.lives <= 0:
+                    gc_manager.stop_play()
                     state = STATE_MENU
                     total_stars = 0
                 else:
@@ -1681,11 +5280,28 @@ def main():
 
             for event in events:
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                    gc_manager.stop_play()
                     level_sel = LevelSelectScene(total_stars)
                     state = STATE_LEVEL_SEL
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    debug_overlay.enabled = not debug_overlay.enabled
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                    occlusion_culler.enabled = not occlusion_culler.enabled
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+                    render_options["silhouette_only"] = not render_options["silhouette_only"]
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F6:
+                    overdraw.enabled = not overdraw.enabled
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F7:
+                    alloc_tracker.enabled = not alloc_tracker.enabled
+                    if alloc_tracker.enabled:
+                        alloc_tracker.reset()
+                    else:
+                        print("\n".join(alloc_tracker.report()))
 
         elif state == STATE_STAR_GET:
+            alloc_tracker.begin()
             # Keep rendering world behind
+            simulate_world(world, mario, cam, collect=False)
             render_world(screen, world, mario, cam)
             draw_hud(screen, mario, world.name)
             star_scene.update()
@@ -1696,10 +5312,279 @@ def main():
                         state = STATE_PLAYING
 
         pygame.display.flip()
+        alloc_tracker.end()
+        gc_manager.end_frame()
+        spike_profiler.end_frame()
 
     pygame.quit()
     sys.exit()
 
+# -------------------------------------------------
+# ENEMY STRESS TEST
+# -------------------------------------------------
+class HeldKeys:
+    """Stand-in for pygame.key.get_pressed() with a fixed set of keys held."""
+    def __init__(self, *held):
+        self.held = set(held)
+
+    def __getitem__(self, key):
+        return key in self.held
+
+def stress_enemies(count=500, frames=600):
+    """Run Bob-omb Battlefield with `count` extra enemies and check p95 frame time against the budget."""
+    world = load_course(BobOmbBattlefield)
+    rng = random.Random(1)
+    kinds = ["goomba", "goomba", "boo", "chomp"]
+    for i in range(count):
+        world.add_enemy(kinds[i % len(kinds)], rng.uniform(-1100, 1100), 0, rng.uniform(-1100, 1100),
+                        leash=rng.uniform(80, 300))
+    mario = Mario(*world.spawn)
+    cam = Camera(mario)
+    keys = HeldKeys(pygame.K_UP, pygame.K_q)   # run in a wide circle
+    times = []
+    gc_manager.start_play()
+    passes, paused = gc_manager.collections, gc_manager.total_ms
+    try:
+        for _ in range(frames):
+            pygame.event.pump()
+            start = time.perf_counter()
+            spike_profiler.begin_frame()
+            if mario.update(keys, cam.yaw, world.collision) == "death":
+                mario.respawn(*world.spawn)
+            cam.update(keys)
+            simulate_world(world, mario, cam)
+            render_world(screen, world, mario, cam)
+            pygame.display.flip()
+            spike_profiler.end_frame()
+            times.append((time.perf_counter() - start) * 1000)
+        passes, paused = gc_manager.collections - passes, gc_manager.total_ms - paused
+    finally:
+        gc_manager.stop_play()
+    budget = 1000 / FPS
+    times.sort()
+    avg = sum(times) / len(times)
+    p95 = times[int(len(times) * 0.95)]
+    over = sum(1 for t in times if t > budget)
+    print(f"{len(world.enemies)} enemies, {frames} frames: avg {avg:.2f} ms  p95 {p95:.2f} ms  "
+          f"worst {times[-1]:.2f} ms  over {budget:.1f} ms: {over}  gc {passes} pauses {paused:.2f} ms")
+    # Hold 60 FPS on 95% of frames; a low mean can hide a steady stream of dropped frames
+    ok = p95 <= budget
+    print(f"{1000 / avg:.0f} FPS average, {1000 / p95:.0f} FPS at p95: " + ("PASS" if ok else "FAIL"))
+    return ok
+
+ALLOC_BUDGET_BYTES = 64 * 1024    # traced peak a steady-state STATE_PLAYING frame may reach, averaged
+
+def alloc_bench(frames=60, warmup=30, budget=ALLOC_BUDGET_BYTES):
+    """Trace steady-state playing frames on Bob-omb Battlefield; their mean traced peak must fit `budget`."""
+    world = load_course(BobOmbBattlefield)
+    mario = Mario(*world.spawn)
+    cam = Camera(mario)
+    keys = HeldKeys(pygame.K_UP, pygame.K_q)   # run in a wide circle
+    was_enabled, alloc_tracker.enabled = alloc_tracker.enabled, False
+    try:
+        for frame in range(warmup + frames):
+            if frame == warmup:
+                alloc_tracker.enabled = True
+                alloc_tracker.reset()
+            pygame.event.pump()
+            alloc_tracker.begin()
+            if mario.update(keys, cam.yaw, world.collision) == "death":
+                mario.respawn(*world.spawn)
+            cam.update(keys)
+            simulate_world(world, mario, cam)
+            render_world(screen, world, mario, cam)
+            draw_hud(screen, mario, world.name)
+            pygame.display.flip()
+            alloc_tracker.end()
+    finally:
+        alloc_tracker.enabled = was_enabled
+    print("\n".join(alloc_tracker.report()))
+    # The peak includes temporaries freed before any checkpoint, which live bytes miss
+    average = alloc_tracker.peak / max(alloc_tracker.frames, 1)
+    print(f"{average / 1024:.1f} KB peak per frame against {budget / 1024:.1f} KB: "
+          + ("PASS" if average <= budget else "FAIL"))
+    return average <= budget
+
+# -------------------------------------------------
+# COURSE ANALYZER
+# -------------------------------------------------
+ANALYZE_VIEWS = 8   # camera yaws around the spawn point used to time projection
+
+def geometry_issues(builder):
+    """Count duplicate vertices, unused vertices, degenerate faces and duplicate faces in a MeshBuilder."""
+    weld = {}
+    remap = []
+    for v in range(builder.vertex_count()):
+        x, y, z = builder.vertex(v)
+        key = (round(x / WELD_EPS), round(y / WELD_EPS), round(z / WELD_EPS))
+        remap.append(weld.setdefault(key, len(weld)))
+    verts = VertexView(builder)
+    used, seen = set(), set()
+    degenerate = duplicate = 0
+    for f in range(builder.face_count()):
+        indices, _ = builder.face(f)
+        used.update(indices)
+        welded = [remap[i] for i in indices]
+        if len(set(welded)) < 3 or face_normal(verts, indices) == (0.0, 0.0, 0.0):
+            degenerate += 1
+            continue
+        key = frozenset(welded)
+        if key in seen:
+            duplicate += 1
+        seen.add(key)
+    return {"duplicate_verts": len(remap) - len(weld), "unused_verts": len(remap) - len(used),
+            "degenerate_faces": degenerate, "duplicate_faces": duplicate}
+
+def spawn_views(world, views=ANALYZE_VIEWS):
+    """Yield (mario, cam) with the camera settled behind Mario at the spawn, at `views` even yaws."""
+    mario = Mario(*world.spawn)
+    cam = Camera(mario)
+    for k in range(views):
+        cam.yaw = 2 * math.pi * k / views
+        cam.x = mario.x - math.sin(cam.yaw) * cam.dist
+        cam.y = mario.y + cam.height
+        cam.z = mario.z - math.cos(cam.yaw) * cam.dist
+        yield mario, cam
+
+def projection_cost(world, views=ANALYZE_VIEWS):
+    """Mean time to project the static mesh, terrain and water from the spawn, over `views` yaws."""
+    fog = world_fog(world)
+    total = faces = 0
+    for mario, cam in spawn_views(world, views):
+        start = time.perf_counter()
+        faces += len(project_static_faces(world.mesh, cam, None, fog))
+        for surface in world.terrains + world.waters:
+            faces += sum(len(items) for _, items in surface.project(cam, fog))
+        total += time.perf_counter() - start
+    return total / views * 1000, faces // views
+
+def analyze_course(index):
+    """Build COURSE_LIST[index] from scratch and measure it; runs in a worker process."""
+    name, WorldClass, _, _ = COURSE_LIST[index]
+    start = time.perf_counter()
+    if issubclass(WorldClass, StreamedCourse):
+        # Stand in with the chunks resident at spawn
+        course = WorldClass()
+        world = WorldBase()
+        world.spawn, world.lights, world.ambient = course.spawn, course.lights, course.ambient
+        world.far_plane, world.fog_start, world.sky_color = course.far_plane, course.fog_start, course.sky_color
+        world.stars = course.stars
+        for ci, cj in ChunkStreamer(course).wanted(*course.spawn):
+            course.build_chunk(world, ci, cj)
+        raw = (world.builder.vertex_count(), world.builder.face_count(), geometry_issues(world.builder))
+        optimize_world(world)
+        bake_lighting(world.builder, world.lights, world.ambient)
+        world.mesh = world.builder.to_course_mesh()
+    else:
+        raw_world = WorldClass()
+        raw = (raw_world.builder.vertex_count(), raw_world.builder.face_count(),
+               geometry_issues(raw_world.builder))
+        world = build_course(WorldClass)
+    build_ms = (time.perf_counter() - start) * 1000
+    project_ms, projected = projection_cost(world)
+    verts, faces, issues = raw
+    return dict(name=name, verts=verts, faces=faces,
+                verts_optimized=world.mesh.vertex_count(), faces_optimized=world.mesh.face_count(),
+                platforms=len(world.platforms), stars=len(world.stars), coins=len(world.coins),
+                enemies=len(world.enemies), movers=len(world.movers),
+                mesh_bytes=world.mesh.nbytes(), world_bytes=world.nbytes(),
+                build_ms=round(build_ms, 1), project_ms=round(project_ms, 3), faces_projected=projected,
+                **issues)
+
+def overdraw_report(views=ANALYZE_VIEWS):
+    """Render every course from the spawn at `views` yaws and print its overdraw."""
+    print(f"{'Course':24s} {'avg':>6s} {'drawn':>6s} {'worst avg':>14s} {'max':>5s}")
+    was_enabled, overdraw.enabled = overdraw.enabled, True
+    try:
+        for name, WorldClass, _, _ in COURSE_LIST:
+            world = load_course(WorldClass)
+            samples = []
+            for mario, cam in spawn_views(world, views):
+                render_world(screen, world, mario, cam)
+                samples.append((overdraw.average, overdraw.drawn_average, overdraw.maximum, math.degrees(cam.yaw)))
+            world.close()
+            worst = max(samples)
+            mean = sum(s[0] for s in samples) / len(samples)
+            drawn = max(s[1] for s in samples)
+            print(f"{name:24s} {mean:6.2f} {drawn:6.2f} {worst[0]:6.2f} @{worst[3]:4.0f}deg "
+                  f"{max(s[2] for s in samples):5d}")
+    finally:
+        overdraw.enabled = was_enabled
+    print(f"avg: fills per screen pixel, drawn: worst fills per non-sky pixel, "
+          f"from the spawn over {views} camera yaws (polygon fills only)")
+
+def analyze_courses(json_path=None, jobs=None):
+    """Build every course in a process pool and print a cost table, or write JSON ("-" for stdout)."""
+    # Workers re-import this script, which opens a window at import time: fork them
+    # from this process where possible, and give spawned ones the dummy video driver.
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context("spawn")
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        rows = list(pool.map(analyze_course, range(len(COURSE_LIST))))
+    if json_path == "-":
+        print(json.dumps(rows, indent=2))
+        return rows
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        return rows
+    print(f"{'Course':22s} {'verts':>11s} {'faces':>11s} {'plat':>4s} {'star':>4s} {'coin':>4s} "
+          f"{'KB':>6s} {'build':>7s} {'proj':>6s} {'dupV':>4s} {'unusedV':>7s} {'degF':>4s} {'dupF':>4s}")
+    for r in rows:
+        print(f"{r['name']:22s} {r['verts']:5d}>{r['verts_optimized']:5d} {r['faces']:5d}>{r['faces_optimized']:5d} "
+              f"{r['platforms']:4d} {r['stars']:4d} {r['coins']:4d} {r['world_bytes'] / 1024:6.1f} "
+              f"{r['build_ms']:5.0f}ms {r['project_ms']:4.1f}ms {r['duplicate_verts']:4d} {r['unused_verts']:7d} "
+              f"{r['degenerate_faces']:4d} {r['duplicate_faces']:4d}")
+    print("verts/faces: as built > compiled (welded, merged and split by the BSP); "
+          "dup/unused/deg counts are as built")
+    print(f"proj: mean static + terrain + water projection from the spawn over {ANALYZE_VIEWS} camera yaws")
+    return rows
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ultra Mario 3D Bros")
+    parser.add_argument("--mesh-report", action="store_true",
+                        help="print face counts before/after mesh optimisation and BSP splitting for every course")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="print per-course mesh memory for list, array and packed storage")
+    parser.add_argument("--stress-enemies", type=int, nargs="?", const=500, metavar="N",
+                        help="time Bob-omb Battlefield with N extra enemies (default 500); fails if p95 misses 60 FPS")
+    parser.add_argument("--alloc-bench", action="store_true",
+                        help="trace per-frame allocations while playing Bob-omb Battlefield and check them "
+                             "against the allocation budget")
+    parser.add_argument("--analyze", action="store_true",
+                        help="build every course in parallel and report counts, memory, projection cost "
+                             "and duplicate/degenerate geometry")
+    parser.add_argument("--overdraw", action="store_true",
+                        help="print average and max overdraw per course from the spawn at several camera yaws")
+    parser.add_argument("--profile-spikes", nargs="?", const="spikes.folded", metavar="PATH",
+                        help="sample the main thread while playing (or with --stress-enemies) and write the "
+                             "stacks of frames over 16.7 ms to PATH as folded stacks (default spikes.folded)")
+    parser.add_argument("--json", nargs="?", const="-", metavar="PATH",
+                        help="with --analyze, write JSON to PATH (stdout if omitted) instead of a table")
+    parser.add_argument("--jobs", type=int, default=None, metavar="N",
+                        help="with --analyze, worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    if args.profile_spikes:
+        spike_profiler.start(args.profile_spikes)
+        atexit.register(spike_profiler.stop)
+    if args.mesh_report:
+        mesh_report()
+        sys.exit()
+    if args.memory_report:
+        memory_report()
+        sys.exit()
+    if args.stress_enemies:
+        sys.exit(0 if stress_enemies(args.stress_enemies) else 1)
+    if args.alloc_bench:
+        sys.exit(0 if alloc_bench() else 1)
+    if args.analyze:
+        analyze_courses(args.json, args.jobs)
+        sys.exit()
+    if args.overdraw:
+        overdraw_report()
+        sys.exit()
     main()
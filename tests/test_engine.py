@@ -0,0 +1,346 @@
+import importlib.util
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+GAME_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "$acholdingsm64.py")
+
+def _load_game():
+    spec = importlib.util.spec_from_file_location("acholdingsm64", GAME_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+game = _load_game()
+
+
+# -------------------------------------------------
+# COMPILED COURSES (user-026)
+# -------------------------------------------------
+@pytest.fixture
+def fresh_keys(monkeypatch):
+    monkeypatch.setattr(game, "_course_keys", {})
+    return game._course_keys
+
+def test_course_key_is_stable(fresh_keys):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    assert game.course_key(game.CastleGrounds) == key
+    assert game.course_key(game.BobOmbBattlefield) != key
+
+def test_course_key_changes_with_baked_constant(fresh_keys, monkeypatch):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    monkeypatch.setattr(game, "WELD_EPS", game.WELD_EPS * 2)
+    assert game.course_key(game.CastleGrounds) != key
+
+def test_course_key_changes_with_colour_constant(fresh_keys, monkeypatch):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    monkeypatch.setattr(game, "GRASS_GREEN", (1, 2, 3))
+    assert game.course_key(game.CastleGrounds) != key
+
+def test_course_key_changes_with_course_source(fresh_keys, monkeypatch):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    game._source_of("CastleGrounds")   # make sure the source table is filled
+    sources = dict(game._top_level_sources)
+    sources["CastleGrounds"] += "\n# edited\n"
+    monkeypatch.setattr(game, "_top_level_sources", sources)
+    assert game.course_key(game.CastleGrounds) != key
+
+def test_course_key_changes_with_pipeline_source(fresh_keys, monkeypatch):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    game._source_of("optimize_world")
+    sources = dict(game._top_level_sources)
+    sources["optimize_world"] += "\n# edited\n"
+    monkeypatch.setattr(game, "_top_level_sources", sources)
+    assert game.course_key(game.CastleGrounds) != key
+
+def test_course_key_changes_with_format_version(fresh_keys, monkeypatch):
+    key = game.course_key(game.CastleGrounds)
+    fresh_keys.clear()
+    monkeypatch.setattr(game, "COURSE_FORMAT_VERSION", game.COURSE_FORMAT_VERSION + 1)
+    assert game.course_key(game.CastleGrounds) != key
+
+@pytest.mark.parametrize("WorldClass", [game.CastleGrounds, game.CoolCoolMountain, game.LethalLavaLand])
+def test_compiled_course_round_trip(tmp_path, WorldClass):
+    built = game.build_course(WorldClass)
+    path = str(tmp_path / "course.course")
+    game.write_compiled_course(path, built)
+    loaded = game.read_compiled_course(path, WorldClass)
+
+    assert loaded.name == built.name
+    assert loaded.spawn == tuple(built.spawn)
+    assert loaded.platforms == [tuple(p) for p in built.platforms]
+    assert [(s.x, s.y, s.z) for s in loaded.stars] == [(s.x, s.y, s.z) for s in built.stars]
+    assert [(c.x, c.y, c.z) for c in loaded.coins] == [(c.x, c.y, c.z) for c in built.coins]
+    assert loaded.movers.count == built.movers.count
+    built_arrays, loaded_arrays = built.mesh.arrays(), loaded.mesh.arrays()
+    assert built_arrays.keys() == loaded_arrays.keys()
+    for name, arr in built_arrays.items():
+        np.testing.assert_array_equal(loaded_arrays[name], arr, err_msg=name)
+    assert len(loaded.terrains) == len(built.terrains)
+    for a, b in zip(loaded.terrains, built.terrains):
+        np.testing.assert_array_equal(a.heights, b.heights)
+    assert (loaded.bsp is None) == (built.bsp is None)
+    assert len(loaded.collision) == len(built.collision)
+
+def test_read_compiled_course_rejects_truncated_file(tmp_path):
+    path = tmp_path / "short.course"
+    path.write_bytes(b"UM")
+    with pytest.raises(ValueError):
+        game.read_compiled_course(str(path), game.CastleGrounds)
+
+def test_read_compiled_course_rejects_bad_magic(tmp_path):
+    path = tmp_path / "bad.course"
+    path.write_bytes(game._HEADER.pack(b"NOPE", game.COURSE_FORMAT_VERSION, 2) + b"{}")
+    with pytest.raises(ValueError):
+        game.read_compiled_course(str(path), game.CastleGrounds)
+
+def test_read_compiled_course_rejects_old_version(tmp_path):
+    built = game.build_course(game.CastleGrounds)
+    path = tmp_path / "old.course"
+    game.write_compiled_course(str(path), built)
+    data = bytearray(path.read_bytes())
+    game._HEADER.pack_into(data, 0, game.COURSE_MAGIC, game.COURSE_FORMAT_VERSION - 1,
+                           game._HEADER.unpack_from(data, 0)[2])
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        game.read_compiled_course(str(path), game.CastleGrounds)
+
+
+# -------------------------------------------------
+# COLLISION BVH (user-041)
+# -------------------------------------------------
+def _random_boxes(rng, n):
+    centres = rng.uniform(-2000, 2000, size=(n, 3))
+    sizes = rng.uniform(20, 400, size=(n, 3))
+    return [tuple(c) + tuple(s) for c, s in zip(centres.tolist(), sizes.tolist())]
+
+def _check_bounds(bvh):
+    """Every node's bounds must equal the union of the boxes of the leaves below it."""
+    def walk(n):
+        if bvh.item[n] >= 0:
+            lo, hi = bvh._bounds(bvh.boxes[bvh.item[n]])
+        else:
+            (llo, lhi), (rlo, rhi) = walk(bvh.left[n]), walk(bvh.right[n])
+            lo = [min(p, q) for p, q in zip(llo, rlo)]
+            hi = [max(p, q) for p, q in zip(lhi, rhi)]
+        assert bvh.lo[n] == pytest.approx(lo)
+        assert bvh.hi[n] == pytest.approx(hi)
+        return lo, hi
+    walk(0)
+
+def test_bvh_build_bounds():
+    bvh = game.CollisionBVH(_random_boxes(np.random.default_rng(1), 57))
+    _check_bounds(bvh)
+
+def test_bvh_refit_bounds_after_moves():
+    rng = np.random.default_rng(2)
+    boxes = _random_boxes(rng, 64)
+    bvh = game.CollisionBVH(boxes, first_mover=40)
+    for _ in range(20):
+        moved = rng.choice(np.arange(40, 64), size=rng.integers(1, 10), replace=False).tolist()
+        for i in moved:
+            x, y, z, w, h, d = bvh.boxes[i]
+            dx, dy, dz = rng.uniform(-600, 600, size=3).tolist()
+            bvh.boxes[i] = (x + dx, y + dy, z + dz, w, h, d)
+        dirty = bvh.refit(moved)
+        assert 0 < dirty < len(bvh.lo)
+        _check_bounds(bvh)
+
+def test_bvh_refit_matches_rebuilt_column_queries():
+    rng = np.random.default_rng(3)
+    bvh = game.CollisionBVH(_random_boxes(rng, 48))
+    moved = list(range(0, 48, 3))
+    for i in moved:
+        x, y, z, w, h, d = bvh.boxes[i]
+        bvh.boxes[i] = (x + 900, y, z - 700, w, h, d)
+    bvh.refit(moved)
+    rebuilt = game.CollisionBVH(bvh.boxes)
+    for x, z in rng.uniform(-2500, 2500, size=(200, 2)).tolist():
+        assert sorted(i for i, _ in bvh.column(x, z)) == sorted(i for i, _ in rebuilt.column(x, z))
+
+def test_bvh_first_mover_defaults_past_every_box():
+    boxes = _random_boxes(np.random.default_rng(4), 5)
+    assert game.CollisionBVH(boxes).first_mover == 5
+    assert game.CollisionBVH(boxes, first_mover=3).first_mover == 3
+
+class _NoKeys(dict):
+    def __getitem__(self, key):
+        return False
+
+@pytest.mark.parametrize("first_mover, lands", [(None, True), (0, False)])
+def test_mario_steps_up_onto_static_boxes_only(first_mover, lands):
+    bvh = game.CollisionBVH([(0, 10, 0, 100, 20, 100)], first_mover=first_mover)
+    mario = game.Mario(0, 0)
+    mario.update(_NoKeys(), 0.0, bvh)
+    assert (mario.floor_item == 0) == lands
+    assert mario.y == (20.0 if lands else 0.0)
+
+
+# -------------------------------------------------
+# TERRAIN (user-043)
+# -------------------------------------------------
+LIGHTS = [((0.3, -1.0, 0.2), 0.8)]
+
+def _terrain(cells=16, chunk=4, seed=5):
+    rng = np.random.default_rng(seed)
+    heights = rng.uniform(0, 300, size=(cells + 1, cells + 1))
+    return game.Terrain(0, 0, 1600, heights, [(150, (90, 140, 60)), (400, (200, 200, 200))],
+                        LIGHTS, 0.4, chunk=chunk)
+
+def test_terrain_height_at_grid_vertices():
+    t = _terrain()
+    for i in (0, 3, 8, 16):
+        for j in (0, 5, 16):
+            x = t.x0 + i * t.spacing
+            z = t.z0 + j * t.spacing
+            assert t.height_at(x, z) == pytest.approx(float(t.heights[i, j]), abs=1e-3)
+
+def test_terrain_height_at_is_bilinear_inside_a_cell():
+    t = _terrain()
+    i, j, fu, fv = 6, 9, 0.25, 0.7
+    h = t.heights.astype(np.float64)
+    expected = ((h[i, j] * (1 - fu) + h[i + 1, j] * fu) * (1 - fv)
+                + (h[i, j + 1] * (1 - fu) + h[i + 1, j + 1] * fu) * fv)
+    x = t.x0 + (i + fu) * t.spacing
+    z = t.z0 + (j + fv) * t.spacing
+    assert t.height_at(x, z) == pytest.approx(expected, abs=1e-3)
+
+def test_terrain_height_at_outside_is_none():
+    t = _terrain()
+    assert t.height_at(t.x0 - 1, 0) is None
+    assert t.height_at(0, t.z0 + t.size + 1) is None
+
+def test_stitched_heights_match_coarse_neighbour_edges():
+    t = _terrain()
+    coarse = t.levels - 1
+    levels = np.zeros(t.side * t.side, dtype=np.int64)
+    levels[5] = coarse            # one coarse chunk surrounded by full resolution
+    y = t.stitched_heights(levels)
+    base = t.base_y
+    stitched = 0
+    for c, level in enumerate(levels.tolist()):
+        if level == coarse:
+            continue
+        for edge, nb in zip(t.chunk_edges[c], t.neighbours[c]):
+            if nb < 0 or levels[nb] <= level:
+                np.testing.assert_array_equal(y[edge], base[edge])
+                continue
+            stitched += 1
+            # The fine edge must lie on the straight coarse edge between its corners
+            k = np.arange(len(edge)) / (len(edge) - 1)
+            expected = base[edge[0]] * (1 - k) + base[edge[-1]] * k
+            np.testing.assert_allclose(y[edge], expected, atol=1e-6)
+    assert stitched == 4
+    # Away from the coarse chunk's edges every vertex keeps its height
+    touched = np.zeros(len(base), dtype=bool)
+    for edge in t.chunk_edges[5]:
+        touched[edge] = True
+    np.testing.assert_array_equal(y[~touched], base[~touched])
+
+def test_stitched_heights_leave_uniform_levels_untouched():
+    t = _terrain()
+    for level in range(t.levels):
+        y = t.stitched_heights(np.full(t.side * t.side, level, dtype=np.int64))
+        np.testing.assert_array_equal(y, t.base_y)
+
+def test_terrain_level_error_is_zero_for_a_plane():
+    cells = 8
+    g = np.arange(cells + 1, dtype=np.float64)
+    heights = 3.0 * g[:, None] + 5.0 * g[None, :]
+    t = game.Terrain(0, 0, 800, heights, [(1000, (100, 100, 100))], LIGHTS, 0.4, chunk=4)
+    np.testing.assert_allclose(t.errors, 0.0, atol=1e-4)
+
+
+# -------------------------------------------------
+# PICKUPS (user-039)
+# -------------------------------------------------
+class _OldStar:
+    """Per-object star pickup as it was before the entity stores."""
+    def __init__(self, x, y, z, bob):
+        self.x, self.y, self.z, self.bob = x, y, z, bob
+        self.collected = False
+
+    def check(self, mario):
+        if self.collected:
+            return False
+        dx = mario.x - self.x
+        dy = mario.y - (self.y + math.sin(self.bob) * 10)
+        dz = mario.z - self.z
+        if math.sqrt(dx*dx + dy*dy + dz*dz) < 60:
+            self.collected = True
+            return True
+        return False
+
+class _OldCoin:
+    def __init__(self, x, y, z):
+        self.x, self.y, self.z = x, y, z
+        self.collected = False
+
+    def check(self, mario):
+        if self.collected:
+            return False
+        dx = mario.x - self.x
+        dy = mario.y - self.y
+        dz = mario.z - self.z
+        if math.sqrt(dx*dx + dy*dy + dz*dz) < 45:
+            self.collected = True
+            return True
+        return False
+
+def _walk(rng, steps):
+    mario = game.Mario(0, 0)
+    for _ in range(steps):
+        mario.x, mario.y, mario.z = rng.uniform(-300, 300, size=3).tolist()
+        yield mario
+
+def test_pickup_system_matches_per_object_stars():
+    rng = np.random.default_rng(6)
+    store = game.EntityStore(game.Star)
+    old = []
+    for x, y, z in rng.uniform(-300, 300, size=(80, 3)).tolist():
+        store.add(x, y, z)
+    store.phase[:store.count] = rng.uniform(0, 2 * math.pi, size=store.count)
+    for (x, y, z), bob in zip(store.pos[:store.count].tolist(), store.phase[:store.count].tolist()):
+        old.append(_OldStar(x, y, z, bob))
+    for mario in _walk(rng, 200):
+        lift = np.sin(store.phase[:store.count]) * game.STAR_BOB_HEIGHT
+        got = game.pickup_system(store, mario, game.STAR_REACH, lift)
+        assert got == sum(s.check(mario) for s in old)
+        assert store.collected[:store.count].tolist() == [s.collected for s in old]
+    assert 0 < store.collected[:store.count].sum() < store.count
+
+def test_pickup_system_matches_per_object_coins():
+    rng = np.random.default_rng(7)
+    store = game.EntityStore(game.Coin)
+    old = []
+    for x, y, z in rng.uniform(-300, 300, size=(120, 3)).tolist():
+        store.add(x, y, z)
+        old.append(_OldCoin(x, y, z))
+    for mario in _walk(rng, 200):
+        got = game.pickup_system(store, mario, game.COIN_REACH)
+        assert got == sum(c.check(mario) for c in old)
+        assert store.collected[:store.count].tolist() == [c.collected for c in old]
+    assert 0 < store.collected[:store.count].sum() < store.count
+
+def test_pickup_system_counts_each_entity_once():
+    store = game.EntityStore(game.Coin)
+    store.add(0, 0, 0)
+    store.add(10, 0, 0)
+    store.add(500, 0, 0)
+    mario = game.Mario(0, 0)
+    assert game.pickup_system(store, mario, game.COIN_REACH) == 2
+    assert game.pickup_system(store, mario, game.COIN_REACH) == 0
+    store.reset()
+    assert game.pickup_system(store, mario, game.COIN_REACH) == 2